@@ -1,12 +1,17 @@
 from invoke import Collection
 
 from .base import do, dry, e, echo, t1, t2
-from .develop import build
+from .benchmark import benchmark_backup
+from .catalog import catalog
+from .develop import benchmark_startup, build
 from .factory import make_wheels, release_runtime
 from .notify import send_alert, send_mail
+from .parallel import fan
+from .plan import replay
 from .remote import install_dstack_bot
 from .server import create_ssh_config, machine_create, machine_info, machine_status
-from .tasks import create_backup_table, db, deploy_code, full_db_test, release_code, release_superset, test
+from .tasks import (
+    create_backup_table, db, deploy_code, full_db_test, release_code, release_superset, static_sync_task, test)
 from .wrap import bash, compose, docker, filer, git, machine, mysql, python, s3cmd
 
 ns = Collection()
@@ -14,9 +19,13 @@ ns = Collection()
 ns.add_task(e)
 ns.add_task(echo)
 ns.add_task(dry)
+ns.add_task(replay)
 ns.add_task(bash)
+ns.add_task(fan)
 
 ns.add_task(build)
+ns.add_task(benchmark_startup)
+ns.add_task(benchmark_backup)
 
 ns.add_task(s3cmd)
 ns.add_task(git)
@@ -29,10 +38,12 @@ ns.add_task(mysql)
 ns.add_task(test)
 ns.add_task(release_code)
 ns.add_task(deploy_code)
+ns.add_task(static_sync_task)
 ns.add_task(release_superset)
 ns.add_task(db)
 ns.add_task(create_backup_table)
 ns.add_task(full_db_test)
+ns.add_task(catalog)
 
 # notify
 ns.add_task(send_alert)
@@ -0,0 +1,191 @@
+import asyncio
+import functools
+import os
+
+from .base import LOCAL_PREFIX, REMOTE_PREFIX, DryResult, env, format_command, normalize_path, shell_command
+from .parallel import fork_context
+from .pool import parse_host
+from .trace import record_result, span
+from .wrap import s3_command, s3_locations
+
+# Maximum number of commands running at the same time per host
+HOST_CONCURRENCY = int(os.getenv('ASYNC_HOST_CONCURRENCY', 4))
+
+_semaphores = {}
+_ssh_connections = {}
+_ssh_locks = {}
+
+
+def host_semaphore(host):
+    """Semaphore limiting the number of concurrent commands on host in the running event loop."""
+    key = (id(asyncio.get_event_loop()), host or 'local')
+    if key not in _semaphores:
+        _semaphores[key] = asyncio.Semaphore(HOST_CONCURRENCY)
+    return _semaphores[key]
+
+
+async def _read(reader, hide, stream):
+    chunks = []
+    while True:
+        chunk = await reader.read(64 * 1024)
+        if not chunk:
+            break
+        text = chunk.decode('utf-8', errors='replace')
+        chunks.append(text)
+        if not hide:
+            stream.write(text)
+    return ''.join(chunks)
+
+
+async def _run_local(cmd, path, run_env, sudo, hide):
+    import sys
+
+    process_env = dict(os.environ, **{k: str(v) for k, v in (run_env or {}).items()})
+    # Same shell as `base.do` and stream.py
+    shell = '/bin/bash' if os.path.exists('/bin/bash') else None
+    process = await asyncio.create_subprocess_shell(
+        shell_command(cmd, sudo=sudo), cwd=path or None, env=process_env, executable=shell,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await asyncio.gather(
+        _read(process.stdout, hide in (True, 'both', 'out', 'stdout'), sys.stdout),
+        _read(process.stderr, hide in (True, 'both', 'err', 'stderr'), sys.stderr))
+    return stdout, stderr, await process.wait()
+
+
+async def _ssh_connection(ctx, host):
+    import asyncssh
+
+    hostname, user, port = parse_host(host, getattr(ctx, 'user', None), getattr(ctx, 'port', None))
+    key = (id(asyncio.get_event_loop()), hostname, user, port)
+    # Commands started together on a new host wait for one connection instead of each opening their own
+    async with _ssh_locks.setdefault(key, asyncio.Lock()):
+        if key not in _ssh_connections:
+            _ssh_connections[key] = await asyncssh.connect(hostname, port=port or (), username=user or ())
+    return _ssh_connections[key]
+
+
+async def _run_remote(ctx, cmd, path, run_env, sudo, host, hide, **kwargs):
+    import sys
+
+    try:
+        import asyncssh  # noqa: F401
+    except ImportError:
+        # Fall back to the blocking pooled connection in a worker thread
+        from .base import do as do_sync
+        loop = asyncio.get_event_loop()
+        call = functools.partial(do_sync, fork_context(ctx, host), cmd, dry_run=False, sudo=sudo, host=host,
+                                 path=path, env=run_env, hide=hide, warn=True, **kwargs)
+        result = await loop.run_in_executor(None, call)
+        return result.stdout, result.stderr, result.exited
+
+    connection = await _ssh_connection(ctx, host)
+    completed = await connection.run(shell_command(cmd, path, run_env, sudo), check=False)
+    if hide not in (True, 'both', 'out', 'stdout') and completed.stdout:
+        print(completed.stdout, end='')
+    if hide not in (True, 'both', 'err', 'stderr') and completed.stderr:
+        print(completed.stderr, end='', file=sys.stderr)
+    return completed.stdout or '', completed.stderr or '', completed.exit_status
+
+
+async def do(ctx, cmd, dry_run=None, local=False, sudo=False, host=None, **kwargs):
+    """Async version of `base.do` with the same dry run, `path` and `env` semantics.
+
+    Local commands run as asyncio subprocesses. Remote commands use asyncssh when it is installed and otherwise run
+    on the connection pool in a worker thread. At most ASYNC_HOST_CONCURRENCY (default 4) commands run on a host at
+    the same time.
+
+    Args:
+        ctx: Run context.
+        cmd: The command to execute, e.g. 'ls'
+        dry_run: Override the the env.dry_run variable.
+        local: Whether to run locally or not.
+        sudo: Whether to run as sudo or not.
+        host: Run on this host instead of the context's host.
+        **kwargs: path, env, hide and warn.
+
+    Returns:
+        invoke.runners.Result or DryResult
+
+    Examples:
+        async def steps(ctx):
+            await asyncio.gather(
+                aio.s3cmd(ctx, simple_path='dist/app-1.0.0-py3-none-any.whl'),
+                aio.compose(ctx, 'build django'),
+            )
+        asyncio.run(steps(ctx))
+
+    """
+    from invoke.exceptions import UnexpectedExit
+    from invoke.runners import Result
+
+    run_env = kwargs.pop('env', None) or {}
+    path = kwargs.pop('path', None)
+    hide = kwargs.pop('hide', None)
+    warn = kwargs.pop('warn', False)
+    host = None if local else host or getattr(ctx, 'host', None)
+
+    if dry_run is None:
+        dry_run = env.dry_run
+
+    path = normalize_path(path, host)
+
+    if dry_run and env.plan is not None:
+        from .plan import host_string
+
+        # Replayed one after the other with `base.do`, see plan.py
+        plan_host = host if host and host != getattr(ctx, 'host', None) else host_string(ctx)
+        env.plan.record(cmd, host=plan_host, path=path, run_env=run_env, sudo=sudo, local=local, hide=hide,
+                        warn=warn, **kwargs)
+
+    if dry_run:
+        cmd_str = format_command(cmd, path, run_env)
+        print(REMOTE_PREFIX if host else LOCAL_PREFIX, cmd_str)
+        return DryResult(cmd_str)
+
+    async with host_semaphore(host):
+        with span(cmd if len(cmd) <= 80 else cmd[:77] + '...', 'command', command=cmd, host=host or 'local',
+                  cwd=path or os.getcwd(), sudo=sudo) as trace_args:
+            if host:
+                stdout, stderr, exited = await _run_remote(ctx, cmd, path, run_env, sudo, host, hide, **kwargs)
+            else:
+                stdout, stderr, exited = await _run_local(cmd, path, run_env, sudo, hide)
+            result = Result(stdout=stdout, stderr=stderr, command=cmd, exited=exited,
+                            hide=('stdout', 'stderr') if hide else ())
+            record_result(trace_args, result)
+
+    if exited != 0 and not warn:
+        raise UnexpectedExit(result)
+    return result
+
+
+async def bash(ctx, cmd, path=None, local=None, env_vars=None, host=None):
+    """Async `wrap.bash`."""
+    if env_vars:
+        env_vars = dict(item.split("=") for item in env_vars.split(","))
+    with span('bash', 'wrapper', cmd=cmd):
+        return await do(ctx, cmd=cmd, path=path, local=local, env=env_vars, host=host)
+
+
+async def docker(ctx, cmd='--help', **kwargs):
+    """Async `wrap.docker`."""
+    with span('docker', 'wrapper', cmd=cmd):
+        return await do(ctx, f'docker {cmd}', **kwargs)
+
+
+async def compose(ctx, cmd='--help', **kwargs):
+    """Async `wrap.compose`."""
+    if kwargs.get('path', None) is None:
+        kwargs['path'] = ctx['dir']
+    with span('compose', 'wrapper', cmd=cmd):
+        return await do(ctx, f'docker-compose {cmd}', **kwargs)
+
+
+async def s3cmd(ctx, cmd='cp', simple_path=None, direction='up', local_path=None, s3_path=None, bucket=None,
+                project_name=None, exact_timestamps=False, **kwargs):
+    """Async `wrap.s3cmd`."""
+    if kwargs.get('path', None) is None:
+        kwargs['path'] = ctx['dir']
+
+    local_path, s3_uri = s3_locations(ctx, simple_path, local_path, s3_path, bucket, project_name)
+    with span('s3cmd', 'wrapper', cmd=cmd, direction=direction, local_path=local_path, s3_uri=s3_uri):
+        return await do(ctx, cmd=s3_command(cmd, direction, local_path, s3_uri, exact_timestamps), **kwargs)
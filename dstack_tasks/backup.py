@@ -0,0 +1,288 @@
+import hashlib
+import os
+import zlib
+
+from .base import LOCAL_PREFIX, REMOTE_PREFIX, do, env
+from .engine import get_engine, use_engine
+from .plan import unreplayable
+from .trace import span
+
+# File name suffix per compression
+COMPRESSION_SUFFIX = {None: '', 'gzip': '.gz'}
+
+
+class Checksum(object):
+    """Passes chunks through while keeping a running sha256 and byte count."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self.sha256.update(chunk)
+            self.size += len(chunk)
+            yield chunk
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def compress(chunks, compression='gzip', level=6):
+    """Compress an iterable of bytes chunks incrementally.
+
+    Args:
+        chunks: Iterable of bytes.
+        compression: 'gzip' or None to pass the chunks through unchanged.
+        level: zlib compression level. pg_dump's custom format is already compressed, so a low level is usually
+            enough.
+
+    """
+    if compression is None:
+        yield from chunks
+        return
+    if compression != 'gzip':
+        raise ValueError(f'Unsupported compression: {compression}')
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def dump_chunks(ctx, container, cmd):
+    """Yield the stdout of a command in a container as bytes chunks.
+
+    Uses the Docker Engine API when enabled, see engine.py, and otherwise streams `docker exec` locally or over the
+    pooled SSH connection.
+
+    Raises:
+        RuntimeError or invoke.exceptions.UnexpectedExit: When the command fails, after its output was read.
+
+    """
+    if use_engine(ctx):
+        engine = get_engine()
+        exec_id = engine.exec_create(container, cmd)
+        stderr = []
+        for stream, data in engine.exec_stream(exec_id):
+            if stream == 2:
+                stderr.append(data)
+            else:
+                yield data
+        exit_code = engine.exec_exit_code(exec_id)
+        if exit_code != 0:
+            raise RuntimeError(f'{cmd} failed with exit code {exit_code}: {b"".join(stderr).decode()}')
+    else:
+        yield from do(ctx, f'docker exec {container} {cmd}', stream=True, hide='stdout').chunks()
+
+
+def stream_backup(chunks, bucket, key, compression=None, client=None):
+    """Upload a dump to S3 while it is produced, without a temporary file.
+
+    The chunks are compressed on the fly and sent as a multipart upload, so memory use is bounded by the S3 chunk size
+    and concurrency, see s3.py. A failing producer aborts the upload. The sha256 of the uploaded bytes is stored next
+    to the object as `{key}.sha256`, in the format of `sha256sum`.
+
+    Args:
+        chunks: Iterable of bytes, e.g. `dump_chunks(...)`
+        bucket: The S3 bucket.
+        key: The object key, without compression suffix.
+        compression: None or 'gzip'
+        client: Defaults to the shared client.
+
+    Returns:
+        Tuple of the key, sha256 hex digest and size of the uploaded object.
+
+    """
+    from . import s3
+
+    key += COMPRESSION_SUFFIX[compression]
+    checksum = Checksum(compress(chunks, compression))
+    with span('stream_backup', 's3', bucket=bucket, key=key) as trace_args:
+        s3.upload_stream(checksum, bucket, key, client=client,
+                         extra_args={'ContentType': 'application/gzip' if compression else 'application/octet-stream'})
+        trace_args['bytes'] = checksum.size
+    digest = checksum.hexdigest()
+    s3.upload_stream(f'{digest}  {key.rsplit("/", 1)[-1]}\n', bucket, f'{key}.sha256', client=client)
+    return key, digest, checksum.size
+
+
+def backup_to_s3(ctx, container, bucket, key, compression=None, database='postgres', user='postgres'):
+    """Stream `pg_dump -F c` from a container straight to S3, see `stream_backup`.
+
+    Returns:
+        Tuple of the key, sha256 hex digest and size, or None in dry run mode.
+
+    """
+    cmd = f'pg_dump -U {user} -F c -d {database}'
+    if env.dry_run:
+        prefix = REMOTE_PREFIX if getattr(ctx, 'host', False) else LOCAL_PREFIX
+        print(prefix, f'docker exec {container} {cmd} | {compression or "cat"} '
+                      f'> s3://{bucket}/{key}{COMPRESSION_SUFFIX[compression]}')
+        unreplayable(f'streamed upload of {container} to s3://{bucket}/{key}')
+        return None
+    key, digest, size = stream_backup(dump_chunks(ctx, container, cmd), bucket, key, compression)
+    print(f'Uploaded s3://{bucket}/{key} ({size} bytes, sha256 {digest})')
+    return key, digest, size
+
+
+def _cpuset_size(cpuset):
+    # e.g. '0-3,6' is 5 cpus
+    count = 0
+    for part in filter(None, cpuset.split(',')):
+        start, _, end = part.partition('-')
+        count += int(end or start) - int(start) + 1
+    return count
+
+
+def container_cpus(ctx, container):
+    """Number of cpus a container may use, from its cpu limits or otherwise the cpus of its host.
+
+    Returns:
+        Number of cpus, or None in dry run mode.
+
+    """
+    import math
+
+    if env.dry_run:
+        return None
+    if use_engine(ctx):
+        config = get_engine().inspect(container)['HostConfig']
+        nano_cpus, quota, period, cpuset = (config.get('NanoCpus') or 0, config.get('CpuQuota') or 0,
+                                            config.get('CpuPeriod') or 0, config.get('CpusetCpus') or '')
+    else:
+        from .wrap import docker
+
+        result = docker(ctx, "inspect --format '{{.HostConfig.NanoCpus}} {{.HostConfig.CpuQuota}} "
+                             "{{.HostConfig.CpuPeriod}} {{.HostConfig.CpusetCpus}}' " + container, hide=True, ttl=60)
+        fields = result.stdout.split() + ['']
+        nano_cpus, quota, period, cpuset = int(fields[0]), int(fields[1]), int(fields[2]), fields[3]
+
+    if nano_cpus > 0:
+        return math.ceil(nano_cpus / 1e9)
+    if quota > 0 and period > 0:
+        return math.ceil(quota / period)
+    if cpuset:
+        return _cpuset_size(cpuset)
+    result = do(ctx, f'docker exec {container} nproc', hide=True, warn=True, ttl=60)
+    return int(result.stdout.strip()) if result.ok and result.stdout.strip().isdigit() else 1
+
+
+def default_jobs(ctx, container):
+    """Default number of parallel pg_dump/pg_restore jobs for a container.
+
+    One job per cpu the container may use. Set DB_JOBS to override, in dry run mode the default is 2.
+    """
+    if os.getenv('DB_JOBS'):
+        return int(os.getenv('DB_JOBS'))
+    return container_cpus(ctx, container) or 2
+
+
+def parallel_backup(ctx, container, backup_path, s3_path, jobs=None, bucket='dstack-storage', sync=True,
+                    user='postgres', database='postgres'):
+    """Directory format `pg_dump -j` and a parallel upload of the dump files.
+
+    The dump is written to /tmp in the container, copied to backup_path and uploaded as one object per file under
+    s3_path, `aws s3 sync` and `s3.sync` transfer the files concurrently. The per-table files of the directory
+    format are already compressed.
+
+    Args:
+        ctx: Run context.
+        container: The postgres container.
+        backup_path: Local or host directory for the dump directory.
+        s3_path: Prefix in the bucket, e.g. 'project/backups/backup_<tag>.dir'
+        jobs: Number of parallel dump jobs, see `default_jobs`.
+        bucket: The S3 bucket.
+        sync: Whether to upload the dump.
+        user: Database user.
+        database: Database name.
+
+    Returns:
+        Path of the dump directory.
+
+    """
+    from .wrap import docker, s3cmd
+
+    jobs = jobs or default_jobs(ctx, container)
+    name = s3_path.rstrip('/').rsplit('/', 1)[-1]
+    dump_dir = f'{backup_path}/{name}'
+    with span('parallel_backup', 'db', container=container, jobs=jobs):
+        docker(ctx, f'exec {container} rm -rf /tmp/{name}')
+        docker(ctx, f'exec {container} pg_dump -U {user} -F d -j {jobs} -f /tmp/{name} -d {database}')
+        do(ctx, f'rm -rf {dump_dir}')
+        docker(ctx, f'cp {container}:/tmp/{name} {dump_dir}')
+        docker(ctx, f'exec {container} rm -rf /tmp/{name}')
+        if sync:
+            s3cmd(ctx, cmd='sync', direction='up', local_path=f'{dump_dir}/', s3_path=f'{s3_path}/',
+                  bucket=bucket)
+    return dump_dir
+
+
+def parallel_restore(ctx, container, backup_path, s3_path, jobs=None, bucket='dstack-storage', sync=True,
+                     user='postgres', database='postgres'):
+    """Download a directory format dump and restore it with `pg_restore -j`, see `parallel_backup`.
+
+    Existing objects are dropped before they are recreated, the database server keeps running.
+    """
+    from .wrap import docker, s3cmd
+
+    jobs = jobs or default_jobs(ctx, container)
+    name = s3_path.rstrip('/').rsplit('/', 1)[-1]
+    dump_dir = f'{backup_path}/{name}'
+    with span('parallel_restore', 'db', container=container, jobs=jobs):
+        if sync:
+            s3cmd(ctx, cmd='sync', direction='down', local_path=f'{dump_dir}/', s3_path=f'{s3_path}/', bucket=bucket)
+        docker(ctx, f'exec {container} rm -rf /tmp/{name}')
+        docker(ctx, f'cp {dump_dir} {container}:/tmp/{name}')
+        docker(ctx, f'exec {container} pg_restore -U {user} -j {jobs} --clean --if-exists -d {database} /tmp/{name}')
+        docker(ctx, f'exec {container} rm -rf /tmp/{name}')
+
+
+def dedup_backup(ctx, chunks, bucket, prefix, tag, description, **metadata):
+    """Store a backup in the deduplicated chunk store, see chunkstore.py.
+
+    Args:
+        ctx: Run context.
+        chunks: Iterable of uncompressed bytes, e.g. `dump_chunks(...)`
+        bucket: The S3 bucket.
+        prefix: Prefix of the store in the bucket, e.g. '{project}/dedup'
+        tag: The backup tag.
+        description: The producing command, printed in dry run mode.
+        **metadata: Stored in the manifest, e.g. kind='pg_dump'
+
+    Returns:
+        The manifest, or None in dry run mode.
+
+    """
+    from .chunkstore import ChunkStore, report
+
+    if env.dry_run:
+        prefix_str = REMOTE_PREFIX if getattr(ctx, 'host', False) else LOCAL_PREFIX
+        print(prefix_str, f'{description} | chunk store s3://{bucket}/{prefix}/manifests/{tag}.json')
+        unreplayable(f'chunk store backup s3://{bucket}/{prefix}/manifests/{tag}.json')
+        return None
+    with span('dedup_backup', 's3', bucket=bucket, prefix=prefix, tag=tag) as trace_args:
+        manifest = ChunkStore(bucket, prefix).put(tag, chunks, **metadata)
+        trace_args.update(manifest['stats'])
+    print(report(manifest))
+    return manifest
+
+
+def dedup_restore(ctx, bucket, prefix, tag, path):
+    """Reassemble a backup from the chunk store into a local file, fetching chunks in parallel.
+
+    Returns:
+        The manifest, or None in dry run mode.
+
+    """
+    from .chunkstore import ChunkStore
+
+    if env.dry_run:
+        print(LOCAL_PREFIX, f'chunk store s3://{bucket}/{prefix}/manifests/{tag}.json > {path}')
+        unreplayable(f'chunk store restore s3://{bucket}/{prefix}/manifests/{tag}.json')
+        return None
+    with span('dedup_restore', 's3', bucket=bucket, prefix=prefix, tag=tag):
+        return ChunkStore(bucket, prefix).get(tag, path)
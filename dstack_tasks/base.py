@@ -1,17 +1,61 @@
 import logging
 import os
 import posixpath
-from distutils.util import strtobool
+import shlex
+import threading
+from contextlib import ExitStack
 
 import colorama
 from dotenv import load_dotenv
 from invoke import Config
 from invoke import task
 from invoke.env import Environment
-from setuptools_scm import get_version
+
+from .parallel import labelled_streams
+from .trace import record_result, span
+from .utils import strtobool
+from .version import resolve_version
+
+
+class LazyEnvironment(Environment):
+    """Environment that only resolves `version` and `tag` when they are first read.
+
+    Resolving the version spawns git, which is too expensive to do at import time for tasks like `dstack --list`.
+    """
+    _version = None
+    _tag = None
+    _thread = threading.local()
+
+    @property
+    def version(self):
+        if self._version is None:
+            self._version = resolve_version(getattr(self, 'src', None))
+        return self._version
+
+    @version.setter
+    def version(self, value):
+        self._version = value
+
+    @property
+    def tag(self):
+        return self.version if self._tag is None else self._tag
+
+    @tag.setter
+    def tag(self, value):
+        self._tag = value
+
+    @property
+    def batch(self):
+        """The batch the current thread is collecting commands in, see batch.py. Other threads don't join it."""
+        return getattr(self._thread, 'batch', None)
+
+    @batch.setter
+    def batch(self, value):
+        self._thread.batch = value
+
 
 conf = Config()
-env = Environment(config=conf, prefix='')
+env = LazyEnvironment(config=conf, prefix='')
 env.load()
 
 # Global config
@@ -21,19 +65,11 @@ env.src = os.path.join(env.pwd, 'src')
 env.directory = os.path.basename(env.pwd)
 env.remote = False
 env.dry_run = False
+env.batch = None
+env.plan = None
+env.hosts = []
 
-# Attempt to get a version number
-try:
-    # env.version = get_version(root='.', relative_to=env.pwd)
-    env.version = get_version()
-except LookupError:
-    try:
-        with open(os.path.join(env.src, 'version.txt')) as f:
-            env.version = f.readline().strip()
-    except FileNotFoundError:
-        env.version = os.getenv('VERSION', '0.0.0-dev')
-
-env.tag = env.version
+# env.version and env.tag are resolved on first access, see LazyEnvironment
 
 LOCAL_PREFIX = colorama.Fore.YELLOW + '[local]' + colorama.Fore.RESET
 REMOTE_PREFIX = colorama.Fore.RED + '[remote]' + colorama.Fore.RESET
@@ -110,6 +146,8 @@ def e(ctx, collection=None, tag=None, live=False, debug=False):
         'venv_type': os.getenv('VENV_TYPE', 'conda'),
         'image_name': os.getenv('IMAGE_NAME', ''),
         's3_project_prefix': os.getenv('S3_PROJECT_PREFIX', os.getenv('PROJECT_NAME', env.directory)),
+        's3_engine': os.getenv('S3_ENGINE', 'cli'),
+        'docker_backend': os.getenv('DOCKER_BACKEND', 'cli'),
 
         'node_modules_prefix': os.getenv('NODE_PREFIX', '.local'),
     })
@@ -158,8 +196,8 @@ def e(ctx, collection=None, tag=None, live=False, debug=False):
     # Configure deployment
     ctx.remote = remote
 
-    # Try to get the host_name
-    env.hosts = [os.getenv('HOST_NAME', None), ]
+    # Try to get the host names, HOST_NAMES is a comma separated list used by the `fan` task
+    env.hosts = [h.strip() for h in os.getenv('HOST_NAMES', os.getenv('HOST_NAME', '')).split(',') if h.strip()]
 
     host = getattr(ctx, 'host', False)
     if host or live:
@@ -170,27 +208,144 @@ def e(ctx, collection=None, tag=None, live=False, debug=False):
 
 # noinspection PyUnusedLocal
 @task
-def dry(ctx):
+def dry(ctx, plan=None):
     """Print task commands instead of executing them
 
     Args:
         ctx: Run context.
+        plan: Also save the commands as a plan to this file, see `replay`.
 
     Returns:
 
     """
     env.dry_run = True
+    if plan:
+        import atexit
+        from .plan import Plan
+
+        env.plan = Plan()
+        atexit.register(env.plan.save, plan)
+
+
+def format_command(cmd, path=None, run_env=None):
+    """Single line shell representation of a command as `do` would run it.
+
+    Args:
+        cmd: The command, e.g. 'ls'
+        path: Directory to change to before running the command.
+        run_env: Environmental variables to export before running the command.
+
+    Returns:
+        The command string, e.g. 'export foo=bar && cd /tmp && ls'
+
+    """
+    cmd_str = []
+    if run_env:
+        # noinspection PyUnresolvedReferences
+        env_vars = 'export ' + ' '.join(f'{k}={v}' for k, v in run_env.items())
+        cmd_str.append(env_vars)
+    if path:
+        cmd_str.append(f'cd {path}')
+    cmd_str.append(cmd)
+    return ' && '.join(cmd_str)
+
+
+def shell_command(cmd, path=None, run_env=None, sudo=False):
+    """Quoted shell command that runs cmd in path with run_env exported, for running outside of invoke.
+
+    Args:
+        cmd: The command, e.g. 'ls'
+        path: Directory to change to before running the command.
+        run_env: Environmental variables to export before running the command.
+        sudo: Whether to run the command with non-interactive sudo.
+
+    Returns:
+        The command string.
+
+    """
+    inner = []
+    if run_env:
+        inner.append('export ' + ' '.join(f'{k}={shlex.quote(str(v))}' for k, v in run_env.items()))
+    if path:
+        inner.append(f'cd {shlex.quote(path)}')
+    inner.append(cmd)
+    inner = ' && '.join(inner)
+    if sudo:
+        inner = f'sudo -n -H sh -c {shlex.quote(inner)}'
+    return inner
 
 
 class DryResult(object):
     def __init__(self, message):
         self.message = message
 
+    def __iter__(self):
+        # Streamed commands produce no output in dry run mode
+        return iter(())
+
     @property
     def stdout(self):
         return self.message
 
 
+# noinspection PyUnusedLocal
+# @task
+def get_runner(ctx, host=None):
+    """The context that runs commands for `do`.
+
+    Remote commands run on a connection from the per-process connection pool, see pool.py, so that the SSH transport
+    to each host is reused by every `do` call. A fabric Connection context that is already connected is used as is.
+    Pass the runner to `release_runner` once its command is done.
+
+    Args:
+        ctx: Run context, either an invoke Context or a fabric Connection.
+        host: Host name or `user@host:port` string. Defaults to the host of a fabric Connection context.
+
+    Returns:
+        ctx when running locally, else a pooled fabric Connection.
+
+    """
+    from .pool import pool
+
+    if host and host != getattr(ctx, 'host', None):
+        return pool.get(host, config=ctx.config)
+    elif getattr(ctx, 'host', False):
+        if ctx.is_connected:
+            return ctx
+        return pool.get(ctx.host, user=ctx.user, port=ctx.port, config=ctx.config, connect_kwargs=ctx.connect_kwargs)
+    else:
+        return ctx
+
+
+def release_runner(runner):
+    """Return a runner from `get_runner` to the connection pool, other runners are ignored."""
+    from .pool import pool
+
+    pool.release(runner)
+
+
+def normalize_path(path, host=False):
+    """Absolute path with user and environmental variables expanded.
+
+    Raises:
+        NotADirectoryError: When running locally and the path does not exist.
+
+    """
+    if not path:
+        return path
+
+    if host:
+        ospath = posixpath
+    else:
+        ospath = os.path
+
+    path = ospath.abspath(ospath.expandvars(ospath.expanduser(path)))
+    # Only test if running locally, Python code always execute locally, not on host.
+    if not host and not ospath.isdir(path):
+        raise NotADirectoryError(f'{path}')
+    return path
+
+
 # noinspection PyUnusedLocal
 # @task
 def do(ctx, cmd, dry_run=None, local=False, sudo=False, host=None, **kwargs):
@@ -202,69 +357,104 @@ def do(ctx, cmd, dry_run=None, local=False, sudo=False, host=None, **kwargs):
         dry_run: Override the the env.dry_run variable.
         local: Whether to run locally or not.
         sudo: Whether to run as sudo or not.
-        host:
-        **kwargs: path, host,
+        host: Run on this host instead of the context's host, e.g. 'ubuntu@example.com:2222'
+        **kwargs: path, env and other arguments for `invoke.Context.run`. Streaming arguments, see stream.py:
+            on_line: Called with each line of stdout instead of keeping the whole output in memory.
+            on_chunk: Called with each chunk of stdout as bytes.
+            tail: Number of lines of output kept for the result.
+            stream: Return a CommandStream to iterate over the output lines.
+            ttl: Cache the result of this read-only command for ttl seconds, see cache.py.
 
     Returns:
 
     """
-    # TODO: Optionally load fabric Connection if host is defined
-
     # import pdb; pdb.set_trace()
+    stream_options = {key: kwargs.pop(key) for key in ('on_line', 'on_chunk', 'tail', 'stream') if key in kwargs}
+    ttl = kwargs.pop('ttl', None)
     run_env = kwargs.pop('env', {})
     path = kwargs.pop('path', None)
-    host = getattr(ctx, 'host', False)
+    host = host or getattr(ctx, 'host', False)
 
     if dry_run is None:
         dry_run = env.dry_run
 
-    if host:
-        ospath = posixpath
-    else:
-        ospath = os.path
+    path = normalize_path(path, host)
 
-    if path:
-        path = ospath.abspath(ospath.expandvars(ospath.expanduser(path)))
-        # Only test if running locally, Python code always execute locally, not on host.
-        if not host and not ospath.isdir(path):
-            raise NotADirectoryError(f'{path}')
+    if dry_run and env.plan is not None:
+        from .plan import host_string
 
-    if dry_run:
-        cmd_str = []
-        if run_env:
-            # noinspection PyUnresolvedReferences
-            env_vars = 'export ' + ' '.join(f'{k}={v}' for k, v in run_env.items())
-            cmd_str.append(env_vars)
-        if path:
-            cmd_str.append(f'cd {path}')
-        cmd_str.append(cmd)
-        print(REMOTE_PREFIX if host else LOCAL_PREFIX, ' && '.join(cmd_str))
-        return DryResult(' && '.join(cmd_str))
+        plan_host = host if host and host != getattr(ctx, 'host', None) else host_string(ctx)
+        env.plan.record(cmd, host=plan_host, path=path, run_env=run_env, sudo=sudo, local=local, **kwargs)
 
+    if env.batch is not None and not local and env.batch.accepts(host, dry_run, stream_options, ttl, kwargs):
+        # Queued and executed when the batch context exits, see batch.py
+        return env.batch.add(cmd, path=path, env=run_env, sudo=sudo, **kwargs)
+
+    if dry_run:
+        cmd_str = format_command(cmd, path, run_env)
+        print(REMOTE_PREFIX if host else LOCAL_PREFIX, cmd_str)
+        return DryResult(cmd_str)
+
+    cache_key = None
+    if ttl and not stream_options:
+        from .cache import query_cache
+
+        cache_key = query_cache.key(cmd, host, path, run_env)
+        result = query_cache.get(cache_key)
+        if result is not None:
+            return result
+
+    # Keep the output of concurrent hosts and steps apart, see parallel.py
+    for key, stream in labelled_streams().items():
+        kwargs.setdefault(key, stream)
+
+    if local:
+        # fabric Connections run local commands with `local`, invoke Contexts are always local
+        runner = ctx
+        run = getattr(ctx, 'local', ctx.run)
     else:
-        if not path:
-            if local:
-                return ctx.local(cmd, env=run_env, **kwargs)
-            else:
-                # TODO: env isn't passed on to fabric connection.
-                # Ways to work around this:
-                # 1. use ctx.prefix
-                # 2. Figure out cxn = Connection(..).run()
-                # 3. File bug report for env
-                if sudo:
-                    return ctx.sudo(cmd, env=run_env, **kwargs)
-                else:
-                    return ctx.run(cmd, env=run_env, **kwargs)
+        # TODO: env isn't passed on to fabric connection.
+        # Ways to work around this:
+        # 1. use ctx.prefix
+        # 2. Figure out cxn = Connection(..).run()
+        # 3. File bug report for env
+        runner = get_runner(ctx, host)
+        run = runner.sudo if sudo else runner.run
+
+    trace = ExitStack()
+    trace_args = trace.enter_context(span(cmd if len(cmd) <= 80 else cmd[:77] + '...', 'command', command=cmd,
+                                          host=host or 'local', cwd=path or getattr(runner, 'cwd', '') or os.getcwd(),
+                                          sudo=sudo))
+
+    def finish(result):
+        record_result(trace_args, result)
+        release_runner(runner)
+        trace.close()
 
+    try:
+        if stream_options:
+            from .stream import CommandStream
+
+            command_stream = CommandStream(runner, cmd, path=path, run_env=run_env, sudo=sudo, local=local,
+                                           tail=stream_options.get('tail', 100), hide=kwargs.get('hide'),
+                                           warn=kwargs.get('warn', False),
+                                           on_close=finish if stream_options.get('stream') else None)
+            if stream_options.get('stream'):
+                # The span ends and the connection is released when the stream is read to the end or closed
+                return command_stream
+            result = command_stream.run(stream_options.get('on_line'), stream_options.get('on_chunk'))
+        elif not path:
+            result = run(cmd, env=run_env, **kwargs)
         else:
-            with ctx.cd(path):
-                if local:
-                    return ctx.local(cmd, env=run_env, **kwargs)
-                else:
-                    if sudo:
-                        return ctx.sudo(cmd, env=run_env, **kwargs)
-                    else:
-                        return ctx.run(cmd, env=run_env, **kwargs)
+            with runner.cd(path):
+                result = run(cmd, env=run_env, **kwargs)
+    except BaseException as e:
+        finish(getattr(e, 'result', None))
+        raise
+    finish(result)
+    if cache_key is not None and result.ok:
+        query_cache.set(cache_key, result, ttl)
+    return result
 
 
 @task
@@ -306,4 +496,9 @@ def echo(ctx):
     pprint('ctx')
     pprint(custom_ctx)
 
+    from .cache import query_cache
+    from .pool import pool
+    pprint('stats')
+    pprint({'connection_pool': pool.stats(), 'query_cache': query_cache.stats()})
+
     return custom_envs
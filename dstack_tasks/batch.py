@@ -0,0 +1,205 @@
+import re
+import uuid
+from contextlib import contextmanager
+
+from .base import (LOCAL_PREFIX, REMOTE_PREFIX, DryResult, env, format_command, get_runner, release_runner,
+                   shell_command)
+from .parallel import labelled_streams
+from .trace import record_result, span
+
+
+# `run` arguments a batched command supports besides path, env and sudo
+BATCH_ARGUMENTS = ('warn', 'hide')
+
+
+class BatchResult(object):
+    """Placeholder returned by `do` for a queued command.
+
+    Behaves like the `invoke.runners.Result` of the command once the batch has run.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.result = None
+
+    def __getattr__(self, item):
+        result = self.__dict__.get('result')
+        if result is None:
+            raise RuntimeError(f'Batched command has not been executed: {self.command}')
+        return getattr(result, item)
+
+
+class Batch(object):
+    """Queue of commands that are sent to the shell as one script.
+
+    Each command keeps its own `path`, `env` and `sudo` settings and is run in a subshell. Markers around each
+    command's output are used to split stdout and exit codes back into individual results. The script stops at the
+    first failing command unless that command was queued with `warn=True`.
+
+    A batch belongs to the thread that opened it and to the host of its context, commands for another host and
+    commands that need a live process (streamed output, cached results or other `run` arguments) are run right away.
+
+    Note:
+        Batched `sudo` commands use non-interactive sudo, so they require passwordless sudo on the host.
+
+    """
+
+    def __init__(self, ctx, dry_run=False):
+        self.ctx = ctx
+        self.dry_run = dry_run
+        self.host = getattr(ctx, 'host', False)
+        self.commands = []
+        self.token = uuid.uuid4().hex[:12]
+
+    def __len__(self):
+        return len(self.commands)
+
+    def accepts(self, host, dry_run, stream_options=None, ttl=None, kwargs=None):
+        """Whether a `do` call can be queued in this batch.
+
+        Args:
+            host: The host the command runs on, False when local.
+            dry_run: The dry run mode of the call.
+            stream_options: Streaming arguments of the call, see stream.py.
+            ttl: Cache ttl of the call, see cache.py.
+            kwargs: Remaining `run` arguments.
+
+        """
+        return (dry_run == self.dry_run and (host or False) == (self.host or False) and not stream_options and
+                not ttl and set(kwargs or ()) <= set(BATCH_ARGUMENTS))
+
+    def add(self, cmd, path=None, env=None, sudo=False, warn=False, hide=None, **kwargs):
+        """Queue a command.
+
+        Args:
+            cmd: The command to execute, e.g. 'ls'
+            path: Directory to run the command in.
+            env: Environmental variables for the command.
+            sudo: Whether to run as sudo or not.
+            warn: Whether to continue with the rest of the batch if the command fails.
+            hide: Whether to hide the command's stdout.
+            **kwargs: Other `run` arguments are not supported in a batch, see `accepts`.
+
+        Returns:
+            DryResult in dry run mode, else a BatchResult that is filled in when the batch runs.
+
+        """
+        item = dict(cmd=cmd, path=path, env=env or {}, sudo=sudo, warn=warn, hide=hide)
+        if self.dry_run:
+            item['result'] = DryResult(format_command(cmd, path, env))
+        else:
+            item['result'] = BatchResult(cmd)
+        self.commands.append(item)
+        return item['result']
+
+    def _marker(self, kind, index, suffix=''):
+        return f'__DSTACK_BATCH_{self.token}_{kind}_{index}{suffix}__'
+
+    def script(self):
+        """The shell script that runs all queued commands."""
+        lines = []
+        for i, item in enumerate(self.commands):
+            inner = shell_command(item['cmd'], item['path'], item['env'], item['sudo'])
+
+            lines.append(f"printf '\\n{self._marker('BEGIN', i)}\\n'")
+            lines.append(f'( {inner} )')
+            lines.append('rc=$?')
+            lines.append(f"printf '\\n{self._marker('END', i, '_%d')}\\n' \"$rc\"")
+            if not item['warn']:
+                lines.append('[ "$rc" -eq 0 ] || exit "$rc"')
+        return '\n'.join(lines)
+
+    def parse(self, stdout):
+        """Split the combined stdout of the script into (stdout, exit code) per executed command."""
+        outputs = {}
+        token = re.escape(self.token)
+        pattern = re.compile(
+            rf'__DSTACK_BATCH_{token}_BEGIN_(\d+)__\n(.*?)\n__DSTACK_BATCH_{token}_END_\1_(\d+)__\n', re.S)
+        for match in pattern.finditer(stdout):
+            outputs[int(match.group(1))] = (match.group(2), int(match.group(3)))
+        return outputs
+
+    def flush(self):
+        """Run (or in dry run mode print) the queued commands as one script."""
+        commands, self.commands = self.commands, []
+        if not commands:
+            return
+
+        prefix = REMOTE_PREFIX if self.host else LOCAL_PREFIX
+        if self.dry_run:
+            print(prefix, f'batch of {len(commands)} commands:')
+            for i, item in enumerate(commands, start=1):
+                print(prefix, f'  {i}. {item["result"].stdout}')
+            return
+
+        from invoke.exceptions import UnexpectedExit
+        from invoke.runners import Result
+
+        self.commands = commands
+        script = self.script()
+        self.commands = []
+
+        hide_all = all(item['hide'] for item in commands)
+        with span(f'batch of {len(commands)} commands', 'command', commands=[item['cmd'] for item in commands],
+                  host=self.host or 'local') as trace_args:
+            runner = get_runner(self.ctx)
+            try:
+                combined = runner.run(script, hide='both' if hide_all else 'out', warn=True, **labelled_streams())
+            finally:
+                release_runner(runner)
+            record_result(trace_args, combined)
+        outputs = self.parse(combined.stdout)
+
+        failed = None
+        for i, item in enumerate(commands):
+            if i not in outputs:
+                # Not executed, a previous command failed
+                break
+            stdout, exited = outputs[i]
+            if stdout and not item['hide']:
+                print(stdout, end='')
+            result = Result(stdout=stdout, command=item['cmd'], exited=exited,
+                            hide=('stdout', 'stderr') if item['hide'] else ())
+            item['result'].result = result
+            if exited != 0 and not item['warn']:
+                failed = result
+                break
+
+        if failed is not None:
+            raise UnexpectedExit(failed)
+        if combined.exited != 0 and len(outputs) < len(commands):
+            # The shell itself failed, e.g. a syntax error in one of the commands
+            raise UnexpectedExit(combined)
+
+
+@contextmanager
+def batch(ctx, dry_run=None):
+    """Collect `do` calls and run them as a single shell script when the context exits.
+
+    Commands run with `local=True` are not batched. Nested batches are merged into the outer batch. If the body of
+    the context raises, the queued commands are discarded. The batch is only seen by the current thread, so tasks
+    running concurrently on other hosts (see parallel.py and dag.py) are not affected.
+
+    Args:
+        ctx: Run context.
+        dry_run: Override the env.dry_run variable.
+
+    Examples:
+        with batch(ctx):
+            do(ctx, 'sed -i.bak "s/^VERSION=.*/VERSION=1.0.0/g" .env')
+            do(ctx, 'tar -zxf static.tar.gz -C static/', path='.local/')
+
+    """
+    if env.batch is not None:
+        yield env.batch
+        return
+
+    current = Batch(ctx, dry_run=env.dry_run if dry_run is None else dry_run)
+    env.batch = current
+    try:
+        yield current
+    except BaseException:
+        env.batch = None
+        raise
+    env.batch = None
+    current.flush()
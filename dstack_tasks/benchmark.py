@@ -0,0 +1,221 @@
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+from invoke import task
+
+from .base import env
+from .catalog import BackupCatalog
+from .plan import unreplayable
+from .ready import backoff
+from .sql import Session
+from .trace import tracer
+
+# Backup modes of `tasks.db_backup` and the arguments that select them
+MODES = {
+    'custom': {},
+    'stream': {'stream': True, 'compression': 'gzip'},
+    'parallel': {'parallel': True},
+    'dedup': {'dedup': True},
+}
+# Modes where the dump is uploaded while it is produced, so dump and upload time are the same
+OVERLAPPED = ('stream', 'dedup')
+
+REPORT_DIR = os.path.join('.local', 'benchmarks')
+
+
+def scalar(ctx, sql, service='postgres'):
+    """First column of the first row of a query, as text. None in dry run mode."""
+    with Session(ctx, service) as session:
+        query = session.query(sql)
+    return query.scalar()
+
+
+def seed(ctx, size_mb, service='postgres'):
+    """(Re)create the `bench_seed` table with about size_mb of incompressible rows.
+
+    Returns:
+        Number of rows.
+
+    """
+    # A row holds 16 md5 hex digests, about 560 bytes on disk
+    rows = max(1, int(size_mb * 1024 * 1024 / 560))
+    with Session(ctx, service, single_transaction=True) as session:
+        session.execute('DROP TABLE IF EXISTS bench_seed')
+        session.execute(f"CREATE TABLE bench_seed AS SELECT g AS id, "
+                        f"(SELECT string_agg(md5(random()::text || g), '') FROM generate_series(1, 16)) AS payload "
+                        f"FROM generate_series(1, {int(rows)}) g")
+    return rows
+
+
+def wait_healthy(ctx, replica, tag, timeout=120, service_standby='postgres-replica'):
+    """Seconds until the restored database answers queries and, with a replica, until the standby has a marker row.
+
+    Returns:
+        Seconds, or None on timeout or in dry run mode.
+
+    """
+    if env.dry_run:
+        return None
+    from invoke.exceptions import UnexpectedExit
+
+    start = time.perf_counter()
+    scalar(ctx, f"INSERT INTO backup_log (tag) VALUES ('{tag}_healthy');")
+    for _ in backoff(timeout):
+        try:
+            service = service_standby if replica else 'postgres'
+            if scalar(ctx, f"SELECT count(*) FROM backup_log WHERE tag = '{tag}_healthy';", service) == '1':
+                return round(time.perf_counter() - start, 3)
+        except UnexpectedExit:
+            pass
+    return None
+
+
+def _phase_seconds(events, start):
+    # Time spent in uploads since trace event index start, from the s3cmd and aws cli spans
+    seconds = 0.0
+    for event in events[start:]:
+        command = str(event['args'].get('command', ''))
+        if event['name'] == 's3cmd' or (event['cat'] == 'command' and command.startswith('aws ')):
+            seconds += event['dur'] / 1e6
+    return seconds
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def _mb_per_second(size, seconds):
+    return round(size / 1024 / 1024 / seconds, 2) if size and seconds else None
+
+
+def run_mode(ctx, mode, project, data_dir, seeded_rows, replica, interval):
+    """Backup and restore with one mode and measure it."""
+    from .tasks import db, db_backup
+
+    result = {'mode': mode}
+    marker = f'bench_{mode}_{int(time.time())}'
+    start_event = len(tracer.events)
+    start = time.perf_counter()
+    db_backup(ctx, tag=marker, project=project, data_dir=data_dir, **MODES[mode])
+    backup_seconds = time.perf_counter() - start
+    upload_seconds = _phase_seconds(tracer.events, start_event)
+
+    backup = None if env.dry_run else BackupCatalog().latest(project)
+    size = backup and backup['size']
+    if mode == 'parallel' and not env.dry_run:
+        size = _directory_size(os.path.join(data_dir, 'backups', f"backup_{backup['tag']}.dir"))
+    if mode in OVERLAPPED:
+        dump_seconds = upload_seconds = backup_seconds
+    else:
+        dump_seconds = backup_seconds - upload_seconds
+    result.update({
+        'tag': backup and backup['tag'],
+        'format': backup and backup['format'],
+        'backup_bytes': size,
+        'backup_seconds': round(backup_seconds, 3),
+        'dump_seconds': round(dump_seconds, 3),
+        'upload_seconds': round(upload_seconds, 3),
+        'dump_mb_per_second': _mb_per_second(size, dump_seconds),
+        'upload_mb_per_second': _mb_per_second(size, upload_seconds),
+    })
+
+    # Written after the backup, so it must be gone after the restore
+    scalar(ctx, f"INSERT INTO backup_log (tag) VALUES ('{marker}_lost');")
+    start = time.perf_counter()
+    db(ctx, 'restore', tag=backup['tag'] if backup else marker, project=project, data_dir=data_dir, replica=replica,
+       parallel=mode == 'parallel', dedup=mode == 'dedup')
+    restore_seconds = time.perf_counter() - start
+    healthy_seconds = wait_healthy(ctx, replica, marker)
+
+    with Session(ctx) as session:
+        rows = session.query('SELECT count(*) FROM bench_seed')
+        lost = session.query(f"SELECT count(*) FROM backup_log WHERE tag = '{marker}_lost'")
+    rows, lost = rows.scalar(), lost.scalar()
+    result.update({
+        'restore_seconds': round(restore_seconds, 3),
+        'healthy_seconds': healthy_seconds,
+        'rto_seconds': round(restore_seconds + (healthy_seconds or 0), 3),
+        # Worst case data loss with a backup every interval: a full interval plus the time the backup takes
+        'rpo_seconds': round(interval + backup_seconds, 3),
+        'verified': None if env.dry_run else rows == str(seeded_rows) and lost == '0',
+    })
+    return result
+
+
+def markdown(report):
+    """The report as a Markdown table."""
+    lines = [
+        f"# Backup benchmark {report['version'] or ''}".rstrip(),
+        '',
+        f"{report['created']}, {report['size_mb']} MB seeded ({report['database_bytes']} bytes database), "
+        f"replica: {report['replica']}",
+        '',
+        '| mode | backup s | dump MB/s | upload MB/s | restore s | healthy s | RTO s | RPO s | verified |',
+        '|---|---|---|---|---|---|---|---|---|',
+    ]
+    for r in report['modes']:
+        values = [r['mode'], r['backup_seconds'], r['dump_mb_per_second'], r['upload_mb_per_second'],
+                  r['restore_seconds'], r['healthy_seconds'], r['rto_seconds'], r['rpo_seconds'], r['verified']]
+        lines.append('| ' + ' | '.join('-' if value is None else str(value) for value in values) + ' |')
+    return '\n'.join(lines) + '\n'
+
+
+@task
+def benchmark_backup(ctx, size_mb=100, modes='custom,stream,parallel,dedup', replica=False, interval=86400,
+                     project=None, data_dir=None, output=None):
+    """Seed a database, then backup and restore it with each backup mode and report the recovery times.
+
+    Runs without prompts against the compose stack, e.g. a local postgres container with ENDPOINT_URL pointing to
+    MinIO. Every mode is verified by checking the seeded rows and that a row written after the backup is gone.
+
+    Args:
+        ctx: Run context.
+        size_mb: Default = 100. Approximate size of the seeded table.
+        modes: Comma separated backup modes, see `MODES`.
+        replica: Whether to wait for the standby to replay the restore.
+        interval: Default = 86400. Seconds between scheduled backups, used for the RPO.
+        project: Default is the project name.
+        data_dir: Default is LOCAL_DIR next to the COMPOSE_FILE.
+        output: Report path without extension, default is `.local/benchmarks/backup-<timestamp>`.
+
+    Returns:
+        The report dictionary, also written as JSON and Markdown.
+
+    """
+    project = project or ctx['project_name']
+    if data_dir is None:
+        data_dir = os.path.abspath(os.path.join(os.path.dirname(os.getenv('COMPOSE_FILE')), os.getenv('LOCAL_DIR')))
+    created = datetime.now(timezone.utc).replace(microsecond=0)
+    try:
+        version = env.version
+    except Exception:
+        version = None
+
+    seeded_rows = seed(ctx, float(size_mb))
+    report = {
+        'version': version,
+        'created': created.isoformat(),
+        'size_mb': float(size_mb),
+        'rows': seeded_rows,
+        'database_bytes': scalar(ctx, "SELECT pg_database_size('postgres');"),
+        'replica': replica,
+        'interval_seconds': int(interval),
+        'modes': [run_mode(ctx, mode, project, data_dir, seeded_rows, replica, int(interval))
+                  for mode in modes.split(',')],
+    }
+    if env.dry_run:
+        unreplayable('benchmark report')
+        return report
+
+    output = output or os.path.join(REPORT_DIR, f"backup-{created.strftime('%Y%m%dT%H%M%SZ')}")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    with open(output + '.md', 'w') as f:
+        f.write(markdown(report))
+    print(markdown(report))
+    print(f'Report written to {output}.json and {output}.md')
+    return report
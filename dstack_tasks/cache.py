@@ -0,0 +1,92 @@
+import threading
+import time
+
+# Sub-commands that only inspect state, anything else invalidates the cached queries for the host
+READ_ONLY = {
+    'docker': {'ps', 'inspect', 'images', 'logs', 'version', 'info', 'stats', 'top', 'port', 'history'},
+    'docker-compose': {'ps', 'config', 'images', 'logs', 'port', 'top', 'version'},
+    'docker-machine': {'ip', 'status', 'inspect', 'ls', 'config', 'env', 'url', 'version', 'active'},
+}
+
+
+class QueryCache(object):
+    """Time-to-live cache for the results of idempotent, read-only commands.
+
+    Results are keyed on host, path, environment and command. Use `do(ctx, cmd, ttl=30)` to cache a command for 30
+    seconds. The wrappers invalidate all cached queries for a host after a command that changes state, e.g.
+    `compose up` or `machine restart`.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(cmd, host=None, path=None, run_env=None):
+        return host or 'local', path, tuple(sorted((run_env or {}).items())), cmd
+
+    def get(self, key):
+        """Cached result for key, or None if there is no fresh result."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def set(self, key, result, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + float(ttl), result)
+
+    def invalidate(self, host=None):
+        """Drop cached results for host, or for all hosts if host is None.
+
+        Returns:
+            Number of results dropped.
+
+        """
+        with self._lock:
+            keys = [key for key in self._entries if host is None or key[0] == (host or 'local')]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += 1
+            return len(keys)
+
+    def invalidate_after(self, tool, cmd, host=None):
+        """Invalidate host's cached results unless cmd is a read-only sub-command of tool.
+
+        Args:
+            tool: 'docker', 'docker-compose' or 'docker-machine'
+            cmd: The arguments passed to tool, e.g. '-p project up -d django'
+            host: The host the command runs on, None for local commands. Unlike `invalidate`, None does not drop the
+                results of other hosts.
+
+        """
+        words = [word for word in cmd.split() if not word.startswith('-')]
+        if tool == 'docker-compose' and cmd.split()[:1] == ['-p']:
+            # Skip the project name of `-p <project>`
+            words = words[1:]
+        if not words or words[0] not in READ_ONLY.get(tool, ()):
+            self.invalidate(host or 'local')
+
+    def stats(self):
+        """Hit/miss counters.
+
+        Returns:
+            Dictionary with hits, misses, invalidations and number of cached results.
+
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'size': len(self._entries),
+        }
+
+
+query_cache = QueryCache()
@@ -0,0 +1,313 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from invoke import task
+
+from .base import env
+from .plan import unreplayable
+
+CATALOG_PATH = os.path.join('.local', 'backups.sqlite')
+# Seconds after which `latest` and `before` lookups rebuild the catalog, backups made on other hosts are only seen
+# through a rebuild
+CATALOG_TTL = int(os.getenv('CATALOG_TTL', 3600))
+
+# Object layouts of the backup modes in tasks.py, the tag is everything between prefix and suffix
+LAYOUTS = [
+    ('directory', re.compile(r'backups/backup_(?P<tag>.+)\.dir/')),
+    ('custom.gz', re.compile(r'backups/backup_(?P<tag>.+)\.pg_dump\.gz$')),
+    ('custom', re.compile(r'backups/backup_(?P<tag>.+)\.pg_dump$')),
+    ('pgdata', re.compile(r'backups/db_backup\.(?P<tag>.+)\.tar\.gz$')),
+    ('dedup', re.compile(r'dedup/manifests/(?P<tag>.+)\.json$')),
+]
+CHECKSUM_SUFFIX = '.sha256'
+
+
+def tag_time(tag):
+    """Creation time of a backup from a tag made by `tasks.now_tag`, e.g. '2024-01-31T02-00-00Z_nightly'
+
+    Returns:
+        ISO 8601 UTC timestamp or None when the tag does not start with a timestamp.
+
+    """
+    try:
+        created = datetime.strptime(tag[:20], '%Y-%m-%dT%H-%M-%SZ')
+    except ValueError:
+        return None
+    return created.replace(tzinfo=timezone.utc).isoformat()
+
+
+def parse_date(value):
+    """ISO 8601 UTC timestamp for a date or date and time, e.g. '2024-01-31' or '2024-01-31T12:00'"""
+    value = value.replace(' ', 'T').rstrip('Z')
+    created = datetime.fromisoformat(value)
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    return created.astimezone(timezone.utc).isoformat()
+
+
+class BackupCatalog(object):
+    """Local SQLite index of the backups in S3, so restores don't need a tag typed in or a bucket listing.
+
+    Backups are added when they are made, `rebuild` recreates the index from the bucket.
+
+    Args:
+        path: Default is `.local/backups.sqlite`.
+
+    """
+
+    def __init__(self, path=CATALOG_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS backups (project TEXT, tag TEXT, created TEXT, size INTEGER, '
+                             'checksum TEXT, format TEXT, bucket TEXT, key TEXT, PRIMARY KEY (project, tag, format))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS backups_created ON backups (project, created)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS rebuilds (project TEXT PRIMARY KEY, rebuilt REAL)')
+
+    def add(self, project, tag, format, bucket, key, size=None, checksum=None, created=None):
+        """Add or update a backup."""
+        created = created or tag_time(tag) or datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (project, tag, created, size, checksum, format, bucket, key))
+
+    def _query(self, where, params, order='created DESC', limit=None):
+        sql = f'SELECT * FROM backups WHERE {where} ORDER BY {order}'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql, params)]
+
+    def list(self, project, format=None, limit=None):
+        """Backups of a project, newest first."""
+        if format:
+            return self._query('project = ? AND format = ?', (project, format), limit=limit)
+        return self._query('project = ?', (project,), limit=limit)
+
+    def get(self, project, tag):
+        """The backup with a tag, or None."""
+        rows = self._query('project = ? AND tag = ?', (project, tag), limit=1)
+        return rows[0] if rows else None
+
+    def latest(self, project, format=None):
+        """The newest backup, or None."""
+        rows = self.list(project, format, limit=1)
+        return rows[0] if rows else None
+
+    def before(self, project, date, format=None):
+        """The newest backup made before date, or None.
+
+        Args:
+            date: ISO 8601 date or date and time, UTC unless it has an offset.
+
+        """
+        where, params = 'project = ? AND created < ?', [project, parse_date(date)]
+        if format:
+            where, params = where + ' AND format = ?', params + [format]
+        rows = self._query(where, params, limit=1)
+        return rows[0] if rows else None
+
+    def by_size(self, project, min_size=None, max_size=None, limit=None):
+        """Backups within a size range, largest first."""
+        where, params = 'project = ? AND size IS NOT NULL', [project]
+        if min_size is not None:
+            where, params = where + ' AND size >= ?', params + [int(min_size)]
+        if max_size is not None:
+            where, params = where + ' AND size <= ?', params + [int(max_size)]
+        return self._query(where, params, order='size DESC', limit=limit)
+
+    def count(self, project):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM backups WHERE project = ?', (project,)).fetchone()[0]
+
+    def rebuilt(self, project):
+        """Unix time of the last `rebuild` of a project, or None."""
+        with self._lock:
+            row = self._db.execute('SELECT rebuilt FROM rebuilds WHERE project = ?', (project,)).fetchone()
+        return row[0] if row else None
+
+    def expired(self, project, ttl=None):
+        """Whether the project was never rebuilt or not within ttl seconds, default is CATALOG_TTL."""
+        rebuilt = self.rebuilt(project)
+        return rebuilt is None or time.time() - rebuilt > (CATALOG_TTL if ttl is None else ttl)
+
+    def rebuild(self, project, locations, client=None, workers=None):
+        """Replace a project's entries with the backups found in S3.
+
+        Args:
+            project: The project name.
+            locations: List of (bucket, prefix) tuples to scan, e.g. [('dstack-storage', 'project/')]
+            client: Defaults to the shared s3 client.
+            workers: Number of concurrent listing and checksum requests.
+
+        Returns:
+            Number of backups found.
+
+        """
+        from .s3 import MAX_CONCURRENCY, get_client, list_objects_parallel
+
+        client = client or get_client()
+        workers = workers or MAX_CONCURRENCY
+        entries = {}
+        checksums = {}
+        for bucket, prefix in locations:
+            objects = {}
+            for sub_prefix in ('backups/', 'dedup/manifests/'):
+                objects.update(list_objects_parallel(bucket, prefix.rstrip('/') + '/' + sub_prefix, client,
+                                                     workers=workers))
+            for key, item in objects.items():
+                if key.endswith(CHECKSUM_SUFFIX):
+                    checksums[(bucket, key[:-len(CHECKSUM_SUFFIX)])] = key
+                    continue
+                for format, pattern in LAYOUTS:
+                    match = pattern.search(key)
+                    if match is None:
+                        continue
+                    tag = match.group('tag')
+                    if format == 'directory':
+                        key = key[:match.end()]
+                    entry = entries.setdefault((tag, format), {
+                        'tag': tag, 'format': format, 'bucket': bucket, 'key': key, 'size': 0, 'checksum': None,
+                        'created': tag_time(tag) or item['LastModified'].astimezone(timezone.utc).isoformat()})
+                    entry['size'] += item['Size']
+                    break
+
+        def read(bucket, key):
+            return client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+
+        def complete(entry):
+            if entry['format'] == 'dedup':
+                manifest = json.loads(read(entry['bucket'], entry['key']))
+                entry['size'], entry['checksum'] = manifest.get('size'), manifest.get('sha256')
+            elif (entry['bucket'], entry['key']) in checksums:
+                entry['checksum'] = read(entry['bucket'], checksums[(entry['bucket'], entry['key'])]).split()[0]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(complete, entries.values()))
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM backups WHERE project = ?', (project,))
+            self._db.executemany('INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+                (project, e['tag'], e['created'], e['size'], e['checksum'], e['format'], e['bucket'], e['key'])
+                for e in entries.values()])
+            self._db.execute('INSERT OR REPLACE INTO rebuilds VALUES (?, ?)', (project, time.time()))
+        return len(entries)
+
+    def close(self):
+        self._db.close()
+
+
+def backup_locations(ctx, project):
+    """Buckets and prefixes the backup modes write to, see tasks.py."""
+    locations = [('dstack-storage', project), (ctx.get('bucket_name') or 'dstack-storage', project)]
+    if ctx.get('s3_project_prefix'):
+        locations.append((ctx.get('bucket_name') or 'dstack-storage', ctx['s3_project_prefix']))
+    return list(dict.fromkeys(locations))
+
+
+def record_backup(ctx, project, tag, format, bucket, key, size=None, checksum=None):
+    """Add a backup to the local catalog, nothing is recorded in dry run mode."""
+    if env.dry_run:
+        unreplayable(f'record backup {tag} in the catalog')
+        return
+    BackupCatalog().add(project, tag, format, bucket, key, size=size, checksum=checksum)
+
+
+def find_backup(ctx, project, tag=None, before=None):
+    """Look up a backup in the catalog, rebuilding it from S3 when needed.
+
+    The newest backup is looked up in a catalog that was rebuilt within CATALOG_TTL seconds, and a tag that is not
+    in the catalog is looked up again after a rebuild, so backups made on other hosts are found.
+
+    Args:
+        ctx: Run context.
+        project: The project name.
+        tag: A tag, or None or 'latest' for the newest backup.
+        before: Only backups made before this ISO 8601 date.
+
+    Returns:
+        Dictionary of the catalog columns, or None if the backup is not in the catalog.
+
+    """
+    backups = BackupCatalog()
+    if env.dry_run:
+        unreplayable(f'look up backup {tag or "latest"} in the catalog')
+
+    def lookup():
+        if before:
+            return backups.before(project, before)
+        if tag in (None, 'latest'):
+            return backups.latest(project)
+        return backups.get(project, tag)
+
+    rebuilt = False
+    if not env.dry_run and (before or tag in (None, 'latest')) and backups.expired(project):
+        backups.rebuild(project, backup_locations(ctx, project))
+        rebuilt = True
+    backup = lookup()
+    if backup is None and not rebuilt and not env.dry_run:
+        backups.rebuild(project, backup_locations(ctx, project))
+        backup = lookup()
+    return backup
+
+
+def _size(size):
+    if size is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size:.0f}{unit}'
+        size /= 1024
+    return f'{size:.1f}TB'
+
+
+@task
+def catalog(ctx, cmd='list', project=None, before=None, min_size=None, max_size=None, limit=20):
+    """Query the local backup catalog.
+
+    Args:
+        ctx: Run context.
+        cmd: `list`, `latest`, `before`, `size` or `rebuild`.
+        project: Default is the project name.
+        before: ISO 8601 date for `before`.
+        min_size: Minimum size in bytes for `size`.
+        max_size: Maximum size in bytes for `size`.
+        limit: Maximum number of backups to list.
+
+    Examples:
+        dstack e catalog latest
+        dstack e catalog before --before 2024-01-31
+        dstack e catalog size --min-size 1000000000
+
+    """
+    project = project or ctx['project_name']
+    backups = BackupCatalog()
+    if cmd == 'rebuild' or (backups.expired(project) and not env.dry_run):
+        print(f'Found {backups.rebuild(project, backup_locations(ctx, project))} backups')
+        if cmd == 'rebuild':
+            return
+
+    if cmd == 'list':
+        rows = backups.list(project, limit=limit)
+    elif cmd == 'latest':
+        rows = [backups.latest(project)]
+    elif cmd == 'before':
+        rows = [backups.before(project, before)]
+    elif cmd == 'size':
+        rows = backups.by_size(project, min_size, max_size, limit=limit)
+    else:
+        raise ValueError(f'Unknown catalog command: {cmd}')
+
+    for row in filter(None, rows):
+        print(f"{row['created']}  {row['tag']:<40}  {row['format']:<9}  {_size(row['size']):>8}  "
+              f"s3://{row['bucket']}/{row['key']}")
+    return rows
@@ -0,0 +1,376 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Chunk sizes of the content-defined chunking, the average is a power of two
+MIN_CHUNK = int(os.getenv('CHUNK_MIN_SIZE', 256 * 1024))
+AVG_CHUNK = int(os.getenv('CHUNK_AVG_SIZE', 1024 * 1024))
+MAX_CHUNK = int(os.getenv('CHUNK_MAX_SIZE', 4 * 1024 * 1024))
+CHUNK_WORKERS = int(os.getenv('CHUNK_WORKERS', 8))
+# Seconds for which a rebuilt local index is trusted, after that a backup lists the chunks in the bucket again so
+# chunks removed by lifecycle rules or a cleanup are uploaded again
+INDEX_TTL = int(os.getenv('CHUNK_INDEX_TTL', 3600))
+
+INDEX_PATH = os.path.join('.local', 'chunks.sqlite')
+
+
+# FastCDC gear hash (Xia et al., "FastCDC: a Fast and Efficient Content-Defined Chunking Approach", USENIX ATC 2016):
+# h = (h << 1) + GEAR[byte] over 64 bits, so the hash only depends on the last WINDOW bytes. The table is derived from
+# sha256 so chunk boundaries are stable across runs and versions.
+GEAR = tuple(int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'little') for i in range(256))
+HASH_MASK = (1 << 64) - 1
+WINDOW = 64
+# Hashes are computed in blocks with numpy, when it is installed
+HASH_BLOCK = 256 * 1024
+
+
+def _spread_mask(ones):
+    # Mask bits spread over the upper 48 bits of the hash like FastCDC's masks, so a cut depends on the whole window
+    ones = max(1, min(ones, 48))
+    mask = 0
+    for k in range(ones):
+        mask |= 1 << (63 - k * 48 // ones)
+    return mask
+
+
+def _masks(avg_size):
+    # Normalized chunking: a harder mask before the average size and an easier one after it keeps sizes close to it
+    bits = max(1, avg_size.bit_length() - 1)
+    return _spread_mask(bits + 2), _spread_mask(bits - 2)
+
+
+def _gear_hashes(data, context=b''):
+    """Gear hash at every offset of data as a numpy uint64 array, or None when numpy is not installed.
+
+    The hash of an offset covers the WINDOW bytes up to it, context is the data before data's first byte. Each of
+    the log2(WINDOW) steps adds the hashes of the preceding half window shifted into place.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        return None
+
+    table = np.array(GEAR, dtype=np.uint64)
+    hashes = table[np.frombuffer(bytes(context) + bytes(data), dtype=np.uint8)]
+    shift = 1
+    while shift < WINDOW:
+        hashes[shift:] += hashes[:-shift] << np.uint64(shift)
+        shift *= 2
+    return hashes[len(context):]
+
+
+def _find_cut(data, low, high, mask):
+    # End offset of the first byte in data[low:high] whose hash matches mask, or None. Needs WINDOW bytes before low.
+    for block in range(low, high, HASH_BLOCK):
+        block_end = min(block + HASH_BLOCK, high)
+        hashes = _gear_hashes(data[block:block_end], data[block - WINDOW + 1:block])
+        if hashes is None:
+            break
+        found = ((hashes & hashes.dtype.type(mask)) == 0).nonzero()[0]
+        if len(found):
+            return block + int(found[0]) + 1
+    else:
+        return None
+
+    # Without numpy
+    gear = GEAR
+    h = 0
+    for i in range(low - WINDOW + 1, low):
+        h = ((h << 1) + gear[data[i]]) & HASH_MASK
+    for i in range(low, high):
+        h = ((h << 1) + gear[data[i]]) & HASH_MASK
+        if not h & mask:
+            return i + 1
+    return None
+
+
+def _next_boundary(data, start, min_size, avg_size, max_size):
+    # End offset of the chunk of data that starts at start
+    end = min(start + max_size, len(data))
+    first = start + min_size
+    if first >= end:
+        return end
+    normal = max(first, min(start + avg_size, end))
+    mask_small, mask_large = _masks(avg_size)
+    return _find_cut(data, first, normal, mask_small) or _find_cut(data, normal, end, mask_large) or end
+
+
+def _check_sizes(min_size, avg_size, max_size):
+    if not WINDOW <= min_size <= avg_size <= max_size:
+        raise ValueError(f'Chunk sizes must satisfy {WINDOW} <= min_size <= avg_size <= max_size')
+
+
+def chunk_boundaries(data, min_size=MIN_CHUNK, avg_size=AVG_CHUNK, max_size=MAX_CHUNK):
+    """Yield the end offsets of content-defined chunks in data.
+
+    Boundaries are FastCDC cut points: the first offset after min_size where the gear hash of the preceding WINDOW
+    bytes matches a mask. They only depend on the bytes just before them, so inserting or removing data only changes
+    the chunks around the edit and the rest deduplicate against earlier backups. The gear hash spreads any byte
+    distribution, e.g. SQL text, over the hash bits, so chunk sizes stay close to avg_size. The bytes before
+    min_size are skipped, numpy computes the hashes when it is installed. The last offset is always len(data).
+    """
+    _check_sizes(min_size, avg_size, max_size)
+    start = 0
+    while start < len(data):
+        start = _next_boundary(data, start, min_size, avg_size, max_size)
+        yield start
+
+
+def chunk_stream(chunks, min_size=MIN_CHUNK, avg_size=AVG_CHUNK, max_size=MAX_CHUNK):
+    """Re-chunk an iterable of bytes into content-defined chunks, buffering at most max_size bytes plus one input chunk.
+
+    A chunk is only cut once max_size bytes are buffered, so every byte is hashed at most once.
+    """
+    _check_sizes(min_size, avg_size, max_size)
+    buffer = bytearray()
+    start = 0
+    for data in chunks:
+        buffer += data
+        while len(buffer) - start >= max_size:
+            end = _next_boundary(buffer, start, min_size, avg_size, max_size)
+            yield bytes(buffer[start:end])
+            start = end
+        del buffer[:start]
+        start = 0
+    while start < len(buffer):
+        end = _next_boundary(buffer, start, min_size, avg_size, max_size)
+        yield bytes(buffer[start:end])
+        start = end
+
+
+class ChunkIndex(object):
+    """Local SQLite index of the chunks that are known to be in the store.
+
+    Args:
+        path: Default is `.local/chunks.sqlite`.
+
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS chunks '
+                             '(prefix TEXT, hash TEXT, size INTEGER, stored_size INTEGER, PRIMARY KEY (prefix, hash))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS refreshes (prefix TEXT PRIMARY KEY, refreshed REAL)')
+
+    def __contains__(self, item):
+        prefix, digest = item
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM chunks WHERE prefix = ? AND hash = ?',
+                                    (prefix, digest)).fetchone() is not None
+
+    def add(self, prefix, digest, size, stored_size):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)', (prefix, digest, size, stored_size))
+
+    def count(self, prefix):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM chunks WHERE prefix = ?', (prefix,)).fetchone()[0]
+
+    def clear(self, prefix):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM chunks WHERE prefix = ?', (prefix,))
+
+    def refreshed(self, prefix):
+        """Unix time at which the chunks of prefix were last listed from the bucket, or None."""
+        with self._lock:
+            row = self._db.execute('SELECT refreshed FROM refreshes WHERE prefix = ?', (prefix,)).fetchone()
+        return row[0] if row else None
+
+    def set_refreshed(self, prefix, when=None):
+        when = time.time() if when is None else when
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO refreshes VALUES (?, ?)', (prefix, when))
+
+    def close(self):
+        self._db.close()
+
+
+class ChunkStore(object):
+    """Deduplicated backup store on S3.
+
+    Backups are split into content-defined chunks, see `chunk_stream`. Each chunk is stored once, zlib compressed,
+    as `{prefix}/chunks/{hash[:2]}/{hash}` and every backup gets a manifest `{prefix}/manifests/{tag}.json` listing
+    its chunks. Only chunks that are not in the local index yet are uploaded, so a nightly backup that barely changed
+    uploads little more than its manifest. Before a backup the index is rebuilt with one (parallel) listing of the
+    chunks in the bucket, unless it was rebuilt within `index_ttl`, so a manifest does not refer to chunks that were
+    removed from the bucket.
+
+    Dumps should not be compressed by the producer, e.g. `pg_dump -Z 0` or `tar` without `-z`, otherwise small
+    changes alter most of the bytes and nothing deduplicates.
+
+    Args:
+        bucket: The S3 bucket.
+        prefix: Key prefix of the store, e.g. '{project}/dedup'
+        client: Defaults to the shared s3 client.
+        index: Defaults to a ChunkIndex in `.local/chunks.sqlite`.
+        workers: Default is CHUNK_WORKERS or 8. Number of concurrent chunk uploads and downloads.
+        index_ttl: Default is CHUNK_INDEX_TTL or an hour. Seconds for which a rebuilt index is trusted.
+
+    """
+
+    def __init__(self, bucket, prefix, client=None, index=None, workers=None, index_ttl=None):
+        from .s3 import get_client
+
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/')
+        self.client = client or get_client()
+        self.index = index or ChunkIndex()
+        self.workers = int(workers or CHUNK_WORKERS)
+        self.index_ttl = INDEX_TTL if index_ttl is None else index_ttl
+
+    def chunk_key(self, digest):
+        return f'{self.prefix}/chunks/{digest[:2]}/{digest}'
+
+    def manifest_key(self, tag):
+        return f'{self.prefix}/manifests/{tag}.json'
+
+    def refresh_index(self):
+        """Rebuild the local index from the chunks in the bucket.
+
+        Returns:
+            Number of chunks in the store.
+
+        """
+        from .s3 import list_objects_parallel
+
+        self.index.clear(self.prefix)
+        # The chunks are grouped by the first two characters of their hash, the groups are listed concurrently
+        objects = list_objects_parallel(self.bucket, f'{self.prefix}/chunks/', self.client, delimiter='/',
+                                        workers=self.workers)
+        for key, item in objects.items():
+            self.index.add(self.prefix, key.rsplit('/', 1)[-1], None, item['Size'])
+        self.index.set_refreshed(self.prefix)
+        return len(objects)
+
+    def index_expired(self):
+        """Whether the local index is empty or was last rebuilt more than `index_ttl` seconds ago."""
+        refreshed = self.index.refreshed(self.prefix)
+        return (not self.index.count(self.prefix) or refreshed is None or
+                time.time() - refreshed > self.index_ttl)
+
+    def _upload_chunk(self, digest, data):
+        body = zlib.compress(data, 1)
+        self.client.put_object(Bucket=self.bucket, Key=self.chunk_key(digest), Body=body)
+        self.index.add(self.prefix, digest, len(data), len(body))
+        return len(body)
+
+    def put(self, tag, chunks, **metadata):
+        """Store a backup under tag.
+
+        Args:
+            tag: The backup tag.
+            chunks: Iterable of bytes, e.g. `backup.dump_chunks(...)`. Any chunk sizes, it is re-chunked.
+            **metadata: Stored in the manifest, e.g. kind='pg_dump'
+
+        Returns:
+            The manifest, with upload statistics under 'stats'.
+
+        """
+        if self.index_expired():
+            self.refresh_index()
+
+        start = time.perf_counter()
+        sha256 = hashlib.sha256()
+        manifest_chunks = []
+        pending = {}
+        uploaded = uploaded_bytes = 0
+        # At most twice the number of workers chunks are held in memory while uploads are in flight
+        slots = threading.BoundedSemaphore(self.workers * 2)
+
+        def upload(digest, data):
+            try:
+                return self._upload_chunk(digest, data)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for data in chunk_stream(chunks):
+                digest = hashlib.sha256(data).hexdigest()
+                sha256.update(data)
+                manifest_chunks.append([digest, len(data)])
+                if digest in pending or (self.prefix, digest) in self.index:
+                    continue
+                slots.acquire()
+                pending[digest] = executor.submit(upload, digest, data)
+            for future in pending.values():
+                uploaded += 1
+                uploaded_bytes += future.result()
+
+        size = sum(size for _, size in manifest_chunks)
+        manifest = dict(metadata, tag=tag, size=size, sha256=sha256.hexdigest(), chunks=manifest_chunks)
+        self.client.put_object(Bucket=self.bucket, Key=self.manifest_key(tag), Body=json.dumps(manifest).encode(),
+                               ContentType='application/json')
+        manifest['stats'] = {
+            'chunks': len(manifest_chunks),
+            'new_chunks': uploaded,
+            'uploaded_bytes': uploaded_bytes,
+            'seconds': round(time.perf_counter() - start, 3),
+        }
+        return manifest
+
+    def manifest(self, tag):
+        response = self.client.get_object(Bucket=self.bucket, Key=self.manifest_key(tag))
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+    def _download_chunk(self, digest):
+        response = self.client.get_object(Bucket=self.bucket, Key=self.chunk_key(digest))
+        data = zlib.decompress(response['Body'].read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f'Corrupt chunk: {self.chunk_key(digest)}')
+        return data
+
+    def iter_chunks(self, tag, manifest=None):
+        """Yield the bytes of a backup in order, fetching up to `workers` chunks ahead in parallel.
+
+        Raises:
+            ValueError: When a chunk or the reassembled backup does not match its checksum.
+
+        """
+        manifest = manifest or self.manifest(tag)
+        digests = [digest for digest, _ in manifest['chunks']]
+        sha256 = hashlib.sha256()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            for i, digest in enumerate(digests):
+                # Keep a window of fetches running ahead of the chunk being written
+                for j in range(i, min(i + self.workers * 2, len(digests))):
+                    if j not in futures:
+                        futures[j] = executor.submit(self._download_chunk, digests[j])
+                data = futures.pop(i).result()
+                sha256.update(data)
+                yield data
+        if sha256.hexdigest() != manifest['sha256']:
+            raise ValueError(f'Checksum mismatch for backup {tag}')
+
+    def get(self, tag, path):
+        """Reassemble a backup into a file.
+
+        Returns:
+            The manifest.
+
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        manifest = self.manifest(tag)
+        partial = path + '.part'
+        with open(partial, 'wb') as f:
+            for data in self.iter_chunks(tag, manifest):
+                f.write(data)
+        os.replace(partial, path)
+        return manifest
+
+
+def report(manifest):
+    """One line summary of a `ChunkStore.put`."""
+    stats = manifest['stats']
+    return (f"Stored backup {manifest['tag']}: {manifest['size']} bytes in {stats['chunks']} chunks, "
+            f"uploaded {stats['new_chunks']} new chunks ({stats['uploaded_bytes']} bytes) in {stats['seconds']}s")
@@ -0,0 +1,193 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .base import env
+from .parallel import PrefixedOutput, fork_context, prefixed_output
+
+
+class Step(object):
+    def __init__(self, name, func, args, kwargs, deps):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.deps = list(deps)
+        self.status = 'pending'
+        self.start = None
+        self.end = None
+        self.result = None
+        self.error = None
+
+    @property
+    def duration(self):
+        return self.end - self.start if self.start is not None and self.end is not None else 0.0
+
+
+class Pipeline(object):
+    """Dependency graph of task steps that runs independent steps concurrently.
+
+    Every step is called as `func(ctx, *args, **kwargs)` with its own copy of the context, see
+    `parallel.fork_context`, and its output is prefixed with the step name. Dependencies on steps that are not part of
+    the pipeline are ignored, so steps can be added conditionally. In dry run mode the steps run one at a time in
+    dependency order so the printed commands read like a script.
+
+    Args:
+        ctx: Run context.
+        workers: Default = 4. Maximum number of steps to run at the same time.
+
+    Examples:
+        pipeline = Pipeline(ctx)
+        pipeline.step('build', do, 'python setup.py bdist_wheel')
+        pipeline.step('collectstatic', python, './src/manage.py collectstatic --no-input')
+        pipeline.step('upload', s3cmd, simple_path='dist/app-1.0.0-py3-none-any.whl', deps=['build'])
+        pipeline.run()
+
+    """
+
+    def __init__(self, ctx, workers=4):
+        self.ctx = ctx
+        self.workers = int(workers)
+        self.steps = {}
+        self.start = None
+        self.end = None
+
+    def __contains__(self, name):
+        return name in self.steps
+
+    def step(self, name, func, *args, deps=(), **kwargs):
+        """Add a step that runs after all steps in deps have finished."""
+        if name in self.steps:
+            raise ValueError(f'Duplicate step: {name}')
+        self.steps[name] = Step(name, func, args, kwargs, deps)
+        return self.steps[name]
+
+    def _deps(self, step):
+        return [dep for dep in step.deps if dep in self.steps]
+
+    def order(self):
+        """Step names in dependency order.
+
+        Raises:
+            ValueError: When the steps have a circular dependency.
+
+        """
+        order = []
+        visiting = set()
+
+        def visit(name, chain):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError('Circular dependency: ' + ' -> '.join(chain + [name]))
+            visiting.add(name)
+            for dep in self._deps(self.steps[name]):
+                visit(dep, chain + [name])
+            visiting.discard(name)
+            order.append(name)
+
+        for name in self.steps:
+            visit(name, [])
+        return order
+
+    def _run_step(self, step):
+        step.start = time.perf_counter()
+        with PrefixedOutput.labelled(step.name):
+            try:
+                step.result = step.func(fork_context(self.ctx), *step.args, **step.kwargs)
+                step.status = 'ok'
+            except BaseException as e:
+                step.error = e
+                step.status = 'failed'
+                raise
+            finally:
+                step.end = time.perf_counter()
+
+    def run(self):
+        """Run all steps, starting each one as soon as its dependencies are done.
+
+        Once a step fails no new steps are started, running steps are waited for and the error is raised.
+
+        Returns:
+            Dictionary of step name to step result.
+
+        """
+        order = self.order()
+        self.start = time.perf_counter()
+        try:
+            if env.dry_run or self.workers <= 1:
+                for name in order:
+                    self._run_step(self.steps[name])
+            else:
+                self._run_concurrently(order)
+        finally:
+            self.end = time.perf_counter()
+            for step in self.steps.values():
+                if step.status == 'pending':
+                    step.status = 'skipped'
+        return {name: step.result for name, step in self.steps.items()}
+
+    def _run_concurrently(self, order):
+        done = set()
+        running = {}
+        error = None
+
+        with prefixed_output(), ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                if error is None:
+                    for name in order:
+                        step = self.steps[name]
+                        if step.status == 'pending' and name not in running.values() and \
+                                all(dep in done for dep in self._deps(step)):
+                            running[executor.submit(self._run_step, step)] = name
+                if not running:
+                    break
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                    else:
+                        done.add(name)
+
+        if error is not None:
+            raise error
+
+    def critical_path(self):
+        """The chain of dependent steps that took the longest.
+
+        Returns:
+            Tuple of the list of step names and their total duration in seconds.
+
+        """
+        finish = {}
+        previous = {}
+        for name in self.order():
+            step = self.steps[name]
+            deps = self._deps(step)
+            slowest = max(deps, key=lambda dep: finish[dep], default=None)
+            previous[name] = slowest
+            finish[name] = step.duration + (finish[slowest] if slowest else 0.0)
+
+        if not finish:
+            return [], 0.0
+        name = max(finish, key=finish.get)
+        total = finish[name]
+        path = []
+        while name:
+            path.append(name)
+            name = previous[name]
+        return list(reversed(path)), total
+
+    def report(self):
+        """Table of step status and durations followed by the critical path."""
+        width = max([len('step')] + [len(name) for name in self.steps])
+        lines = [f'{"step":<{width}}  {"status":<7}  {"time":>8}']
+        for name in self.order():
+            step = self.steps[name]
+            lines.append(f'{name:<{width}}  {step.status:<7}  {step.duration:>7.1f}s')
+        path, total = self.critical_path()
+        wall = (self.end - self.start) if self.start is not None and self.end is not None else 0.0
+        serial = sum(step.duration for step in self.steps.values())
+        lines.append(f'critical path: {" -> ".join(path)} ({total:.1f}s)')
+        lines.append(f'wall time: {wall:.1f}s, sequential time: {serial:.1f}s')
+        return '\n'.join(lines)
@@ -1,3 +1,8 @@
+import statistics
+import subprocess
+import sys
+import time
+
 from invoke import task
 
 from .base import do
@@ -37,3 +42,57 @@ def contribute(ctx):
     do(ctx, 'python3.6 -m venv venv')
     do(ctx, 'source venv/bin/activate')
     build(ctx, docs=True)
+
+
+# Modules that must not be imported just to list tasks or do a dry run
+HEAVY_MODULES = ['boto3', 'botocore', 'requests', 'smtplib', 'pkg_resources', 'setuptools_scm', 'distutils']
+
+
+@task
+def benchmark_startup(ctx, runs=5, budget=0.5):
+    """Measure CLI startup time and fail if it exceeds the budget.
+
+    Times `dstack --list` and `dstack dry echo` and checks that none of the `HEAVY_MODULES` are imported at startup.
+
+    Args:
+        ctx: Run context.
+        runs: Default = 5. Number of times to run each command. The median is compared to the budget.
+        budget: Default = 0.5. Maximum median startup time in seconds.
+
+    Returns:
+        Dictionary of median startup time per command.
+
+    Raises:
+        RuntimeError: When the budget is exceeded or a heavy module is imported at startup.
+
+    """
+    runs = int(runs)
+    budget = float(budget)
+    entry_point = [sys.executable, '-c', 'from dstack_tasks.main import program; program.run()']
+    commands = {
+        'dstack --list': ['--list'],
+        'dstack dry echo': ['dry', 'echo'],
+    }
+
+    probe = 'import sys, dstack_tasks.main; print(",".join(sys.modules))'
+    loaded = set(subprocess.run([sys.executable, '-c', probe], check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout.strip().split(','))
+    heavy = [module for module in HEAVY_MODULES if module in loaded]
+
+    timings = {}
+    for name, args in commands.items():
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(entry_point + args, check=True, stdout=subprocess.DEVNULL)
+            samples.append(time.perf_counter() - start)
+        timings[name] = statistics.median(samples)
+        print(f'{name}: {timings[name]:.3f}s (median of {runs}, budget {budget:.3f}s)')
+
+    if heavy:
+        raise RuntimeError(f'Heavy modules imported at startup: {", ".join(heavy)}')
+    over_budget = [name for name, seconds in timings.items() if seconds > budget]
+    if over_budget:
+        raise RuntimeError(f'Startup budget of {budget:.3f}s exceeded by: {", ".join(over_budget)}')
+
+    return timings
@@ -0,0 +1,283 @@
+import http.client
+import json
+import os
+import socket
+import struct
+import threading
+import urllib.parse
+
+# Defaults for the DOCKER_SOCKET and DOCKER_API_VERSION env vars, which are read when an engine is created so that
+# values from the .env file apply
+DOCKER_SOCKET = '/var/run/docker.sock'
+API_VERSION = 'v1.40'
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f'{status}: {message}')
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix socket."""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class ExecResult(object):
+    def __init__(self, exit_code, stdout=b'', stderr=b''):
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+
+def demultiplex(response, chunk_size=64 * 1024):
+    """Split Docker's multiplexed attach/exec stream into (stream, bytes) frames.
+
+    Without a TTY, Docker prefixes each frame with a header of stream type (1 stdout, 2 stderr) and length.
+    """
+    while True:
+        header = response.read(8)
+        if len(header) < 8:
+            return
+        stream, length = struct.unpack('>BxxxL', header)
+        while length:
+            data = response.read(min(length, chunk_size))
+            if not data:
+                return
+            length -= len(data)
+            yield stream, data
+
+
+class DockerEngine(object):
+    """Minimal Docker Engine API client over one persistent unix socket connection.
+
+    Tasks that issue many docker calls avoid forking the docker CLI and parsing its text output for each of them.
+    Requests from different threads are serialised on the connection, streaming exec output uses its own connection.
+
+    Args:
+        socket_path: Default is the DOCKER_SOCKET env var or /var/run/docker.sock.
+        timeout: Socket timeout in seconds.
+
+    """
+
+    def __init__(self, socket_path=None, timeout=None):
+        self.socket_path = socket_path or os.getenv('DOCKER_SOCKET', DOCKER_SOCKET)
+        self.api_version = os.getenv('DOCKER_API_VERSION', API_VERSION)
+        self.timeout = timeout
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _url(self, path, params=None):
+        url = f'/{self.api_version}{path}'
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        return url
+
+    def _send(self, connection, method, path, params=None, body=None):
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        connection.request(method, self._url(path, params), body=body, headers=headers)
+        return connection.getresponse()
+
+    def request(self, method, path, params=None, body=None):
+        """Send a request on the persistent connection and return the decoded JSON body (or None).
+
+        Raises:
+            DockerAPIError: On 4xx and 5xx responses.
+
+        """
+        with self._lock:
+            for attempt in range(2):
+                if self._connection is None:
+                    self._connection = UnixHTTPConnection(self.socket_path, self.timeout)
+                try:
+                    response = self._send(self._connection, method, path, params, body)
+                    data = response.read()
+                    break
+                except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                    # The daemon closed the idle keep-alive connection, reconnect once
+                    self._connection.close()
+                    self._connection = None
+                    if attempt:
+                        raise
+
+        if response.status >= 400:
+            try:
+                message = json.loads(data.decode('utf-8')).get('message', '')
+            except ValueError:
+                message = data.decode('utf-8', errors='replace')
+            raise DockerAPIError(response.status, message)
+        if data and response.getheader('Content-Type', '').startswith('application/json'):
+            return json.loads(data.decode('utf-8'))
+        return None
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def containers(self, all=True, filters=None):
+        """List containers, like `docker ps`.
+
+        Returns:
+            List of container dictionaries with Id, Names, Image, State, Status, etc.
+
+        """
+        params = {'all': int(bool(all))}
+        if filters:
+            params['filters'] = json.dumps(filters)
+        return self.request('GET', '/containers/json', params)
+
+    def container_names(self, all=True):
+        return [name.lstrip('/') for container in self.containers(all) for name in container['Names'][:1]]
+
+    def inspect(self, container):
+        return self.request('GET', f'/containers/{container}/json')
+
+    def events(self, filters=None, since=None, until=None):
+        """Yield events as dictionaries as they happen, like `docker events`.
+
+        Args:
+            filters: e.g. {'container': ['project_postgres_1'], 'event': ['health_status']}
+            since: Unix timestamp to replay events from.
+            until: Unix timestamp at which the daemon ends the stream.
+
+        """
+        params = {}
+        if filters:
+            params['filters'] = json.dumps(filters)
+        if since is not None:
+            params['since'] = int(since)
+        if until is not None:
+            params['until'] = int(until)
+        connection = UnixHTTPConnection(self.socket_path, self.timeout)
+        try:
+            response = self._send(connection, 'GET', '/events', params)
+            if response.status >= 400:
+                raise DockerAPIError(response.status, response.read().decode('utf-8', errors='replace'))
+            for line in response:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            connection.close()
+
+    def volumes(self):
+        return self.request('GET', '/volumes').get('Volumes') or []
+
+    def remove_volume(self, name, force=False, missing_ok=False):
+        from .cache import query_cache
+
+        # Cached `docker volume ls` style results of the CLI backend are stale now
+        query_cache.invalidate('local')
+        try:
+            self.request('DELETE', f'/volumes/{name}', {'force': int(bool(force))})
+        except DockerAPIError as e:
+            if not (missing_ok and e.status == 404):
+                raise
+
+    def exec_create(self, container, cmd, user=None, env=None, workdir=None):
+        """Create an exec instance in a running container.
+
+        Args:
+            container: Container name or id.
+            cmd: List of arguments, or a string that is run with `sh -c`.
+            user: User to run as.
+            env: Dictionary of environmental variables.
+            workdir: Working directory in the container.
+
+        Returns:
+            Exec id
+
+        """
+        if isinstance(cmd, str):
+            cmd = ['sh', '-c', cmd]
+        config = {'Cmd': cmd, 'AttachStdout': True, 'AttachStderr': True, 'Tty': False}
+        if user:
+            config['User'] = user
+        if env:
+            config['Env'] = [f'{k}={v}' for k, v in env.items()]
+        if workdir:
+            config['WorkingDir'] = workdir
+        return self.request('POST', f'/containers/{container}/exec', body=config)['Id']
+
+    def exec_stream(self, exec_id):
+        """Start an exec instance and yield tuples of stream (1 stdout, 2 stderr) and bytes as they arrive."""
+        # The output is streamed on a separate connection so other requests are not blocked
+        connection = UnixHTTPConnection(self.socket_path, self.timeout)
+        try:
+            response = self._send(connection, 'POST', f'/exec/{exec_id}/start', body={'Detach': False, 'Tty': False})
+            if response.status >= 400:
+                raise DockerAPIError(response.status, response.read().decode('utf-8', errors='replace'))
+            yield from demultiplex(response)
+        finally:
+            connection.close()
+
+    def exec_exit_code(self, exec_id):
+        return self.request('GET', f'/exec/{exec_id}/json')['ExitCode']
+
+    def exec_run(self, container, cmd, **kwargs):
+        """Run a command in a container and collect its output, see `exec_create` for the arguments.
+
+        Returns:
+            ExecResult
+
+        """
+        exec_id = self.exec_create(container, cmd, **kwargs)
+        stdout, stderr = [], []
+        for stream, data in self.exec_stream(exec_id):
+            (stderr if stream == 2 else stdout).append(data)
+        return ExecResult(self.exec_exit_code(exec_id), b''.join(stdout), b''.join(stderr))
+
+    def exec_to_file(self, container, cmd, fileobj, **kwargs):
+        """Stream the stdout of a command in a container into a binary file object.
+
+        Returns:
+            ExecResult with stderr but without stdout.
+
+        """
+        exec_id = self.exec_create(container, cmd, **kwargs)
+        stderr = []
+        for stream, data in self.exec_stream(exec_id):
+            if stream == 2:
+                stderr.append(data)
+            else:
+                fileobj.write(data)
+        return ExecResult(self.exec_exit_code(exec_id), b'', b''.join(stderr))
+
+
+_engine = None
+
+
+def get_engine():
+    """Shared DockerEngine for this process."""
+    global _engine
+    if _engine is None:
+        _engine = DockerEngine()
+    return _engine
+
+
+def use_engine(ctx):
+    """Whether to use the Engine API instead of the docker CLI.
+
+    Only local commands can use the API, set DOCKER_BACKEND=api in the .env file to enable it.
+    """
+    from .base import env
+
+    return ctx.get('docker_backend', 'cli') == 'api' and not getattr(ctx, 'host', False) and not env.dry_run
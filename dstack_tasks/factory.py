@@ -1,5 +1,6 @@
 import io
 import os
+import pathlib
 
 import colorama
 from invoke import task
@@ -147,6 +148,7 @@ def make_wheels(ctx, use_package=None, use_recipe=None, clear_wheels=True,
     elif not use_package and use_recipe:
         if os.path.exists(use_recipe):
             recipe_filename = f'{ctx.project_name}-{env.tag}'
+            use_recipe = pathlib.Path(use_recipe)
         else:
             # raise FileNotFoundError('Recipe file not found!')
             print(colorama.Fore.RED + 'Warning: Recipe file does not exist')
@@ -1,17 +1,86 @@
-import pkg_resources
 from invoke import Argument, Collection, Program
 
 import dstack_tasks
 
+try:
+    from importlib.metadata import PackageNotFoundError, version as _distribution_version
+except ImportError:  # Python 3.7
+    PackageNotFoundError = _distribution_version = None
+
 
 class MainProgram(Program):
     def core_args(self):
         core_args = super(MainProgram, self).core_args()
         extra_args = [
             Argument(names=('project', 'n'), help="The project/package name being build"),
+            Argument(names=('trace',), help="Write a Chrome trace-event JSON file of all commands run"),
+            Argument(names=('plan-cache',), kind=bool, default=False,
+                     help="Compile the tasks into a plan once and replay the cached plan while the inputs don't "
+                          "change"),
         ]
         return core_args + extra_args
 
+    def execute(self):
+        try:
+            if self.args['plan-cache'].value and 'dry' not in [task.name for task in self.tasks]:
+                self.execute_plan()
+            else:
+                super(MainProgram, self).execute()
+        finally:
+            if self.args.trace.value:
+                from .trace import tracer
+                tracer.write(self.args.trace.value)
+
+    def execute_plan(self):
+        """Replay the cached plan for this invocation, compiling it first if the inputs have changed.
+
+        Plans with steps a replay can't reproduce, like in-process uploads or timestamped backup tags, are not cached
+        and the tasks run as usual instead.
+        """
+        import contextlib
+        import io
+        import sys
+
+        from invoke import Context
+
+        from .base import env
+        from .plan import Plan, cached_plan_path, plan_key
+
+        key = plan_key([arg for arg in self.argv[1:] if arg != '--plan-cache'])
+        path = cached_plan_path(key)
+        try:
+            plan = Plan.load(path)
+        except (OSError, ValueError):
+            # Compile the plan by running the tasks in dry run mode
+            plan = Plan(key=key)
+            env.dry_run, env.plan = True, plan
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    super(MainProgram, self).execute()
+            finally:
+                env.dry_run, env.plan = False, None
+            if not plan.replayable:
+                print('Not caching the plan, it has steps a replay can\'t reproduce: ' +
+                      '; '.join(plan.unreplayable_steps()), file=sys.stderr)
+                return super(MainProgram, self).execute()
+            plan.save(path)
+
+        plan.execute(Context(config=self.config))
+
+
+def get_distribution_version():
+    """Version of the installed dstack-tasks distribution.
+
+    Uses importlib.metadata where available because importing pkg_resources scans every installed distribution.
+    """
+    if _distribution_version is None:
+        import pkg_resources
+        return pkg_resources.get_distribution('dstack_tasks').version
+    try:
+        return _distribution_version('dstack_tasks')
+    except PackageNotFoundError:
+        return 'unknown'
+
 
-version = pkg_resources.get_distribution("dstack_tasks").version
+version = get_distribution_version()
 program = MainProgram(namespace=Collection.from_module(dstack_tasks), version=version)
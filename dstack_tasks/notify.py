@@ -1,17 +1,18 @@
-import email.message
 import json
 import os
-import smtplib
 import socket
 
-import requests
 from invoke import task
 
 from .base import LOCAL_PREFIX, REMOTE_PREFIX, env
+from .plan import unreplayable
 
 
 @task
 def send_mail(send_to, message, subject=None, mail_host=None):
+    import email.message
+    import smtplib
+
     email_from = os.getenv('NOTIFY_EMAIL_FROM', None)
     email_domain = os.getenv('NOTIFY_EMAIL_DOMAIN', socket.getfqdn())
     email_from = email_from or f"Server Alert <no-reply@{email_domain}>"
@@ -38,9 +39,12 @@ def send_alert(ctx, message, backend):
     }
     web_hook = os.getenv(hooks[backend])
     if not env.dry_run:
+        import requests
+
         data = {'text': message}
         if backend == 'telegram':
             data.update({'chat_id': os.getenv('NOTIFY_TELEGRAM_CHAT_ID')})
         requests.post(web_hook, headers=headers, data=json.dumps(data))
     else:
         print(REMOTE_PREFIX if getattr(ctx, 'host', False) else LOCAL_PREFIX, f'POST "{message}" to {web_hook[:25]}...')
+        unreplayable(f'{backend} alert')
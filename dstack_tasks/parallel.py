@@ -0,0 +1,314 @@
+import io
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import colorama
+from invoke import task
+
+LOCAL_HOSTS = ('local', 'localhost')
+
+
+class PrefixedOutput(io.TextIOBase):
+    """Stream that prefixes every line written from a labelled thread.
+
+    Installed as `sys.stdout`/`sys.stderr` while tasks run concurrently so that the output of each host or step can
+    be told apart. Lines are written whole, so the output of different threads doesn't interleave mid-line.
+    Threads without a label write straight through.
+    """
+    _local = threading.local()
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._partial = {}
+
+    @classmethod
+    def label(cls):
+        return getattr(cls._local, 'label', None)
+
+    @classmethod
+    @contextmanager
+    def labelled(cls, label):
+        """Prefix output of the current thread with label."""
+        previous = cls.label()
+        cls._local.label = label
+        try:
+            yield
+        finally:
+            cls._local.label = previous
+
+    def write(self, text):
+        label = self.label()
+        if label is None:
+            return self.stream.write(text)
+        return self.write_labelled(label, text)
+
+    def write_labelled(self, label, text):
+        with self._lock:
+            lines = (self._partial.pop(label, '') + text).split('\n')
+            if lines[-1]:
+                self._partial[label] = lines[-1]
+            prefix = colorama.Fore.CYAN + f'[{label}]' + colorama.Fore.RESET
+            for line in lines[:-1]:
+                self.stream.write(f'{prefix} {line}\n')
+        return len(text)
+
+    def flush(self):
+        label = self.label()
+        if label is not None and label in self._partial:
+            self.write_labelled(label, '\n')
+        self.stream.flush()
+
+    def stream_for(self, label):
+        """Stream that writes with label's prefix from any thread, e.g. invoke's output reader threads."""
+        return _LabelledStream(self, label)
+
+    @property
+    def encoding(self):
+        return getattr(self.stream, 'encoding', 'utf-8')
+
+    def isatty(self):
+        return False
+
+    def fileno(self):
+        return self.stream.fileno()
+
+
+class _LabelledStream(io.TextIOBase):
+    def __init__(self, output, label):
+        super().__init__()
+        self.output = output
+        self.label = label
+
+    def write(self, text):
+        return self.output.write_labelled(self.label, text)
+
+    def flush(self):
+        self.output.stream.flush()
+
+
+def labelled_streams():
+    """`out_stream` and `err_stream` run arguments for the current thread's label, if any."""
+    label = PrefixedOutput.label()
+    if label is None or not isinstance(sys.stdout, PrefixedOutput):
+        return {}
+    return {'out_stream': sys.stdout.stream_for(label), 'err_stream': sys.stderr.stream_for(label)}
+
+
+@contextmanager
+def prefixed_output():
+    """Route `sys.stdout` and `sys.stderr` through PrefixedOutput."""
+    stdout, stderr = sys.stdout, sys.stderr
+    if isinstance(stdout, PrefixedOutput):
+        yield
+        return
+    sys.stdout, sys.stderr = PrefixedOutput(stdout), PrefixedOutput(stderr)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def fork_context(ctx, host=None):
+    """New context sharing ctx's config but with its own `cd` and `prefix` state, for use in another thread.
+
+    Args:
+        ctx: Run context.
+        host: Host for the new context. Defaults to the host of ctx. 'local' or 'localhost' gives a local context.
+
+    Returns:
+        invoke.Context or fabric.Connection
+
+    """
+    host = host or getattr(ctx, 'host', None)
+    if not host or host in LOCAL_HOSTS:
+        from invoke import Context
+        return Context(config=ctx.config)
+
+    from fabric import Config, Connection
+
+    config = ctx.config.clone(into=Config)
+    if host == getattr(ctx, 'host', None):
+        # Keep the user, port and keys of a Connection that was not created from a `user@host:port` string
+        connection = Connection(host, user=ctx.user, port=ctx.port, config=config, connect_kwargs=ctx.connect_kwargs)
+    else:
+        connection = Connection(host, config=config)
+    remote = config.get('remote', None)
+    if remote:
+        # Tasks run against the project directory on the server, like `e` does for a single host
+        connection['dir'] = remote['project_path']
+    return connection
+
+
+class HostResult(object):
+    def __init__(self, host):
+        self.host = host
+        self.status = 'skipped'
+        self.duration = 0.0
+        self.result = None
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.status == 'ok'
+
+
+def run_on_hosts(ctx, func, hosts, workers=4, fail_fast=False, *args, **kwargs):
+    """Run func(ctx, *args, **kwargs) on every host concurrently.
+
+    Each host gets its own context, see `fork_context`, and its output is prefixed with the host name.
+
+    Args:
+        ctx: Run context configured by e.g. the `e` task.
+        func: Task or function to run.
+        hosts: List of hosts. 'local' or 'localhost' runs the task locally, which is useful for testing.
+        workers: Default = 4. Maximum number of hosts to run on at the same time.
+        fail_fast: Default = False. Stop starting new hosts once one fails.
+        *args: Positional arguments for func.
+        **kwargs: Keyword arguments for func.
+
+    Returns:
+        List of HostResult in the order of hosts.
+
+    """
+    results = [HostResult(host) for host in hosts]
+    failed = threading.Event()
+
+    def _run(item):
+        if fail_fast and failed.is_set():
+            return
+        start = time.perf_counter()
+        with PrefixedOutput.labelled(item.host):
+            try:
+                item.result = func(fork_context(ctx, item.host), *args, **kwargs)
+                item.status = 'ok'
+            except BaseException as e:
+                item.error = e
+                item.status = 'failed'
+                failed.set()
+                print(f'{type(e).__name__}: {e}')
+            finally:
+                item.duration = time.perf_counter() - start
+
+    with prefixed_output(), ThreadPoolExecutor(max_workers=int(workers)) as executor:
+        for _ in executor.map(_run, results):
+            pass
+
+    return results
+
+
+def summary_table(results):
+    """Format a list of HostResult as a table with the status and duration per host."""
+    width = max([len('host')] + [len(item.host) for item in results])
+    lines = [f'{"host":<{width}}  {"status":<7}  {"time":>8}  error']
+    for item in results:
+        error = f'{type(item.error).__name__}: {item.error}'.splitlines()[0] if item.error else ''
+        lines.append(f'{item.host:<{width}}  {item.status:<7}  {item.duration:>7.1f}s  {error}')
+    ok = sum(item.ok for item in results)
+    lines.append(f'{ok}/{len(results)} hosts succeeded')
+    return '\n'.join(lines)
+
+
+def resolve_hosts(hosts=None, hosts_file=None, default=None):
+    """List of hosts from a comma separated string, a file with one host per line or the default.
+
+    Args:
+        hosts: Comma separated hosts, e.g. 'web1,ubuntu@web2:2222'
+        hosts_file: File with one host per line. Empty lines and lines starting with # are ignored.
+        default: Hosts to use when neither hosts nor hosts_file are given, e.g. env.hosts.
+
+    Returns:
+        List of hosts.
+
+    """
+    if hosts:
+        return [host.strip() for host in hosts.split(',') if host.strip()]
+    if hosts_file:
+        with open(hosts_file) as f:
+            return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+    return [host for host in default or [] if host]
+
+
+def task_arguments(task_object, args):
+    """Keyword arguments for a task from a 'key=value,...' string.
+
+    Values are converted to the type of the argument's default, like invoke does for the command line, so that
+    e.g. 'replica=False' is False rather than a truthy string. Values of arguments without a typed default are
+    passed as strings, except true/false.
+
+    Args:
+        task_object: The invoke Task.
+        args: Comma separated task arguments, e.g. 'cmd=check,replica=False'
+
+    Returns:
+        Dictionary of argument name to value.
+
+    Raises:
+        ValueError: When a value does not match the type of the default.
+
+    """
+    import inspect
+
+    from .utils import strtobool
+
+    body = getattr(task_object, 'body', task_object)
+    defaults = {name: parameter.default for name, parameter in inspect.signature(body).parameters.items()}
+    kwargs = {}
+    for item in filter(None, (args or '').split(',')):
+        name, value = item.split('=', 1)
+        name = name.strip().replace('-', '_')
+        default = defaults.get(name)
+        if isinstance(default, bool) or (default is None and value.lower() in ('true', 'false')):
+            value = strtobool(value)
+        elif isinstance(default, (int, float)):
+            value = type(default)(value)
+        kwargs[name] = value
+    return kwargs
+
+
+@task
+def fan(ctx, name, hosts=None, hosts_file=None, workers=4, fail_fast=False, args=None):
+    """Run a task on several hosts concurrently and print a summary table.
+
+    Args:
+        ctx: Run context. Run `e` first to configure it.
+        name: Name of the task to run, e.g. 'deploy-code' or 'server.machine-status'
+        hosts: Comma separated hosts. Defaults to HOST_NAMES from the .env file.
+        hosts_file: File with one host per line.
+        workers: Default = 4. Maximum number of hosts to run on at the same time.
+        fail_fast: Default = False. Stop starting new hosts once one fails.
+        args: Comma separated task arguments, e.g. 'cmd=check,replica=False'
+
+    Returns:
+        List of HostResult
+
+    Raises:
+        RuntimeError: When the task failed on any host.
+
+    Examples:
+        dstack e fan db --args cmd=check --hosts db1,db2,db3
+        dstack e fan deploy-code --args version=1.2.0 --hosts-file .local/hosts.txt --fail-fast
+
+    """
+    from . import ns
+    from .base import env
+
+    host_list = resolve_hosts(hosts, hosts_file, default=env.hosts)
+    if not host_list:
+        raise AttributeError('No hosts specified. Use --hosts, --hosts-file or set HOST_NAMES')
+
+    task_object = ns[name]
+    results = run_on_hosts(ctx, task_object, host_list, workers=workers, fail_fast=fail_fast,
+                           **task_arguments(task_object, args))
+
+    print(summary_table(results))
+    if not all(item.ok for item in results):
+        failed = sum(item.status == 'failed' for item in results)
+        raise RuntimeError(f'{name} failed on {failed} of {len(results)} host(s)')
+    return results
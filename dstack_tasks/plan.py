@@ -0,0 +1,202 @@
+import glob
+import hashlib
+import io
+import json
+import os
+
+from invoke import task
+
+from .base import do, env
+
+PLAN_DIR = os.path.join('.local', 'plans')
+
+# `run` arguments that are kept in a plan, others like streams can't be serialised. Text given on stdin with
+# `in_stream=io.StringIO(...)` is stored as `stdin`.
+RUN_ARGUMENTS = ('hide', 'warn', 'pty', 'echo')
+
+# Part of the cache key, so plans cached by an older format are compiled again
+PLAN_FORMAT = 2
+
+# Environmental variables read by `e` and the tasks, their values are part of the cache key. Secrets like
+# TELEGRAM_BOT_TOKEN don't change the commands and are left out so they don't end up in a hash on disk.
+PLAN_ENV_VARS = (
+    'APP_PATH', 'AWS_DEFAULT_REGION', 'AWS_PROFILE', 'BACKUP_STREAM', 'COMPOSE_FILE', 'COMPOSE_PARALLEL_LIMIT',
+    'COMPOSE_PROJECT_NAME', 'DB_JOBS', 'DOCKER_BACKEND', 'DOCKER_HOST', 'ENDPOINT_URL', 'GIT_REPO', 'HOST_NAME',
+    'HOST_NAMES', 'IMAGE_NAME', 'LOCAL_DIR', 'NODE_PREFIX', 'NOTIFY_EMAIL_DOMAIN', 'NOTIFY_EMAIL_FROM',
+    'NOTIFY_TELEGRAM_CHAT_ID', 'ORGANISATION', 'PROJECT_NAME', 'S3_BUCKET_NAME', 'S3_ENGINE', 'S3_PROJECT_PREFIX',
+    'SOURCE_DIR', 'USER_NAME', 'VENV_NAME', 'VENV_TYPE', 'VERSION', 'VIRTUAL_HOST',
+)
+
+
+class Plan(object):
+    """Ordered list of the commands a task would run, compiled by running the task in dry run mode.
+
+    A plan can be saved as JSON and executed later without running the Python task logic, loading config or resolving
+    the version again.
+
+    Work a task does in-process instead of with a command (boto3 transfers, the backup catalog, waiting for
+    services, editing .env files) and values that depend on the time, like timestamps in backup tags, can't be
+    reproduced by a replay. They are recorded as `unreplayable` steps and a plan that contains them is neither cached
+    nor replayed, see `unreplayable`.
+
+    Note:
+        Tasks that inspect the output of earlier commands only see the dry run output while planning.
+
+    """
+
+    def __init__(self, steps=None, key=None):
+        self.steps = list(steps or [])
+        self.key = key
+
+    def __len__(self):
+        return len(self.steps)
+
+    @property
+    def replayable(self):
+        return not self.unreplayable_steps()
+
+    def unreplayable_steps(self):
+        """Descriptions of the steps a replay can't reproduce."""
+        return [step['unreplayable'] for step in self.steps if 'unreplayable' in step]
+
+    def record(self, cmd, host=None, path=None, run_env=None, sudo=False, local=False, **kwargs):
+        """Add a command with the settings `do` was called with."""
+        step = {
+            'cmd': cmd,
+            'host': host or None,
+            'path': path,
+            'env': dict(run_env or {}),
+            'sudo': sudo,
+            'local': bool(local),
+            'kwargs': {k: v for k, v in kwargs.items() if k in RUN_ARGUMENTS},
+        }
+        in_stream = kwargs.get('in_stream')
+        if in_stream is not None:
+            if not hasattr(in_stream, 'getvalue'):
+                self.record_unreplayable(f'{cmd} reads stdin from {type(in_stream).__name__}')
+                return
+            step['stdin'] = in_stream.getvalue()
+        self.steps.append(step)
+
+    def record_unreplayable(self, description):
+        """Add a step that runs in-process or depends on the time, which makes the plan unreplayable."""
+        self.steps.append({'unreplayable': description})
+
+    def to_dict(self):
+        return {'key': self.key, 'steps': self.steps}
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(steps=data['steps'], key=data.get('key'))
+
+    def execute(self, ctx, dry_run=False):
+        """Run every command in the plan with `do`.
+
+        Args:
+            ctx: Run context.
+            dry_run: Default = False. Print the commands instead.
+
+        Returns:
+            List of results.
+
+        Raises:
+            RuntimeError: When the plan has unreplayable steps, nothing is run then.
+
+        """
+        from .base import LOCAL_PREFIX
+
+        if not self.replayable and not dry_run:
+            raise RuntimeError('The plan has steps that a replay can\'t reproduce, run the task instead: ' +
+                               '; '.join(self.unreplayable_steps()))
+        results = []
+        for step in self.steps:
+            if 'unreplayable' in step:
+                print(LOCAL_PREFIX, f'# not replayable: {step["unreplayable"]}')
+                results.append(None)
+                continue
+            kwargs = dict(step['kwargs'])
+            if 'stdin' in step:
+                kwargs['in_stream'] = io.StringIO(step['stdin'])
+            results.append(do(ctx, step['cmd'], dry_run=dry_run, local=step['local'], sudo=step['sudo'],
+                              host=step['host'], path=step['path'], env=step['env'] or None, **kwargs))
+        return results
+
+
+def unreplayable(description):
+    """Record in the plan being compiled, if any, that a task did something a replay can't reproduce.
+
+    Call it from the dry run branch of in-process work, e.g. `unreplayable('wait until postgres is ready')`.
+    """
+    if env.plan is not None:
+        env.plan.record_unreplayable(description)
+
+
+def host_string(ctx):
+    """`user@host:port` of a fabric Connection, or None for a local context."""
+    host = getattr(ctx, 'host', None)
+    if not host:
+        return None
+    user = getattr(ctx, 'user', None)
+    port = getattr(ctx, 'port', None)
+    return f'{user + "@" if user else ""}{host}{":" + str(port) if port else ""}'
+
+
+def plan_key(argv, root='.'):
+    """Hash of everything that determines the plan of an invocation.
+
+    Covers the command line arguments, the working directory, the .env files, the environmental variables in
+    PLAN_ENV_VARS and the git state.
+
+    Args:
+        argv: The command line arguments.
+        root: Default = '.'. The project root.
+
+    Returns:
+        Hex digest.
+
+    """
+    from .version import git_state
+
+    digest = hashlib.sha256()
+    digest.update(str(PLAN_FORMAT).encode('utf-8'))
+    digest.update(json.dumps(list(argv)).encode('utf-8'))
+    digest.update(os.path.abspath(root).encode('utf-8'))
+    for path in [os.path.join(root, '.env')] + sorted(glob.glob(os.path.join(root, '.local', '*.env'))):
+        try:
+            with open(path, 'rb') as f:
+                digest.update(path.encode('utf-8') + b'\0' + f.read())
+        except FileNotFoundError:
+            pass
+    variables = {name: os.environ[name] for name in PLAN_ENV_VARS if name in os.environ}
+    digest.update(json.dumps(variables, sort_keys=True).encode('utf-8'))
+    digest.update(str(git_state(root)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def cached_plan_path(key, root='.'):
+    return os.path.join(root, PLAN_DIR, f'{key}.json')
+
+
+@task
+def replay(ctx, plan):
+    """Execute a plan saved by `dstack dry --plan <file> ...`
+
+    Args:
+        ctx: Run context.
+        plan: Path to the plan file.
+
+    Examples:
+        dstack dry --plan .local/deploy.json e deploy-code --version 1.2.0
+        dstack replay .local/deploy.json
+
+    """
+    return Plan.load(plan).execute(ctx, dry_run=env.dry_run)
@@ -0,0 +1,149 @@
+import atexit
+import os
+import threading
+import time
+
+
+def parse_host(host, user=None, port=None):
+    """Split a `user@host:port` string into its parts.
+
+    Args:
+        host: Host string, e.g. 'ubuntu@example.com:2222'
+        user: Default user if the host string does not include one.
+        port: Default port if the host string does not include one.
+
+    Returns:
+        Tuple of host, user, port
+
+    """
+    if '@' in host:
+        user, host = host.rsplit('@', 1)
+    if host.count(':') == 1:
+        host, port = host.split(':')
+    return host, user, int(port) if port else None
+
+
+class ConnectionPool(object):
+    """Per-process pool of open Fabric connections keyed by host, user and port.
+
+    Connections stay open across every `do` call in an invocation so that a deploy only pays for one SSH handshake
+    per host. Each call gets its own lightweight `Connection` that shares the pooled SSH client and transport, so the
+    `cd` and `prefix` state of concurrent callers don't interfere. Callers `release` the connection when their command
+    is done, connections are only evicted when no caller is using them.
+
+    Args:
+        keepalive: Seconds between SSH keepalive packets. 0 disables keepalives.
+        idle_timeout: Seconds after which connections are closed once they were released. 0 disables eviction.
+
+    """
+
+    def __init__(self, keepalive=30, idle_timeout=300):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._connections = {}
+        # Connection returned by `get` (by id) to its pool entry, until it is released
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def _open(self, host, user, port, config, connect_kwargs):
+        from fabric import Connection
+
+        connection = Connection(host, user=user, port=port, config=config, connect_kwargs=connect_kwargs)
+        connection.open()
+        if self.keepalive:
+            connection.transport.set_keepalive(self.keepalive)
+        return connection
+
+    def get(self, host, user=None, port=None, config=None, connect_kwargs=None):
+        """Get a connection to host, opening a new SSH transport only when there is no live one in the pool.
+
+        The connection is in use until it is passed to `release`.
+
+        Args:
+            host: Host name or `user@host:port` string.
+            user: SSH user. Defaults to the Fabric config.
+            port: SSH port. Defaults to the Fabric config.
+            config: Invoke or Fabric config used for the returned connection.
+            connect_kwargs: Passed to paramiko when a new connection is opened.
+
+        Returns:
+            fabric.Connection
+
+        """
+        from fabric import Connection
+
+        host, user, port = parse_host(host, user, port)
+        view = Connection(host, user=user, port=port, config=config, connect_kwargs=connect_kwargs)
+        key = (view.host, view.user, view.port)
+
+        self.evict_idle()
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is not None and entry['connection'].is_connected:
+                self.hits += 1
+            else:
+                self.misses += 1
+                entry = {'connection': self._open(view.host, view.user, view.port, view.config, connect_kwargs),
+                         'in_use': 0, 'released': time.monotonic()}
+                self._connections[key] = entry
+            entry['in_use'] += 1
+            self._leases[id(view)] = entry
+
+        view.client = entry['connection'].client
+        view.transport = entry['connection'].transport
+        return view
+
+    def release(self, connection):
+        """Mark a connection returned by `get` as no longer in use. Other connections are ignored."""
+        with self._lock:
+            entry = self._leases.pop(id(connection), None)
+            if entry is not None:
+                entry['in_use'] -= 1
+                entry['released'] = time.monotonic()
+
+    def evict_idle(self):
+        """Close connections that are not in use and were released more than `idle_timeout` seconds ago."""
+        if not self.idle_timeout:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for key, entry in list(self._connections.items()):
+                if entry['in_use']:
+                    continue
+                if now - entry['released'] > self.idle_timeout or not entry['connection'].is_connected:
+                    del self._connections[key]
+                    entry['connection'].close()
+                    self.evictions += 1
+
+    def close_all(self):
+        """Close all pooled connections."""
+        with self._lock:
+            connections, self._connections = self._connections, {}
+            self._leases.clear()
+        for entry in connections.values():
+            entry['connection'].close()
+
+    def stats(self):
+        """Pool hit/miss counters.
+
+        Returns:
+            Dictionary with hits, misses, evictions and number of open connections.
+
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'open': len(self._connections),
+            'in_use': sum(entry['in_use'] for entry in self._connections.values()),
+        }
+
+
+pool = ConnectionPool(
+    keepalive=int(os.getenv('SSH_KEEPALIVE', 30)),
+    idle_timeout=int(os.getenv('SSH_IDLE_TIMEOUT', 300)),
+)
+atexit.register(pool.close_all)
@@ -0,0 +1,144 @@
+import os
+import time
+
+from .base import LOCAL_PREFIX, REMOTE_PREFIX, do, env
+from .engine import get_engine, use_engine
+from .plan import unreplayable
+from .trace import span
+
+# Default seconds to wait for a service before giving up, the READY_TIMEOUT env var is read when waiting
+READY_TIMEOUT = 120
+
+
+def backoff(timeout, initial=0.1, maximum=2.0, factor=2.0):
+    """Yield the elapsed seconds, sleeping exponentially longer between iterations, until timeout has passed."""
+    start = time.perf_counter()
+    delay = initial
+    while True:
+        elapsed = time.perf_counter() - start
+        yield elapsed
+        if elapsed >= timeout:
+            return
+        time.sleep(min(delay, max(0.0, timeout - elapsed)))
+        delay = min(delay * factor, maximum)
+
+
+def container_state(ctx, container):
+    """Health and run state of a container.
+
+    Returns:
+        Tuple of the health status ('starting', 'healthy', 'unhealthy' or 'none' without a healthcheck) and whether
+        the container is running. ('missing', False) when it does not exist.
+
+    """
+    if use_engine(ctx):
+        from .engine import DockerAPIError
+
+        try:
+            state = get_engine().inspect(container)['State']
+        except DockerAPIError:
+            return 'missing', False
+        return (state.get('Health') or {}).get('Status', 'none'), state.get('Running', False)
+
+    result = do(ctx, "docker inspect --format '{{if .State.Health}}{{.State.Health.Status}}{{else}}none{{end}} "
+                     "{{.State.Running}}' " + container, hide=True, warn=True)
+    if not result.ok:
+        return 'missing', False
+    health, _, running = result.stdout.strip().partition(' ')
+    return health, running == 'true'
+
+
+def _wait_health_events(ctx, container, timeout):
+    # Returns the final health status as soon as the daemon reports it, None when no event arrived
+    if use_engine(ctx):
+        since = time.time() - 1
+        filters = {'container': [container], 'event': ['health_status']}
+        for event in get_engine().events(filters, since=since, until=time.time() + timeout):
+            status = event.get('status', '').rpartition(':')[2].strip()
+            if status in ('healthy', 'unhealthy'):
+                return status
+        return None
+
+    # `timeout` ends the stream when nothing happens, the events of the last second cover a change during inspect
+    events = do(ctx, f"timeout {int(timeout) + 1} docker events --since 1s --filter container={container} "
+                     f"--filter event=health_status --format '{{{{.Status}}}}'", stream=True, hide=True, warn=True)
+    try:
+        for line in events:
+            status = line.rpartition(':')[2].strip()
+            if status in ('healthy', 'unhealthy'):
+                return status
+    finally:
+        events.close()
+    return None
+
+
+def _wait_pg_isready(ctx, container, timeout, user='postgres'):
+    for _ in backoff(timeout):
+        if do(ctx, f'docker exec {container} pg_isready -q -U {user}', hide=True, warn=True).ok:
+            return True
+    return False
+
+
+def wait_ready(ctx, container, timeout=None, postgres=False):
+    """Wait until a container is ready and return how long that took.
+
+    Containers with a healthcheck are ready when docker reports them healthy, which is awaited with `docker events`
+    (or the Engine API) instead of polling. Postgres containers without a healthcheck are polled with `pg_isready`
+    with exponential backoff, other containers are ready once they run. Containers that are still being created or
+    restarting are polled with backoff until they run.
+
+    Args:
+        ctx: Run context.
+        container: Container name, e.g. 'project_postgres_1'
+        timeout: Default is the READY_TIMEOUT env var or 120 seconds.
+        postgres: Whether to wait for postgres to accept connections.
+
+    Returns:
+        Seconds waited.
+
+    Raises:
+        TimeoutError: When the container is not ready within timeout or reported unhealthy.
+
+    """
+    timeout = float(timeout or os.getenv('READY_TIMEOUT') or READY_TIMEOUT)
+    if env.dry_run:
+        prefix = REMOTE_PREFIX if getattr(ctx, 'host', False) else LOCAL_PREFIX
+        print(prefix, f'# wait until {container} is ready (timeout {timeout:.0f}s)')
+        unreplayable(f'wait until {container} is ready')
+        return 0.0
+
+    start = time.perf_counter()
+
+    def remaining():
+        return max(0.0, timeout - (time.perf_counter() - start))
+
+    with span(f'ready {container}', 'ready', container=container, timeout=timeout) as trace_args:
+        health, running = 'missing', False
+        for _ in backoff(timeout):
+            # The container can take a moment to be created and started after `compose up -d`
+            health, running = container_state(ctx, container)
+            if health != 'missing' and (running or health != 'none' or postgres):
+                break
+
+        if health == 'starting':
+            trace_args['method'] = 'events'
+            for _ in backoff(remaining()):
+                # The events only cover changes from a second before the wait, inspect again when none arrived
+                health = _wait_health_events(ctx, container, remaining()) or container_state(ctx, container)[0]
+                if health != 'starting':
+                    break
+        if health == 'none' and postgres:
+            trace_args['method'] = 'pg_isready'
+            if _wait_pg_isready(ctx, container, timeout - (time.perf_counter() - start)):
+                health = 'healthy'
+        elif health == 'none' and running:
+            trace_args['method'] = 'running'
+            health = 'healthy'
+
+        seconds = time.perf_counter() - start
+        trace_args.update(status=health, seconds=round(seconds, 3))
+    if health != 'healthy':
+        raise TimeoutError(f'{container} not ready after {seconds:.1f}s: '
+                           f'{"not running" if health == "none" and not running else health}')
+    print(f'{container} ready after {seconds:.1f}s')
+    return seconds
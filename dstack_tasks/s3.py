@@ -0,0 +1,392 @@
+import hashlib
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Multipart chunk size, parallel parts per transfer and bandwidth limit in bytes per second
+CHUNK_SIZE = int(os.getenv('S3_CHUNK_SIZE', 8 * 1024 * 1024))
+MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', 10))
+MAX_BANDWIDTH = int(os.getenv('S3_MAX_BANDWIDTH', 0)) or None
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(endpoint_url=None):
+    """Shared boto3 s3 client, so credentials are only looked up once per process.
+
+    Args:
+        endpoint_url: Defaults to the ENDPOINT_URL environmental variable, e.g. for MinIO or a local stand-in.
+
+    Returns:
+        botocore S3 client, which is thread safe.
+
+    """
+    endpoint_url = endpoint_url or os.getenv('ENDPOINT_URL') or None
+    with _lock:
+        if endpoint_url not in _clients:
+            import boto3
+            from botocore.config import Config
+
+            session = boto3.session.Session()
+            _clients[endpoint_url] = session.client(
+                's3', endpoint_url=endpoint_url, config=Config(max_pool_connections=max(MAX_CONCURRENCY, 10) * 2))
+        return _clients[endpoint_url]
+
+
+def transfer_config(chunk_size=None, max_concurrency=None, max_bandwidth=None):
+    """boto3 TransferConfig with the configured multipart chunk size, part concurrency and bandwidth limit."""
+    from boto3.s3.transfer import TransferConfig
+
+    chunk_size = int(chunk_size or CHUNK_SIZE)
+    options = dict(multipart_threshold=chunk_size, multipart_chunksize=chunk_size,
+                   max_concurrency=int(max_concurrency or MAX_CONCURRENCY))
+    max_bandwidth = max_bandwidth or MAX_BANDWIDTH
+    if max_bandwidth:
+        options['max_bandwidth'] = int(max_bandwidth)
+    return TransferConfig(**options)
+
+
+def split_uri(s3_uri):
+    """Bucket and key of an s3:// uri."""
+    bucket, _, key = s3_uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def upload_file(local_path, s3_uri, client=None, config=None):
+    """Upload a file. Like `aws s3 cp`, a uri ending in / is treated as a prefix."""
+    bucket, key = split_uri(s3_uri)
+    if not key or key.endswith('/'):
+        key += os.path.basename(local_path)
+    (client or get_client()).upload_file(local_path, bucket, key, Config=config or transfer_config())
+    return f'upload: {local_path} to s3://{bucket}/{key}'
+
+
+def download_file(s3_uri, local_path, client=None, config=None):
+    """Download an object. Like `aws s3 cp`, a local directory or path ending in / gets the object's name."""
+    bucket, key = split_uri(s3_uri)
+    if local_path.endswith(os.sep) or os.path.isdir(local_path):
+        local_path = os.path.join(local_path, os.path.basename(key))
+    directory = os.path.dirname(local_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    (client or get_client()).download_file(bucket, key, local_path, Config=config or transfer_config())
+    return f'download: s3://{bucket}/{key} to {local_path}'
+
+
+def _expected_sha256(client, bucket, key):
+    # Backups are uploaded with a `sha256sum` style sidecar object, see backup.stream_backup
+    try:
+        body = client.get_object(Bucket=bucket, Key=key + '.sha256')['Body'].read()
+    except client.exceptions.ClientError:
+        # Missing, or not readable without ListBucket permission
+        return None
+    return body.decode('utf-8').split()[0]
+
+
+def _file_digest(path, name):
+    digest = hashlib.new(name)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def download_ranged(s3_uri, local_path, client=None, part_size=None, workers=None, sha256=None):
+    """Download an object with concurrent ranged GETs into a preallocated file, resuming interrupted downloads.
+
+    The object is written to `{local_path}.part`, the finished parts are tracked in `{local_path}.part.json` and
+    only the missing parts are fetched when the download is started again for the same version (ETag) of the object.
+    The assembled file is verified before it is moved into place, against sha256, the `{key}.sha256` object of a
+    backup or otherwise the ETag of objects that were not uploaded in parts or encrypted with SSE-KMS or SSE-C.
+
+    Args:
+        s3_uri: The s3:// uri.
+        local_path: Target file, a directory or path ending in / gets the object's name.
+        client: Defaults to the shared client.
+        part_size: Default is S3_CHUNK_SIZE.
+        workers: Default is S3_MAX_CONCURRENCY.
+        sha256: Expected sha256 hex digest.
+
+    Returns:
+        Transfer message like `download_file`.
+
+    Raises:
+        ValueError: When the checksum of the downloaded file does not match.
+
+    """
+    client = client or get_client()
+    part_size = int(part_size or CHUNK_SIZE)
+    bucket, key = split_uri(s3_uri)
+    if local_path.endswith(os.sep) or os.path.isdir(local_path):
+        local_path = os.path.join(local_path, os.path.basename(key))
+    if os.path.dirname(local_path):
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+    head = client.head_object(Bucket=bucket, Key=key)
+    size, etag = head['ContentLength'], head['ETag']
+    encrypted = head.get('ServerSideEncryption') == 'aws:kms' or bool(head.get('SSECustomerAlgorithm'))
+    partial, state_path = local_path + '.part', local_path + '.part.json'
+    state = {'etag': etag, 'size': size, 'part_size': part_size, 'done': []}
+    try:
+        with open(state_path) as f:
+            saved = json.load(f)
+        if os.path.exists(partial) and all(saved.get(name) == state[name] for name in ('etag', 'size', 'part_size')):
+            state = saved
+    except (OSError, ValueError):
+        pass
+
+    if not state['done']:
+        with open(partial, 'wb') as f:
+            if hasattr(os, 'posix_fallocate') and size:
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+
+    done = set(state['done'])
+    parts = [i for i in range(max(1, -(-size // part_size))) if i not in done]
+    lock = threading.Lock()
+
+    def fetch(index):
+        start = index * part_size
+        end = min(start + part_size, size) - 1
+        if end >= start:
+            body = client.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end}', IfMatch=etag)['Body']
+            with open(partial, 'r+b') as f:
+                f.seek(start)
+                for block in iter(lambda: body.read(1024 * 1024), b''):
+                    f.write(block)
+        with lock:
+            done.add(index)
+            state['done'] = sorted(done)
+            with open(state_path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(state_path + '.tmp', state_path)
+
+    with ThreadPoolExecutor(max_workers=workers or MAX_CONCURRENCY) as executor:
+        list(executor.map(fetch, parts))
+
+    sha256 = sha256 or _expected_sha256(client, bucket, key)
+    if sha256:
+        verified = _file_digest(partial, 'sha256') == sha256
+    elif '-' not in etag.strip('"') and not encrypted:
+        verified = _file_digest(partial, 'md5') == etag.strip('"')
+    else:
+        # The ETag of a multipart upload or of an SSE-KMS or SSE-C encrypted object is not the md5 of the content
+        verified = os.path.getsize(partial) == size
+    if not verified:
+        os.remove(partial)
+        os.remove(state_path)
+        raise ValueError(f'Checksum mismatch for s3://{bucket}/{key}')
+
+    os.replace(partial, local_path)
+    os.remove(state_path)
+    return f'download: s3://{bucket}/{key} to {local_path}'
+
+
+def _download_synced(s3_uri, local_path, client=None, config=None):
+    # Like the AWS CLI, give synced files the modification time of the object so the next sync can skip them
+    message = download_file(s3_uri, local_path, client, config)
+    bucket, key = split_uri(s3_uri)
+    modified = (client or get_client()).head_object(Bucket=bucket, Key=key)['LastModified'].timestamp()
+    os.utime(local_path, (modified, modified))
+    return message
+
+
+def list_objects(bucket, prefix, client=None):
+    """Dictionary of key to object summary for all objects under prefix."""
+    paginator = (client or get_client()).get_paginator('list_objects_v2')
+    objects = {}
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            objects[item['Key']] = item
+    return objects
+
+
+def list_objects_parallel(bucket, prefix, client=None, delimiter='-', workers=None):
+    """Like `list_objects`, but lists the groups of keys that share a prefix up to delimiter concurrently.
+
+    One delimited listing finds the groups, e.g. `backup_2024-` and `backup_2025-` for timestamped keys, and each
+    group is then paginated in its own thread.
+    """
+    client = client or get_client()
+    paginator = client.get_paginator('list_objects_v2')
+    objects = {}
+    groups = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter=delimiter):
+        for item in page.get('Contents', []):
+            objects[item['Key']] = item
+        groups.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+
+    with ThreadPoolExecutor(max_workers=workers or MAX_CONCURRENCY) as executor:
+        for group in executor.map(lambda group_prefix: list_objects(bucket, group_prefix, client), groups):
+            objects.update(group)
+    return objects
+
+
+def sync(local_path, s3_uri, direction='up', exact_timestamps=False, client=None, config=None):
+    """Copy new and changed files between a directory and a prefix, like `aws s3 sync`.
+
+    Files are compared on size and modification time. Transfers run in parallel.
+
+    Returns:
+        List of transfer messages.
+
+    """
+    client = client or get_client()
+    config = config or transfer_config()
+    bucket, prefix = split_uri(s3_uri)
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    remote = list_objects(bucket, prefix, client)
+
+    jobs = []
+    if direction == 'up':
+        for root, _, files in os.walk(local_path):
+            for name in files:
+                path = os.path.join(root, name)
+                key = prefix + os.path.relpath(path, local_path).replace(os.sep, '/')
+                stat = os.stat(path)
+                item = remote.get(key)
+                # Listings have whole second timestamps, a file uploaded in the second it was written is not newer
+                if item is None or item['Size'] != stat.st_size or \
+                        int(stat.st_mtime) > item['LastModified'].timestamp():
+                    jobs.append((upload_file, path, f's3://{bucket}/{key}'))
+    else:
+        for key, item in remote.items():
+            if key.endswith('/'):
+                continue
+            path = os.path.join(local_path, *key[len(prefix):].split('/'))
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                jobs.append((_download_synced, f's3://{bucket}/{key}', path))
+                continue
+            remote_mtime = item['LastModified'].timestamp()
+            changed = stat.st_mtime != remote_mtime if exact_timestamps else stat.st_mtime < remote_mtime
+            if item['Size'] != stat.st_size or changed:
+                jobs.append((_download_synced, f's3://{bucket}/{key}', path))
+
+    with ThreadPoolExecutor(max_workers=config.max_request_concurrency) as executor:
+        futures = [executor.submit(func, source, target, client, config) for func, source, target in jobs]
+        return [future.result() for future in futures]
+
+
+def transfer(cmd, direction, local_path, s3_uri, exact_timestamps=False, cwd=None):
+    """In-process equivalent of the `aws s3 cp/sync` command built by `wrap.s3cmd`.
+
+    Args:
+        cmd: `cp` or `sync`.
+        direction: `up` or `down`.
+        local_path: Local file or directory, relative to cwd.
+        s3_uri: The s3:// uri.
+        exact_timestamps: Only used by sync.
+        cwd: Directory that local_path is relative to.
+
+    Returns:
+        invoke.runners.Result with a line per transferred file as stdout.
+
+    """
+    from invoke.runners import Result
+
+    if cwd and not os.path.isabs(local_path):
+        # Keep a trailing / which marks a directory target
+        local_path = os.path.join(cwd, local_path)
+
+    if cmd == 'sync':
+        messages = sync(local_path, s3_uri, direction, exact_timestamps)
+    elif cmd == 'cp':
+        if direction == 'up':
+            messages = [upload_file(local_path, s3_uri)]
+        else:
+            # Concurrent ranged GETs with resume and checksum verification
+            messages = [download_ranged(s3_uri, local_path)]
+    else:
+        raise ValueError(f'Unsupported s3 command: {cmd}')
+
+    return Result(stdout=''.join(message + '\n' for message in messages), command=f'aws s3 {cmd}', exited=0)
+
+
+class ChunkReader(io.RawIOBase):
+    """Read-only binary file object over an iterable of str or bytes chunks.
+
+    Lets boto3 stream generators, text files and other chunked content into a (multipart) upload without
+    holding the full body in memory. Text chunks are encoded as UTF-8.
+    """
+
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # Fill the whole buffer: boto3 reads the multipart threshold once to decide on a multipart upload and would
+        # otherwise send a streamed dump as one PutObject held in memory
+        view = memoryview(buffer)
+        filled = 0
+        while filled < len(view):
+            if not self._buffer:
+                try:
+                    chunk = next(self._chunks)
+                except StopIteration:
+                    break
+                self._buffer = chunk.encode('utf-8') if isinstance(chunk, str) else bytes(chunk)
+                continue
+            size = min(len(view) - filled, len(self._buffer))
+            view[filled:filled + size] = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+            filled += size
+        return filled
+
+
+def _text_chunks(text, size=CHUNK_SIZE):
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+def as_fileobj(content):
+    """Binary file object for str, bytes, a path, a text or binary file object or an iterable of chunks.
+
+    Plain strings are treated as content, use a `pathlib.Path` to upload a file.
+
+    Returns:
+        Tuple of the file object and whether the caller should close it.
+
+    """
+    if isinstance(content, str):
+        return ChunkReader(_text_chunks(content)), True
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        return io.BytesIO(content), True
+    if isinstance(content, os.PathLike):
+        return open(content, 'rb'), True
+    if hasattr(content, 'read'):
+        if isinstance(content, io.TextIOBase) or 'b' not in getattr(content, 'mode', 'b'):
+            return ChunkReader(iter(lambda: content.read(CHUNK_SIZE), '')), False
+        return content, False
+    return ChunkReader(content), True
+
+
+def upload_stream(content, bucket, key, client=None, config=None, extra_args=None):
+    """Stream content to an object, using multipart upload for content larger than the chunk size.
+
+    Args:
+        content: str, bytes, path, file object or iterable of str/bytes chunks, see `as_fileobj`.
+        bucket: The S3 bucket.
+        key: The object key.
+        client: Defaults to the shared client.
+        config: Defaults to `transfer_config()`.
+        extra_args: e.g. {'Metadata': {...}, 'ContentType': 'text/plain'}
+
+    """
+    fileobj, close = as_fileobj(content)
+    try:
+        (client or get_client()).upload_fileobj(fileobj, bucket, key, Config=config or transfer_config(),
+                                                ExtraArgs=extra_args)
+    finally:
+        if close:
+            fileobj.close()
@@ -42,8 +42,8 @@ def machine_create(ctx, name, driver='digitalocean', username='ubuntu', user_id=
 
 @task
 def machine_info(ctx, name):
-    hostname = machine(ctx, f'ssh {name} hostname --fqdn', hide=True).stdout.strip('\n')
-    username = machine(ctx, f'ssh {name} whoami', hide=True).stdout.strip('\n')
+    hostname = machine(ctx, f'ssh {name} hostname --fqdn', hide=True, ttl=300).stdout.strip('\n')
+    username = machine(ctx, f'ssh {name} whoami', hide=True, ttl=300).stdout.strip('\n')
     ip, status = machine_status(ctx, name=name)
     if status == 'Running':
         send_alert(ctx,
@@ -52,19 +52,20 @@ def machine_info(ctx, name):
 
 
 @task
-def machine_status(ctx, name='default'):
+def machine_status(ctx, name='default', ttl=30):
     """Attempts to parse docker-machine ip, config and machine_status to get
     the path to the key file and the ip address.
 
     Args:
         ctx: instance of invoke.Context
         name: The name of the machine.
+        ttl: Default = 30. Seconds to reuse the result of a previous check, see cache.py.
 
     Returns: ip, status
 
     """
-    ip = machine(ctx, f'ip {name}').stdout.strip('\n')
-    status = machine(ctx, f'status {name}').stdout.strip('\n')
+    ip = machine(ctx, f'ip {name}', ttl=ttl).stdout.strip('\n')
+    status = machine(ctx, f'status {name}', ttl=ttl).stdout.strip('\n')
     return ip, status
 
 
@@ -92,7 +93,7 @@ def create_ssh_config(ctx, name, write=False):
     Returns:
 
     """
-    result = machine(ctx, f'inspect {name}', hide=True)
+    result = machine(ctx, f'inspect {name}', hide=True, ttl=60)
     if not env.dry_run:
         config = json.loads(result.stdout)
         home = os.path.expanduser('~')
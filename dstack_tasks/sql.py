@@ -0,0 +1,149 @@
+import io
+import uuid
+
+from .base import env
+
+# psql flags: no psqlrc, quiet, unaligned output with NUL separated fields and no footers, stop at the first error
+PSQL_FLAGS = '-X -q -A -z -P footer=off -v ON_ERROR_STOP=1'
+
+
+def literal(value):
+    """Quote a value as an SQL literal, e.g. literal("it's") == "'it''s'"."""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class Query(object):
+    """A statement in a Session, its rows are available once the session has run."""
+
+    def __init__(self, sql):
+        self.sql = sql.strip().rstrip(';')
+        self.columns = []
+        self.rows = []
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def scalar(self):
+        """The first column of the first row, or None."""
+        return next(iter(self.rows[0].values())) if self.rows and self.columns else None
+
+    def _parse(self, lines):
+        if not lines:
+            return
+        self.columns = lines[0].split('\x00')
+        self.rows = [dict(zip(self.columns, line.split('\x00'))) for line in lines[1:]]
+
+
+class Session(object):
+    """Many SQL statements sent to psql through a single `docker-compose exec`.
+
+    Statements are queued and sent on stdin as a script (`psql -f -`) when the session runs, so nothing is
+    interpolated into a shell command and a whole setup or check costs one exec. In dry run mode the script is printed
+    and recorded with the command in a plan, see plan.py. Each statement's output is parsed into rows of column name
+    to text value, NULL is an empty string. Values must not contain newlines.
+
+    Args:
+        ctx: Run context.
+        service: The postgres compose service.
+        user: Database user.
+        database: Default is the user's database.
+        single_transaction: Run all statements in one transaction. Not possible for e.g. CREATE DATABASE.
+
+    Examples:
+        with Session(ctx) as session:
+            session.execute('CREATE TABLE IF NOT EXISTS backup_log (tag VARCHAR(255))')
+            tags = session.query('SELECT tag FROM backup_log')
+        print([row['tag'] for row in tags])
+
+    """
+
+    def __init__(self, ctx, service='postgres', user='postgres', database=None, single_transaction=False):
+        self.ctx = ctx
+        self.service = service
+        self.user = user
+        self.database = database
+        self.single_transaction = single_transaction
+        self.queries = []
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.run()
+
+    def execute(self, sql):
+        """Queue a statement.
+
+        Returns:
+            Query with the rows once the session has run.
+
+        """
+        query = Query(sql)
+        self.queries.append(query)
+        return query
+
+    query = execute
+
+    def script(self, token):
+        """The psql input, every statement is preceded by a marker line to split the output."""
+        lines = []
+        for i, query in enumerate(self.queries):
+            lines.append(f'\\echo __DSTACK_SQL_{token}_{i}__')
+            lines.append(query.sql + ';')
+        return '\n'.join(lines) + '\n'
+
+    def command(self):
+        # psql only honours --single-transaction for scripts given with -c or -f
+        flags = PSQL_FLAGS + (' -1' if self.single_transaction else '')
+        database = f' -d {self.database}' if self.database else ''
+        return f'exec -T {self.service} psql -U {self.user}{database} {flags} -f -'
+
+    def run(self, **kwargs):
+        """Send the queued statements and parse the output of each.
+
+        Args:
+            **kwargs: Passed on to `compose`, e.g. warn or host.
+
+        Returns:
+            List of Query
+
+        Raises:
+            invoke.exceptions.UnexpectedExit: When a statement fails, later statements are not run.
+
+        """
+        from .wrap import compose
+
+        if not self.queries:
+            return []
+        token = uuid.uuid4().hex[:8]
+        script = self.script(token)
+        # Cached results are keyed by the command, which is the same for every script
+        kwargs.pop('ttl', None)
+        kwargs.setdefault('hide', True)
+        self.result = compose(self.ctx, self.command(), in_stream=io.StringIO(script), **kwargs)
+        if env.dry_run:
+            print(script, end='')
+            return self.queries
+
+        sections = {}
+        current = None
+        for line in self.result.stdout.splitlines():
+            if line.startswith(f'__DSTACK_SQL_{token}_') and line.endswith('__'):
+                current = int(line[len(f'__DSTACK_SQL_{token}_'):-2])
+                sections[current] = []
+            elif current is not None:
+                sections[current].append(line)
+        for i, query in enumerate(self.queries):
+            query._parse(sections.get(i, []))
+        return self.queries
@@ -0,0 +1,210 @@
+import fnmatch
+import hashlib
+import json
+import os
+import posixpath
+import shlex
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+from .s3 import MAX_CONCURRENCY, get_client, list_objects, transfer_config
+
+# Per directory cache of file hashes keyed on size and modification time
+LOCAL_MANIFEST = '.static_manifest.json'
+
+
+def file_hash(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_manifest(root, exclude=()):
+    """Manifest of all files under root.
+
+    Hashes are reused from the local manifest cache for files whose size and modification time did not change.
+
+    Args:
+        root: The static directory.
+        exclude: Glob patterns of relative paths to leave out, e.g. ['*.less', 'ckeditor/*']
+
+    Returns:
+        Dictionary of relative posix path to {'hash': sha256, 'size': bytes}
+
+    """
+    cache_path = os.path.join(root, LOCAL_MANIFEST)
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    manifest = {}
+    local_cache = {}
+    for directory, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, root).replace(os.sep, '/')
+            if relative == LOCAL_MANIFEST or any(fnmatch.fnmatch(relative, pattern) for pattern in exclude):
+                continue
+            info = os.stat(path)
+            cached = cache.get(relative)
+            if cached and cached['size'] == info.st_size and cached['mtime'] == info.st_mtime_ns:
+                digest = cached['hash']
+            else:
+                digest = file_hash(path)
+            manifest[relative] = {'hash': digest, 'size': info.st_size}
+            local_cache[relative] = {'hash': digest, 'size': info.st_size, 'mtime': info.st_mtime_ns}
+
+    try:
+        with open(cache_path, 'w') as f:
+            json.dump(local_cache, f)
+    except OSError:
+        pass
+    return manifest
+
+
+def object_key(prefix, digest):
+    return f'{prefix}/objects/{digest[:2]}/{digest}'
+
+
+def manifest_key(prefix, version):
+    return f'{prefix}/manifests/static_v{version}.json'
+
+
+def read_manifest(bucket, prefix, version, client=None):
+    """The manifest of a released version, see `build_manifest`."""
+    client = client or get_client()
+    body = client.get_object(Bucket=bucket, Key=manifest_key(prefix, version))['Body'].read()
+    return json.loads(body.decode('utf-8'))
+
+
+def upload_static(root, bucket, prefix, version, workers=None, exclude=()):
+    """Upload the files under root that are not in the bucket yet, followed by the manifest of the version.
+
+    Objects are stored by content hash under `{prefix}/objects/`, so unchanged files are never uploaded twice.
+
+    Args:
+        root: The static directory, e.g. '.local/static'
+        bucket: The S3 bucket.
+        prefix: Key prefix, e.g. '{project}/static'
+        version: The release version.
+        workers: Number of parallel uploads. Defaults to S3_MAX_CONCURRENCY.
+        exclude: Glob patterns of relative paths to leave out.
+
+    Returns:
+        Tuple of number of files and bytes uploaded.
+
+    """
+    client = get_client()
+    config = transfer_config()
+    manifest = build_manifest(root, exclude)
+    existing = list_objects(bucket, f'{prefix}/objects/', client)
+
+    missing = {}
+    for relative, entry in manifest.items():
+        key = object_key(prefix, entry['hash'])
+        if key not in existing:
+            missing[key] = (os.path.join(root, *relative.split('/')), entry['size'])
+
+    def _upload(key):
+        client.upload_file(missing[key][0], bucket, key, Config=config)
+
+    with ThreadPoolExecutor(max_workers=int(workers or MAX_CONCURRENCY)) as executor:
+        list(executor.map(_upload, missing))
+
+    client.put_object(Bucket=bucket, Key=manifest_key(prefix, version),
+                      Body=json.dumps(manifest, sort_keys=True).encode('utf-8'), ContentType='application/json')
+    return len(missing), sum(size for _, size in missing.values())
+
+
+def deploy_static(root, bucket, prefix, version, workers=None):
+    """Download the files of a version's manifest that differ from what is in root.
+
+    Files are written to a temporary name and renamed, so a failed deploy never leaves partial files. Directories
+    get mode 755 and files 644, like the chmod done after extracting the tarball.
+
+    Args:
+        root: The static directory, e.g. '.local/static'
+        bucket: The S3 bucket.
+        prefix: Key prefix, e.g. '{project}/static'
+        version: The release version.
+        workers: Number of parallel downloads. Defaults to S3_MAX_CONCURRENCY.
+
+    Returns:
+        Tuple of number of files and bytes downloaded.
+
+    """
+    client = get_client()
+    config = transfer_config()
+    manifest = read_manifest(bucket, prefix, version, client)
+    os.makedirs(root, exist_ok=True)
+    current = build_manifest(root)
+
+    changed = [relative for relative, entry in manifest.items() if current.get(relative) != entry]
+
+    def _download(relative):
+        path = os.path.join(root, *relative.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.part'
+        client.download_file(bucket, object_key(prefix, manifest[relative]['hash']), temp_path, Config=config)
+        os.replace(temp_path, path)
+
+    with ThreadPoolExecutor(max_workers=int(workers or MAX_CONCURRENCY)) as executor:
+        list(executor.map(_download, changed))
+
+    file_mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
+    for directory, directories, files in os.walk(root):
+        os.chmod(directory, file_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        for name in files:
+            os.chmod(os.path.join(directory, name), file_mode)
+
+    # Refresh the local hash cache with the new files
+    build_manifest(root)
+    return len(changed), sum(manifest[relative]['size'] for relative in changed)
+
+
+def checksum_command(root):
+    """Command that prints the `sha256sum` of every file under root on a host, creating root if it is missing."""
+    root = shlex.quote(root)
+    return (f"mkdir -p {root} && cd {root} && find . -type f ! -name '*.part' ! -name {LOCAL_MANIFEST} "
+            f"-exec sha256sum {{}} +")
+
+
+def parse_checksums(output):
+    """Dictionary of relative posix path to sha256 from the output of `checksum_command`."""
+    checksums = {}
+    for line in output.splitlines():
+        digest, _, path = line.partition('  ')
+        if path:
+            checksums[path[2:] if path.startswith('./') else path] = digest
+    return checksums
+
+
+def download_script(manifest, checksums, root, bucket, prefix):
+    """Shell script that downloads the files of a manifest that differ from the files on a host, see `deploy_static`.
+
+    Args:
+        manifest: The version's manifest, see `read_manifest`.
+        checksums: Hashes of the files on the host, see `parse_checksums`.
+        root: The static directory on the host.
+        bucket: The S3 bucket.
+        prefix: Key prefix, e.g. '{project}/static'
+
+    Returns:
+        Tuple of the script, number of files and bytes it downloads.
+
+    """
+    changed = [relative for relative, entry in sorted(manifest.items()) if checksums.get(relative) != entry['hash']]
+    lines = ['set -e']
+    for relative in changed:
+        path = posixpath.join(root, relative)
+        source = shlex.quote(f's3://{bucket}/{object_key(prefix, manifest[relative]["hash"])}')
+        lines.append(f'mkdir -p {shlex.quote(posixpath.dirname(path))}')
+        lines.append(f'aws s3 cp --quiet {source} {shlex.quote(path + ".part")} && '
+                     f'mv {shlex.quote(path + ".part")} {shlex.quote(path)}')
+    lines.append(f'find {shlex.quote(root)} -type d -exec chmod 755 {{}} +')
+    lines.append(f'find {shlex.quote(root)} -type f -exec chmod 644 {{}} +')
+    return '\n'.join(lines) + '\n', len(changed), sum(manifest[relative]['size'] for relative in changed)
@@ -0,0 +1,250 @@
+import codecs
+import collections
+import functools
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+from .base import shell_command
+from .parallel import labelled_streams
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _hides(hide, stream):
+    # stream is 'stdout' or 'stderr', invoke also accepts 'out' and 'err'
+    return hide in (True, 'both', stream, stream[3:])
+
+
+def _kill_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # Already exited
+        pass
+
+
+def _drain_stderr(read, tail, out):
+    # Keep the tail of stderr and pass it on to out unless it is hidden
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    partial = ''
+    while True:
+        chunk = read(CHUNK_SIZE)
+        text = decoder.decode(chunk, final=not chunk)
+        if text and out is not None:
+            out.write(text)
+        lines = (partial + text).split('\n')
+        partial = lines.pop()
+        tail.extend(line + '\n' for line in lines)
+        if not chunk:
+            break
+    if partial:
+        tail.append(partial)
+
+
+class CommandStream(object):
+    """Output of a running command, read incrementally with bounded memory.
+
+    Unlike `invoke.Context.run`, which keeps the full output in memory, only the last `tail` lines of stdout and
+    stderr are kept for the result and error reports. Iterating over a CommandStream yields stdout line by line.
+
+    Args:
+        runner: invoke Context for local commands or fabric Connection for remote commands.
+        cmd: The command to execute.
+        path: Directory to run the command in.
+        run_env: Environmental variables for the command.
+        sudo: Whether to run the command with non-interactive sudo.
+        local: Whether to run the command locally even if runner is a fabric Connection.
+        tail: Default = 100. Number of lines of stdout and stderr to keep.
+        hide: Whether to hide stdout/stderr, same values as invoke's `hide`.
+        warn: Whether to return a failed result instead of raising UnexpectedExit.
+        on_close: Called once with the result when the command has finished, or with None when it was closed early.
+
+    Examples:
+        for line in do(ctx, 'docker logs -f django', stream=True):
+            if 'ERROR' in line:
+                print(line)
+
+    """
+
+    def __init__(self, runner, cmd, path=None, run_env=None, sudo=False, local=False, tail=100, hide=None,
+                 warn=False, on_close=None):
+        self.command = cmd
+        self.hide = hide
+        self.warn = warn
+        self._on_close = on_close
+        self.stdout_tail = collections.deque(maxlen=int(tail) if tail else None)
+        self.stderr_tail = collections.deque(maxlen=int(tail) if tail else None)
+        self.bytes_read = 0
+        self.lines_read = 0
+        self._result = None
+        streams = labelled_streams()
+        self._out = streams.get('out_stream', sys.stdout)
+        self._err = streams.get('err_stream', sys.stderr)
+
+        if hasattr(runner, 'client') and not local:
+            self._start_remote(runner, shell_command(cmd, path, run_env, sudo))
+        else:
+            self._start_local(shell_command(cmd, sudo=sudo), path, run_env)
+
+        # The reader thread doesn't reference the stream, so an abandoned stream can be garbage collected and closed
+        self._stopped = False
+        err = None if _hides(hide, 'stderr') else self._err
+        self._stderr_thread = threading.Thread(target=_drain_stderr, args=(self._read_stderr, self.stderr_tail, err),
+                                               daemon=True)
+        self._stderr_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, '_stderr_thread', None) is not None:
+            self.close()
+
+    def _start_local(self, cmd, path, run_env):
+        process_env = dict(os.environ, **{k: str(v) for k, v in (run_env or {}).items()})
+        shell = '/bin/bash' if os.path.exists('/bin/bash') else None
+        # In its own process group, so that close() also stops the children of the shell which keep the pipes open
+        self._process = subprocess.Popen(cmd, shell=True, executable=shell, cwd=path or None, env=process_env,
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        self._read = self._process.stdout.read1
+        self._read_stderr = self._process.stderr.read1
+        self._wait = self._process.wait
+        self._kill = functools.partial(_kill_group, self._process)
+        self._reap = self._process.wait
+
+    def _start_remote(self, connection, cmd):
+        connection.open()
+        channel = connection.client.get_transport().open_session()
+        channel.exec_command(cmd)
+        self._read = channel.recv
+        self._read_stderr = channel.recv_stderr
+        self._wait = channel.recv_exit_status
+        self._kill = channel.close
+        # A closed channel gets no exit status, there is no process to wait for
+        self._reap = lambda: None
+
+    def chunks(self):
+        """Yield stdout as raw bytes as soon as it is available."""
+        try:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            partial = ''
+            while True:
+                chunk = self._read(CHUNK_SIZE)
+                if chunk:
+                    self.bytes_read += len(chunk)
+                    yield chunk
+                # Keep track of the tail
+                lines = (partial + decoder.decode(chunk, final=not chunk)).split('\n')
+                partial = lines.pop()
+                self.lines_read += len(lines)
+                self.stdout_tail.extend(line + '\n' for line in lines)
+                if not chunk:
+                    break
+            if partial:
+                self.lines_read += 1
+                self.stdout_tail.append(partial)
+            self._finish()
+        finally:
+            if self._result is None:
+                # The consumer stopped reading early
+                self.close()
+
+    def lines(self):
+        """Yield stdout line by line, without line endings."""
+        try:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            partial = ''
+            hide_out = _hides(self.hide, 'stdout')
+            while True:
+                chunk = self._read(CHUNK_SIZE)
+                self.bytes_read += len(chunk)
+                lines = (partial + decoder.decode(chunk, final=not chunk)).split('\n')
+                partial = lines.pop()
+                for line in lines:
+                    self.lines_read += 1
+                    self.stdout_tail.append(line + '\n')
+                    if not hide_out:
+                        self._out.write(line + '\n')
+                    yield line
+                if not chunk:
+                    break
+            if partial:
+                self.lines_read += 1
+                self.stdout_tail.append(partial)
+                if not hide_out:
+                    self._out.write(partial + '\n')
+                yield partial
+            self._finish()
+        finally:
+            if self._result is None:
+                # The consumer stopped reading early
+                self.close()
+
+    __iter__ = lines
+
+    def _finish(self):
+        from invoke.exceptions import UnexpectedExit
+        from invoke.runners import Result
+
+        exited = self._wait()
+        self._stderr_thread.join()
+        hide = tuple(stream for stream in ('stdout', 'stderr') if _hides(self.hide, stream))
+        self._result = Result(stdout=''.join(self.stdout_tail), stderr=''.join(self.stderr_tail),
+                              command=self.command, exited=exited, hide=hide)
+        # Counters for the trace, see trace.record_result
+        self._result.bytes_read = self.bytes_read
+        self._result.lines_read = self.lines_read
+        self._closed(self._result)
+        if exited != 0 and not self.warn:
+            raise UnexpectedExit(self._result)
+
+    def _closed(self, result):
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close(result)
+
+    def run(self, on_line=None, on_chunk=None):
+        """Read all output, passing it to the callbacks, and return the result.
+
+        Args:
+            on_line: Called with each line of stdout, without line ending.
+            on_chunk: Called with each chunk of stdout as bytes. Takes precedence over on_line.
+
+        Returns:
+            invoke.runners.Result with only the tail of stdout and stderr.
+
+        """
+        if on_chunk is not None:
+            for chunk in self.chunks():
+                on_chunk(chunk)
+        else:
+            for line in self.lines():
+                if on_line is not None:
+                    on_line(line)
+        return self.result
+
+    def close(self):
+        """Stop a command that is still running, e.g. `docker events` once the awaited event was seen.
+
+        Waits for the command to exit and calls `on_close` with None. Streams are also closed when the iteration over
+        their output stops early, when they are used as a context manager and when they are garbage collected.
+        """
+        if self._result is None and not self._stopped:
+            self._stopped = True
+            self._kill()
+            self._reap()
+            self._stderr_thread.join()
+            self._closed(None)
+
+    @property
+    def result(self):
+        """The result once all output has been read."""
+        if self._result is None:
+            raise RuntimeError(f'Command output has not been read yet: {self.command}')
+        return self._result
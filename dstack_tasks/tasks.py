@@ -1,15 +1,22 @@
 import os
-import time
 from datetime import datetime
 import posixpath
 
 from dotenv import set_key
 from invoke import task
-from setuptools_scm import get_version
 
+from .backup import backup_to_s3, dedup_backup, dedup_restore, dump_chunks, parallel_backup, parallel_restore
 from .base import LOCAL_PREFIX, REMOTE_PREFIX, do, env
+from .batch import batch
+from .catalog import find_backup, record_backup
+from .dag import Pipeline
+from .engine import get_engine, use_engine
 from .notify import send_alert
-from .wrap import compose, docker, git, python, s3cmd
+from .plan import unreplayable
+from .ready import wait_ready
+from .sql import Session, literal
+from .utils import strtobool
+from .wrap import compose, compose_deploy, docker, git, python, s3cmd
 
 
 @task
@@ -19,14 +26,20 @@ def test(ctx, cmd='uname -a', path='.'):
 
 # TODO: See what invoke did in their release task that requires a specific branch
 @task
-def release_code(ctx, project_name=None, version=None, upload=True, push=False, static=True, build=True):
+def release_code(ctx, project_name=None, version=None, upload=True, push=False, static=True, build=True, workers=4,
+                 static_sync=False):
     """Tag, build and optionally push and upload new project release
 
+    The release is run as a dependency graph, see dag.py, so the static assets are built and uploaded while the
+    wheel is being built and uploaded. With `static_sync` only changed static files are uploaded instead of a
+    tarball, see `static_sync`.
+
     """
     # TODO set project name in ctx
     project_name = project_name or os.path.basename(os.getcwd()).replace('-', '_')
-    scm_version = get_version()
+    scm_version = env.version
     version = version or '.'.join(scm_version.split('.')[:3])
+    pipeline = Pipeline(ctx, workers=workers)
 
     if build:
         print(f'Git version: {scm_version}')
@@ -35,34 +48,54 @@ def release_code(ctx, project_name=None, version=None, upload=True, push=False,
             return False
 
         if scm_version != version:
-            git(ctx, f'tag v{version}')
+            pipeline.step('tag', git, f'tag v{version}')
 
         # Clean and build
-        do(ctx, cmd='rm -rf build/')
-        python(ctx, cmd='setup.py bdist_wheel', conda_env=True)
+        pipeline.step('clean', do, cmd='rm -rf build/')
+        pipeline.step('wheel', python, cmd='setup.py bdist_wheel', conda_env=True, deps=['tag', 'clean'])
 
     if push:
-        git(ctx, f'push origin v{version}')
+        pipeline.step('push', git, f'push origin v{version}', deps=['tag'])
 
     if upload:
-        s3cmd(ctx,
-              simple_path=f'dist/{project_name}-{version}-py3-none-any.whl', direction='up', project_name=project_name)
+        pipeline.step('upload-wheel', s3cmd,
+                      simple_path=f'dist/{project_name}-{version}-py3-none-any.whl', direction='up',
+                      project_name=project_name, deps=['wheel'])
 
     if static:
         excludes = '--exclude=' + ' --exclude='.join(['"*.less"', '"*.md"', '"ckeditor/"'])
-        try:
-            do(ctx, f'webpack', path='src/assets/')
-        except Exception:
-            pass
-        python(ctx, f'./src/manage.py collectstatic --no-input -v0', conda_env=True)
+        pipeline.step('webpack', _webpack)
+        pipeline.step('collectstatic', python, f'./src/manage.py collectstatic --no-input -v0', conda_env=True,
+                      deps=['webpack'])
         # do(ctx, f'rm -rf .local/static/ckeditor/')
-        do(ctx, f'tar -zcvf .local/static_v{version}.tar.gz {excludes} -C .local/static/ .')
-        if upload:
-            s3cmd(ctx, local_path=f'.local/static_v{version}.tar.gz', s3_path=f'{project_name}/static/')
+        if static_sync:
+            if upload:
+                pipeline.step('sync-static', static_sync_task, version, project=project_name, deps=['collectstatic'])
+        else:
+            pipeline.step('tar-static', do,
+                          f'tar -zcvf .local/static_v{version}.tar.gz {excludes} -C .local/static/ .',
+                          deps=['collectstatic'])
+            if upload:
+                pipeline.step('upload-static', s3cmd, local_path=f'.local/static_v{version}.tar.gz',
+                              s3_path=f'{project_name}/static/', deps=['tar-static'])
+
+    try:
+        pipeline.run()
+    finally:
+        if not env.dry_run:
+            print(pipeline.report())
+
+
+def _webpack(ctx):
+    try:
+        do(ctx, f'webpack', path='src/assets/')
+    except Exception:
+        pass
 
 
 @task
-def deploy_code(ctx, version, download=False, build=True, static=False, migrate=False, project=None, bucket=None):
+def deploy_code(ctx, version, download=False, build=True, static=False, migrate=False, project=None, bucket=None,
+                static_sync=False, services='django', parallel=None):
     project = project or ctx['project_name']
     bucket = bucket or ctx['bucket_name']
 
@@ -78,38 +111,111 @@ def deploy_code(ctx, version, download=False, build=True, static=False, migrate=
     stack_path = path.abspath(path.join(ctx.dir, stack_path))
     local_path = path.abspath(path.join(ctx.dir, local_path))
 
-    # Update the env files
-    do(ctx, f'sed -i.bak "s/^VERSION=.*/VERSION={version}/g" {path.join(ctx.dir, ".env")}')
-    do(ctx, f'sed -i.bak "s/^VERSION=.*/VERSION={version}/g" {path.join(stack_path, ".env")}')
-    do(ctx, f'sed -i.bak "s/^PACKAGE_NAME=.*/PACKAGE_NAME=toolset-{version}-py3-none-any.whl/g" {path.join(stack_path, ".env")}')
-    if download:
-        do(ctx, f'aws s3 cp --quiet s3://{bucket}/{project}/dist/{project}-{version}-py3-none-any.whl {stack_path}/')
-    if static:
+    if static and static_sync and not download:
+        raise ValueError('Static sync downloads the static files, use it together with download')
+
+    # Independent file operations are sent to the host as a single script
+    with batch(ctx):
+        # Update the env files
+        do(ctx, f'sed -i.bak "s/^VERSION=.*/VERSION={version}/g" {path.join(ctx.dir, ".env")}')
+        do(ctx, f'sed -i.bak "s/^VERSION=.*/VERSION={version}/g" {path.join(stack_path, ".env")}')
+        do(ctx, f'sed -i.bak "s/^PACKAGE_NAME=.*/PACKAGE_NAME=toolset-{version}-py3-none-any.whl/g" {path.join(stack_path, ".env")}')
         if download:
-            do(ctx, f'aws s3 cp --quiet s3://{bucket}/{project}/static/static_v{version}.tar.gz {local_path}')
-        do(ctx, f'tar -zvxf static_v{version}.tar.gz -C static/', path=local_path)
-        do(ctx, f'find {local_path}static/ -type d -exec chmod 755 {{}} \\;')
-        do(ctx, f'find {local_path}static/ -type f -exec chmod 644 {{}} \\;')
+            s3cmd(ctx, direction='down', bucket=bucket, s3_path=f'{project}/dist/{project}-{version}-py3-none-any.whl',
+                  local_path=f'{stack_path}/')
+        if static and not static_sync:
+            if download:
+                s3cmd(ctx, direction='down', bucket=bucket, s3_path=f'{project}/static/static_v{version}.tar.gz',
+                      local_path=local_path)
+            do(ctx, f'tar -zvxf static_v{version}.tar.gz -C static/', path=local_path)
+            do(ctx, f'find {local_path}static/ -type d -exec chmod 755 {{}} \\;')
+            do(ctx, f'find {local_path}static/ -type f -exec chmod 644 {{}} \\;')
+
+    if static and static_sync:
+        # Only fetches the files that changed, see static.py. Runs after the batched commands above.
+        static_sync_task(ctx, version, direction='down', project=project, bucket=bucket,
+                         static_path=path.join(local_path, 'static'))
 
     if build:
         del os.environ['VERSION']
-        compose(ctx, cmd='build django')
-        compose(ctx, cmd='up -d django')
-        # compose(ctx, cmd='up -d celery_worker celery_camera')
+        compose_deploy(ctx, services, parallel=parallel)
+        for service in services.split():
+            wait_ready(ctx, f'{project}_{service}_1')
 
     if migrate:
         db(ctx, 'backup', sync=True)
         compose(ctx, cmd=f'exec django {project} migrate')
 
 
+# Files left out of static releases
+STATIC_EXCLUDES = ['*.less', '*.md', 'ckeditor/*']
+
+
+@task(name='static-sync')
+def static_sync_task(ctx, version, direction='up', project=None, bucket=None, static_path=None):
+    """Content-addressed sync of the collected static files.
+
+    Uploads only files whose content is not in the bucket yet, plus a manifest per version. Deploying a version
+    downloads only the files that differ from what is on disk. On a host the files are compared with `sha256sum` and
+    the changed ones are fetched there with the AWS CLI.
+
+    Args:
+        ctx: Run context.
+        version: The release version.
+        direction: `up` to release or `down` to deploy.
+        project: Default is the project name. Files are stored under `{project}/static/`.
+        bucket: Default is the S3_BUCKET_NAME.
+        static_path: Default is `.local/static/` in the project directory.
+
+    Raises:
+        ValueError: When uploading from a host, releases are made where the static files were collected.
+
+    """
+    import io
+
+    project = project or ctx['project_name']
+    bucket = bucket or ctx['bucket_name']
+    host = getattr(ctx, 'host', False)
+    root = static_path or (posixpath if host else os.path).join(ctx['dir'], '.local', 'static')
+    prefix = f'{project}/static'
+
+    if host and direction == 'up':
+        raise ValueError('Static files are uploaded by release-code, not from a host')
+    if env.dry_run:
+        print(REMOTE_PREFIX if host else LOCAL_PREFIX,
+              f'static sync {direction} {root} s3://{bucket}/{prefix}/ (static_v{version})')
+        unreplayable(f'static sync {direction} s3://{bucket}/{prefix}/')
+        return
+
+    from .static import (checksum_command, deploy_static, download_script, parse_checksums, read_manifest,
+                         upload_static)
+
+    if host:
+        checksums = parse_checksums(do(ctx, checksum_command(root), hide=True).stdout)
+        script, count, size = download_script(read_manifest(bucket, prefix, version), checksums, root, bucket, prefix)
+        do(ctx, 'sh -s', in_stream=io.StringIO(script), hide=True)
+        print(f'Downloaded {count} static files ({size} bytes)')
+        return
+
+    if direction == 'up':
+        count, size = upload_static(root, bucket, prefix, version, exclude=STATIC_EXCLUDES)
+        print(f'Uploaded {count} static files ({size} bytes)')
+    else:
+        count, size = deploy_static(root, bucket, prefix, version)
+        print(f'Downloaded {count} static files ({size} bytes)')
+
+
 @task
 def docker_ps(ctx):
     """
 
     :return: List of running container names
     """
-    result = docker(ctx, cmd='ps -a --format "table {{.Names}}"', hide=True)
-    containers = result.stdout.split('\n')[1:-1]
+    if use_engine(ctx):
+        containers = get_engine().container_names()
+    else:
+        containers = []
+        docker(ctx, cmd='ps -a --format "{{.Names}}"', hide=True, on_line=containers.append)
     print(containers)
     return containers
 
@@ -138,18 +244,26 @@ def release_superset(ctx, version):
     else:
         print(REMOTE_PREFIX if ctx.get('host', False) else LOCAL_PREFIX,
               f'dotenv -f {project_root}/.env -q auto set SUPERSET_VERSION {version}')
+        unreplayable(f'set SUPERSET_VERSION in {project_root}/.env')
 
     compose(ctx, 'build superset', path=f'{project_root}')
 
 
 def now_tag(tag=None):
     time_str = datetime.utcnow().replace(microsecond=0).isoformat().replace(':', '-') + 'Z'
+    # A replayed plan would reuse the timestamp and overwrite the earlier backup
+    unreplayable(f'timestamped tag {time_str}')
     return f'{time_str}_{tag}' if tag else time_str
 
 
+def dedup_location(ctx, project):
+    """Bucket and prefix of the project's deduplicated backup store."""
+    return ctx.get('bucket_name') or 'dstack-storage', f'{project or ctx["project_name"]}/dedup'
+
+
 def db_backup_old(ctx, tag=None, sync=True, notify=False, replica=True, project=None, image='postgres:9.5',
        service_main='postgres', volume_main='postgres',
-       service_standby='postgres-replica', volume_standby='dbdata', data_dir=None):
+       service_standby='postgres-replica', volume_standby='dbdata', data_dir=None, dedup=False):
 
     if data_dir is None:
         data_dir = os.path.abspath(
@@ -159,18 +273,31 @@ def db_backup_old(ctx, tag=None, sync=True, notify=False, replica=True, project=
     tag = now_tag(tag)
     backup_cmd = f'tar -zcpf /backup/db_backup.{tag}.tar.gz /data'
     # Stop container and make backup of ${PGDATA}
-    psql(ctx, sql=f"INSERT INTO backup_log (tag) VALUES ('{tag}');")
+    psql(ctx, sql=f'INSERT INTO backup_log (tag) VALUES ({literal(tag)})')
     service = service_standby if replica else service_main
     volume = volume_standby if replica else volume_main
     compose(ctx, f'stop {service}')
-    docker(ctx, f'run --rm -v {project}_{volume}:/data -v {backup_path}:/backup {image} {backup_cmd}')
+    if dedup:
+        # Uncompressed tar stream, so unchanged files deduplicate against earlier backups
+        tar_cmd = f'docker run --rm -v {project}_{volume}:/data {image} tar -cpf - /data'
+        chunks = do(ctx, tar_cmd, stream=True, hide='stdout').chunks() if not env.dry_run else ()
+        bucket, prefix = dedup_location(ctx, project)
+        manifest = dedup_backup(ctx, chunks, bucket, prefix, tag, tar_cmd, kind='pgdata')
+        if manifest:
+            record_backup(ctx, project or ctx['project_name'], tag, 'dedup', bucket, f'{prefix}/manifests/{tag}.json',
+                          manifest['size'], manifest['sha256'])
+    else:
+        docker(ctx, f'run --rm -v {project}_{volume}:/data -v {backup_path}:/backup {image} {backup_cmd}')
     compose(ctx, f'start {service}')
-    if sync:
+    wait_ready(ctx, f'{project}_{service}_1', postgres=True)
+    if sync and not dedup:
         s3cmd(ctx, local_path=os.path.join(backup_path, f'db_backup.{tag}.tar.gz'),
               s3_path=f'{ctx.s3_project_prefix}/backups/')
+        record_backup(ctx, project or ctx['project_name'], tag, 'pgdata', ctx['bucket_name'] or 'dstack-storage',
+                      f'{ctx.s3_project_prefix}/backups/db_backup.{tag}.tar.gz')
     if replica:
-        result = psql(ctx, sql=f"SELECT * from backup_log WHERE tag='{tag}'", service=service)
-        if tag in getattr(result, 'stdout', ''):
+        rows = psql(ctx, sql=f'SELECT tag FROM backup_log WHERE tag = {literal(tag)}', service=service)
+        if any(row['tag'] == tag for row in rows):
             print('Success!')
     if notify:
         message = f'Backup with tag={tag} uploaded to S3. Please verify.'
@@ -186,11 +313,51 @@ def db_backup_old(ctx, tag=None, sync=True, notify=False, replica=True, project=
     #     md5sum .local/db_backup...tar.gz
 
 
-def db_backup(ctx, tag=None, sync=True, project=None, data_dir=None, service='postgres'):
+def db_backup(ctx, tag=None, sync=True, project=None, data_dir=None, service='postgres', stream=None,
+              compression=None, parallel=False, jobs=None, dedup=False):
+    """Dump the database and upload it to S3.
+
+    Args:
+        ctx: Run context.
+        tag: Default is the current time.
+        sync: Whether to upload the dump.
+        project: Default is the project name.
+        data_dir: Directory for the on-disk dump, default is LOCAL_DIR next to the COMPOSE_FILE.
+        service: The postgres service.
+        stream: Pipe the dump straight into a multipart upload without a file on disk, see backup.py. Default is the
+            BACKUP_STREAM env var.
+        compression: None or 'gzip', only for streamed backups.
+        parallel: Directory format dump with `pg_dump -j`, uploaded as one object per file, see backup.py.
+        jobs: Number of parallel dump jobs, default is derived from the container's cpu limits.
+        dedup: Store an uncompressed dump in the deduplicated chunk store, only new chunks are uploaded.
+
+    """
     tag = now_tag(tag)
-    psql(ctx, sql=f"INSERT INTO backup_log (tag) VALUES ('{tag}');")
+    psql(ctx, sql=f'INSERT INTO backup_log (tag) VALUES ({literal(tag)})')
     project = project or ctx['project_name']
 
+    if stream is None:
+        stream = strtobool(os.getenv('BACKUP_STREAM', 'False'))
+    if dedup and sync:
+        container = f'{project}_{service}_1'
+        dump_cmd = 'pg_dump -U postgres -F c -Z 0 -d postgres'
+        chunks = dump_chunks(ctx, container, dump_cmd) if not env.dry_run else ()
+        bucket, prefix = dedup_location(ctx, project)
+        manifest = dedup_backup(ctx, chunks, bucket, prefix, tag, f'docker exec {container} {dump_cmd}',
+                                kind='pg_dump')
+        if manifest:
+            record_backup(ctx, project, tag, 'dedup', bucket, f'{prefix}/manifests/{tag}.json', manifest['size'],
+                          manifest['sha256'])
+        return manifest
+    if stream and sync:
+        uploaded = backup_to_s3(ctx, f'{project}_{service}_1', 'dstack-storage',
+                                f'{project}/backups/backup_{tag}.pg_dump', compression=compression)
+        if uploaded:
+            key, checksum, size = uploaded
+            record_backup(ctx, project, tag, 'custom.gz' if compression else 'custom', 'dstack-storage', key, size,
+                          checksum)
+        return uploaded
+
     host = getattr(ctx, 'host', False)
     if host:
         os_path = posixpath
@@ -200,11 +367,28 @@ def db_backup(ctx, tag=None, sync=True, project=None, data_dir=None, service='po
     if data_dir is None:
         data_dir = os_path.abspath(
             os_path.join(os_path.dirname(os.getenv('COMPOSE_FILE')), os.getenv('LOCAL_DIR')))
+    if parallel:
+        dump_dir = parallel_backup(ctx, f'{project}_{service}_1', os_path.join(data_dir, 'backups'),
+                                   f'{project}/backups/backup_{tag}.dir', jobs=jobs and int(jobs), sync=sync)
+        if sync:
+            record_backup(ctx, project, tag, 'directory', 'dstack-storage', f'{project}/backups/backup_{tag}.dir/')
+        return dump_dir
+
     backup_file = os_path.join(f'{data_dir}', 'backups', 'backup_latest.pg_dump')
-    docker(ctx, f'exec {project}_{service}_1 pg_dump -U postgres -F c -d postgres > {backup_file}')
+    if use_engine(ctx):
+        # Stream the dump from the Engine API straight into the file instead of through a shell redirect
+        with open(backup_file, 'wb') as f:
+            result = get_engine().exec_to_file(f'{project}_{service}_1', ['pg_dump', '-U', 'postgres', '-F', 'c',
+                                                                          '-d', 'postgres'], f)
+        if not result.ok:
+            raise RuntimeError(f'pg_dump failed with exit code {result.exit_code}: {result.stderr.decode()}')
+    else:
+        docker(ctx, f'exec {project}_{service}_1 pg_dump -U postgres -F c -d postgres > {backup_file}')
     if sync:
         endpoint_url = f'--endpoint-url {os.getenv("ENDPOINT_URL")}'
         do(ctx, f'aws {endpoint_url} s3 cp {backup_file} s3://dstack-storage/{project}/backups/backup_{tag}.pg_dump')
+        record_backup(ctx, project, tag, 'custom', 'dstack-storage', f'{project}/backups/backup_{tag}.pg_dump',
+                      size=None if host or env.dry_run else os.path.getsize(backup_file))
     else:
         # TODO: implement local backup copy
         pass
@@ -213,13 +397,14 @@ def db_backup(ctx, tag=None, sync=True, project=None, data_dir=None, service='po
 @task
 def db(ctx, cmd, tag=None, sync=True, notify=False, replica=True, project=None, image='postgres:9.5',
        service_main='postgres', volume_main='postgres',
-       service_standby='postgres-replica', volume_standby='dbdata', data_dir=None):
+       service_standby='postgres-replica', volume_standby='dbdata', data_dir=None, parallel=False, jobs=None,
+       dedup=False, before=None):
     """
 
     Args:
         ctx:
         cmd:
-        tag:
+        tag: Restores look up the tag in the backup catalog, default is the latest backup, see catalog.py.
         sync: Default=True. Whether to upload/download to/from s3 or not
         notify: Default=True. Whether to post machine_status
         replica: Whether to use simple backup/restore or backup/restore with replica
@@ -230,6 +415,10 @@ def db(ctx, cmd, tag=None, sync=True, notify=False, replica=True, project=None,
         service_standby:
         volume_standby:
         data_dir: The storage location for backups, static, media files.
+        parallel: Directory format `pg_dump -j`/`pg_restore -j` instead of a custom format dump and a PGDATA tarball
+        jobs: Number of parallel jobs, default is the number of cpus the container may use or DB_JOBS.
+        dedup: Backup to and restore from the deduplicated chunk store, see chunkstore.py.
+        before: Restore the latest backup made before this ISO 8601 date.
 
     Returns:
 
@@ -242,69 +431,144 @@ def db(ctx, cmd, tag=None, sync=True, notify=False, replica=True, project=None,
             os.path.join(os.path.dirname(os.getenv('COMPOSE_FILE')), os.getenv('LOCAL_DIR')))
     backup_path = os.path.join(ctx['dir'], f'{data_dir}/backups')
     # promote_cmd = 'su - postgres -c "/usr/lib/postgresql/9.5/bin/pg_ctl promote -D /var/lib/postgresql/data"'
+    backup_format = None
+    if cmd == 'restore' and (tag in (None, 'latest') or before or not (parallel or dedup)):
+        backup = find_backup(ctx, project, tag, before)
+        if backup is not None:
+            tag, backup_format = backup['tag'], backup['format']
+            parallel = parallel or backup_format == 'directory'
+            dedup = dedup or backup_format == 'dedup'
+            print(f"Restoring {backup_format} backup {tag} from s3://{backup['bucket']}/{backup['key']}")
+        elif not env.dry_run and (tag in (None, 'latest') or before):
+            raise ValueError(f'No backup of {project} found in the catalog, see the catalog task')
+
     if cmd == 'backup':
-        db_backup(ctx, tag=tag, sync=sync, project=project, data_dir=data_dir, service=service_main)
-    elif cmd == 'restore':
+        db_backup(ctx, tag=tag, sync=sync, project=project, data_dir=data_dir, service=service_main,
+                  parallel=parallel, jobs=jobs, dedup=dedup)
+    elif cmd == 'restore' and parallel:
+        # Logical restore into the running server, the standby replays it from the WAL
+        parallel_restore(ctx, f'{project}_{service_main}_1', backup_path, f'{project}/backups/backup_{tag}.dir',
+                         jobs=jobs and int(jobs), sync=sync)
+    elif cmd == 'restore' and backup_format in ('custom', 'custom.gz'):
+        suffix = '.gz' if backup_format == 'custom.gz' else ''
         if sync:
+            s3cmd(ctx, direction='down', bucket=backup['bucket'], s3_path=backup['key'], local_path=f'{backup_path}/')
+        pg_restore(ctx, f'{project}_{service_main}_1', os.path.join(backup_path, f'backup_{tag}.pg_dump{suffix}'))
+    elif cmd == 'restore':
+        archive = f'db_backup.{tag}.tar.gz'
+        if dedup:
+            # Dumps and PGDATA tarballs are reassembled from the chunk store
+            archive = f'dedup_{tag}'
+            manifest = dedup_restore(ctx, *dedup_location(ctx, project), tag, os.path.join(backup_path, archive))
+            if (manifest or {}).get('kind', 'pg_dump') == 'pg_dump':
+                pg_restore(ctx, f'{project}_{service_main}_1', os.path.join(backup_path, archive))
+                return
+        elif sync:
             s3cmd(ctx, direction='down',
                   s3_path=f'{ctx.s3_project_prefix}/backups/db_backup.{tag}.tar.gz',
                   local_path=f'{backup_path}/')
-        restore_cmd = f'bash -c "tar xpf /backup/db_backup.{tag}.tar.gz && chmod -R 700 /data"'
+        restore_cmd = f'bash -c "tar xpf /backup/{archive} && chmod -R 700 /data"'
         # TODO: First restart django with updated POSTGRES_HOST=standby and then only destroy afterwards
         if replica:
             # Destroy replica server and associated volume
             compose(ctx, f'rm -vsf {service_standby}')
-            docker(ctx, f'volume rm {project}_{volume_standby}', warn=True)
+            if use_engine(ctx):
+                get_engine().remove_volume(f'{project}_{volume_standby}', missing_ok=True)
+            else:
+                docker(ctx, f'volume rm {project}_{volume_standby}', warn=True)
         # Restore database
         compose(ctx, f'-p {project} stop {service_main}')
         docker(ctx, f'run --rm -v {project}_{volume_main}:/data -v {backup_path}:/backup {image} {restore_cmd}')
         compose(ctx, f'-p {project} start {service_main}')
+        wait_ready(ctx, f'{project}_{service_main}_1', postgres=True)
         # compose(ctx, f'exec -T {service_main} {promote_cmd}')
         compose(ctx, f'-p {project} exec -T {service_main} touch /tmp/pg_failover_trigger')
         if replica:
             # Recreate standby database
             compose(ctx, f'up -d {service_standby}')
+            wait_ready(ctx, f'{project}_{service_standby}_1', postgres=True)
     elif cmd == 'recreate-standby':
         compose(ctx, f'rm -vsf {service_standby}')
-        docker(ctx, f'volume rm {project}_{volume_standby}')
+        if use_engine(ctx):
+            get_engine().remove_volume(f'{project}_{volume_standby}')
+        else:
+            docker(ctx, f'volume rm {project}_{volume_standby}')
         compose(ctx, f'up -d {service_standby}')
+        wait_ready(ctx, f'{project}_{service_standby}_1', postgres=True)
     elif cmd == 'check':
-        result_main = psql(ctx, 'SELECT * from backup_log;')
-        result_standby = psql(ctx, 'SELECT * from backup_log;', service='postgres-replica')
-        if ('initialized' in getattr(result_main, 'stdout', '') and
-                'initialized' in getattr(result_standby, 'stdout', '')):
+        counts = []
+        for service in (service_main, service_standby):
+            with Session(ctx, service) as session:
+                count = session.query("SELECT count(*) FROM backup_log WHERE tag = 'initialized'")
+            counts.append(count.scalar())
+        if all(count and int(count) > 0 for count in counts):
             print('Success!')
     elif cmd == 'enable-replication':
         # TODO: Test this code and maybe make part of main restore task
         compose(ctx, f'exec {service_main} ./docker-entrypoint-initdb.d/10-config.sh')
         compose(ctx, f'exec {service_main} ./docker-entrypoint-initdb.d/20-replication.sh')
         compose(ctx, f'restart {service_main}')
+        wait_ready(ctx, f'{project}_{service_main}_1', postgres=True)
         compose(ctx, f'up -d {service_standby}')
+        wait_ready(ctx, f'{project}_{service_standby}_1', postgres=True)
+
+
+def pg_restore(ctx, container, dump_file):
+    """Restore a custom format dump, optionally gzipped, into the running server of a container."""
+    name = os.path.basename(dump_file)
+    restore_cmd = 'pg_restore -U postgres --clean --if-exists -d postgres'
+    docker(ctx, f'cp {dump_file} {container}:/tmp/{name}')
+    if name.endswith('.gz'):
+        docker(ctx, f"exec {container} sh -c 'gunzip -c /tmp/{name} | {restore_cmd}'")
+    else:
+        docker(ctx, f'exec {container} {restore_cmd} /tmp/{name}')
+    docker(ctx, f'exec {container} rm -f /tmp/{name}')
 
 
 @task
-def psql(ctx, sql, service='postgres', user='postgres'):
-    return compose(ctx, f'exec -T {service} psql -U {user} -c "{sql}"')
+def psql(ctx, sql, service='postgres', user='postgres', **kwargs):
+    """Run SQL in the postgres service, the SQL is sent to psql on stdin, see sql.Session.
+
+    Args:
+        ctx: Run context.
+        sql: A statement, or several statements of which at most one returns rows. They are sent as one section of
+            the session script, so the output of several queries would be parsed as one table.
+        service: The postgres compose service.
+        user: Database user.
+        **kwargs: Passed on to `compose`.
+
+    Returns:
+        sql.Query with the rows of the statement that returns rows.
+
+    """
+    session = Session(ctx, service, user)
+    query = session.execute(sql)
+    session.run(**kwargs)
+    if query.columns:
+        print('\t'.join(query.columns))
+        for row in query.rows:
+            print('\t'.join(row.values()))
+    return query
 
 
 @task
 def full_db_test(ctx):
-    db(ctx, cmd='backup', upload=False)
-    psql(ctx, sql=f"INSERT INTO backup_log (tag) VALUES ('not_backed_up'); SELECT * from backup_log;")
-    tag = input("Tag:")
-    db(ctx, cmd='restore', tag=tag)
-    time.sleep(10)
+    db(ctx, cmd='backup')
+    with Session(ctx) as session:
+        session.execute("INSERT INTO backup_log (tag) VALUES ('not_backed_up')")
+    # The backup that was just made is the latest one in the catalog, restore waits for the databases to be ready
+    db(ctx, cmd='restore', tag='latest')
     db(ctx, cmd='check')
 
 
 @task
 def create_backup_table(ctx):
-    sql = """CREATE TABLE IF NOT EXISTS backup_log (
-                id serial not null primary key,
-                date_created timestamp default current_timestamp,
-                tag VARCHAR(255))"""
-    psql(ctx, sql=" ".join(sql.split()))
-    psql(ctx, sql="INSERT INTO backup_log (tag) VALUES ('initialized');")
+    with Session(ctx, single_transaction=True) as session:
+        session.execute("""CREATE TABLE IF NOT EXISTS backup_log (
+                               id serial not null primary key,
+                               date_created timestamp default current_timestamp,
+                               tag VARCHAR(255))""")
+        session.execute("INSERT INTO backup_log (tag) VALUES ('initialized')")
 
 
 @task
@@ -313,9 +577,11 @@ def install_superset(ctx):
     # CREATE USER superset WITH PASSWORD 'superset';
     # GRANT ALL PRIVILEGES ON DATABASE superset TO superset;
     # TODO: Make database name and password env variables
-    psql(ctx, 'CREATE DATABASE superset')
-    psql(ctx, "CREATE USER superset WITH PASSWORD 'superset'")
-    psql(ctx, 'GRANT ALL PRIVILEGES ON DATABASE superset TO superset')
+    # Not in a single transaction, CREATE DATABASE can't run inside one
+    with Session(ctx) as session:
+        session.execute('CREATE DATABASE superset')
+        session.execute("CREATE USER superset WITH PASSWORD 'superset'")
+        session.execute('GRANT ALL PRIVILEGES ON DATABASE superset TO superset')
     compose(ctx, 'exec superset fabmanager create-admin --app superset')
     compose(ctx, 'exec superset superset db upgrade')
     compose(ctx, 'exec superset superset init')
@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    """In-memory trace of command and task timings.
+
+    Spans are recorded as Chrome trace "complete" events, so a written trace can be opened in chrome://tracing,
+    Perfetto or speedscope to see where a deploy spends its time.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _now(self):
+        return int((time.perf_counter() - self.origin) * 1e6)
+
+    @contextmanager
+    def span(self, name, category='task', **args):
+        """Record the duration of the body.
+
+        Yields the event's args dictionary so that the body can add details like exit codes.
+
+        Args:
+            name: Span name, e.g. the command.
+            category: Span category, e.g. 'command' or 'wrapper'.
+            **args: Details shown with the span, e.g. host and cwd.
+
+        """
+        start = self._now()
+        try:
+            yield args
+        finally:
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': start,
+                'dur': self._now() - start,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def to_chrome(self):
+        """The trace in Chrome trace-event format."""
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event['ts'])
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': 'dstack'}}]
+        return {'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        """Write the trace as Chrome trace-event JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome(), f, default=str)
+
+
+def record_result(args, result):
+    """Add exit code and output sizes of an invoke Result to span args."""
+    if result is None:
+        return
+    args['exit_code'] = getattr(result, 'exited', None)
+    for stream in ('stdout', 'stderr'):
+        output = getattr(result, stream, None)
+        if isinstance(output, str):
+            args[f'{stream}_bytes'] = len(output.encode('utf-8', errors='replace'))
+    if hasattr(result, 'bytes_read'):
+        # Streamed results only keep the tail of stdout
+        args['stdout_bytes'] = result.bytes_read
+
+
+tracer = Tracer()
+span = tracer.span
@@ -97,3 +97,20 @@ def find_and_replace(file_path, find_str, replace_str, count):
     # Write the file out again
     with open(file_path, 'w') as file:
         file.write(file_data)
+
+
+def strtobool(value: str) -> bool:
+    """Convert a string representation of truth to True or False.
+
+    Replaces `distutils.util.strtobool`, which is slow to import and removed in Python 3.12.
+
+    :param value: y, yes, t, true, on and 1 are True. n, no, f, false, off and 0 are False.
+    :raises ValueError: If value is anything else.
+    """
+    value = value.lower()
+    if value in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    elif value in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    else:
+        raise ValueError(f'invalid truth value {value!r}')
@@ -0,0 +1,149 @@
+import datetime
+import json
+import os
+import subprocess
+
+CACHE_FILE = os.path.join('.local', 'version_cache.json')
+
+# Versions resolved by this process, keyed by git state
+_resolved = {}
+
+
+def _git_dir(root):
+    git_dir = os.path.join(root, '.git')
+    if os.path.isfile(git_dir):
+        # Worktrees and submodules use a file pointing to the actual git directory
+        with open(git_dir) as f:
+            content = f.readline().strip()
+        if content.startswith('gitdir:'):
+            git_dir = os.path.join(root, content[len('gitdir:'):].strip())
+    return git_dir if os.path.isdir(git_dir) else None
+
+
+def _read_ref(git_dir, ref):
+    try:
+        with open(os.path.join(git_dir, ref)) as f:
+            return f.readline().strip()
+    except FileNotFoundError:
+        pass
+    try:
+        with open(os.path.join(git_dir, 'packed-refs')) as f:
+            for line in f:
+                if line.rstrip().endswith(' ' + ref):
+                    return line.split(' ', 1)[0]
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def git_state(root='.'):
+    """Cheap fingerprint of the git state that determines the setuptools_scm version.
+
+    HEAD and tags are read straight from the git directory. Only the dirty check spawns git.
+
+    Args:
+        root: The project root.
+
+    Returns:
+        A string key, or None if root is not a git repository.
+
+    """
+    git_dir = _git_dir(root)
+    if git_dir is None:
+        return None
+
+    head = _read_ref(git_dir, 'HEAD')
+    if head and head.startswith('ref:'):
+        head = _read_ref(git_dir, head[len('ref:'):].strip())
+    if not head:
+        return None
+
+    try:
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    except FileNotFoundError:
+        return None
+    # setuptools_scm adds the date to versions of dirty trees
+    dirty = datetime.date.today().strftime('%Y%m%d') if status.stdout.strip() else 'clean'
+
+    tags = '{}.{}'.format(_mtime(os.path.join(git_dir, 'refs', 'tags')), _mtime(os.path.join(git_dir, 'packed-refs')))
+    return f'{head}:{dirty}:{tags}'
+
+
+def _read_cache(cache_file, key):
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return cache.get('version') if cache.get('key') == key else None
+
+
+def _write_cache(cache_file, key, version):
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, 'w') as f:
+            json.dump({'key': key, 'version': version}, f)
+    except OSError:
+        # Caching is an optimisation, e.g. read only checkouts still work
+        pass
+
+
+def _fallback_version(src):
+    try:
+        with open(os.path.join(src, 'version.txt')) as f:
+            return f.readline().strip()
+    except FileNotFoundError:
+        return os.getenv('VERSION', '0.0.0-dev')
+
+
+def resolve_version(src=None, root='.', use_cache=True):
+    """Resolve the project version.
+
+    Tries setuptools_scm first, then `src/version.txt` and finally the VERSION environmental variable.
+    Versions from setuptools_scm are cached in `.local/version_cache.json`, keyed on the HEAD commit, the dirty
+    state of the tree and the tags, so the cache is invalidated whenever any of them change.
+
+    Args:
+        src: The source directory containing `version.txt`. Defaults to `./src`.
+        root: Default = '.'. The project root.
+        use_cache: Default = True. Whether to use the cached version.
+
+    Returns:
+        The version string.
+
+    """
+    src = src or os.path.join(os.path.abspath(root), 'src')
+    cache_file = os.path.join(root, CACHE_FILE)
+
+    key = git_state(root) if use_cache else None
+    if key is None:
+        # Not a git repository (or no git), setuptools_scm will fall back to version.txt and VERSION anyway
+        use_cache = False
+    elif key in _resolved:
+        return _resolved[key]
+    else:
+        version = _read_cache(cache_file, key)
+        if version:
+            _resolved[key] = version
+            return version
+
+    # Imported here because setuptools_scm (and the git calls it makes) is slow
+    from setuptools_scm import get_version
+
+    try:
+        version = get_version(root=root)
+    except LookupError:
+        return _fallback_version(src)
+
+    if use_cache:
+        _resolved[key] = version
+        _write_cache(cache_file, key, version)
+    return version
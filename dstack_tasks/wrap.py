@@ -1,10 +1,12 @@
 import os
 import sys
 
-import boto3
 from invoke import task
 
-from .base import do
+from .base import LOCAL_PREFIX, do, env
+from .cache import query_cache
+from .plan import unreplayable
+from .trace import span
 
 
 @task
@@ -25,7 +27,8 @@ def bash(ctx, cmd, path=None, local=None, env_vars=None, host=None):
     if env_vars:
         env_vars = dict(item.split("=") for item in env_vars.split(","))
 
-    return do(ctx, cmd=cmd, path=path, local=local, env=env_vars, host=host)
+    with span('bash', 'wrapper', cmd=cmd):
+        return do(ctx, cmd=cmd, path=path, local=local, env=env_vars, host=host)
 
 
 @task
@@ -40,7 +43,10 @@ def docker(ctx, cmd='--help', **kwargs):
     Returns:
 
     """
-    return do(ctx, f'docker {cmd}', **kwargs)
+    if 'ttl' not in kwargs:
+        query_cache.invalidate_after('docker', cmd, kwargs.get('host') or getattr(ctx, 'host', None))
+    with span('docker', 'wrapper', cmd=cmd):
+        return do(ctx, f'docker {cmd}', **kwargs)
 
 
 @task
@@ -57,7 +63,54 @@ def compose(ctx, cmd='--help', **kwargs):
     """
     if kwargs.get('path', None) is None:
         kwargs['path'] = ctx['dir']
-    return do(ctx, f'docker-compose {cmd}', **kwargs)
+    if 'ttl' not in kwargs:
+        query_cache.invalidate_after('docker-compose', cmd, kwargs.get('host') or getattr(ctx, 'host', None))
+    with span('compose', 'wrapper', cmd=cmd):
+        return do(ctx, f'docker-compose {cmd}', **kwargs)
+
+
+# Build with BuildKit, also when docker-compose calls the docker CLI to build
+BUILDKIT_ENV = {'DOCKER_BUILDKIT': '1', 'COMPOSE_DOCKER_CLI_BUILD': '1'}
+
+
+def compose_deploy(ctx, services, build=True, parallel=None, report=True, **kwargs):
+    """Build services concurrently and bring them all up in one `docker-compose up`.
+
+    Every service is built by its own `docker-compose build` with BuildKit enabled, at most `parallel` at a time.
+    When all builds succeed the services are started with a single `up -d --no-build`, which lets compose start them
+    in the order of their `depends_on`.
+
+    Args:
+        ctx: Run context.
+        services: List of service names or a space separated string, e.g. 'django celery_worker'
+        build: Whether to build the images first.
+        parallel: Maximum number of concurrent builds, default is the COMPOSE_PARALLEL_LIMIT env var or 4.
+        report: Whether to print the build times per service.
+        **kwargs: Passed on to `compose`, e.g. path or host.
+
+    Returns:
+        dag.Pipeline with the `build:<service>` and `up` steps.
+
+    """
+    from .dag import Pipeline
+
+    if isinstance(services, str):
+        services = services.split()
+    parallel = int(parallel or os.getenv('COMPOSE_PARALLEL_LIMIT', 4))
+    build_env = dict(BUILDKIT_ENV, **kwargs.pop('env', None) or {})
+
+    pipeline = Pipeline(ctx, workers=parallel)
+    if build:
+        for service in services:
+            pipeline.step(f'build:{service}', compose, cmd=f'build {service}', env=build_env, **kwargs)
+    pipeline.step('up', compose, cmd=f'up -d {"--no-build " if build else ""}{" ".join(services)}',
+                  deps=[f'build:{service}' for service in services], **kwargs)
+    try:
+        pipeline.run()
+    finally:
+        if report and not env.dry_run:
+            print(pipeline.report())
+    return pipeline
 
 
 @task
@@ -72,7 +125,10 @@ def machine(ctx, cmd, **kwargs):
     Returns: runner.Result
 
     """
-    return do(ctx, f'docker-machine {cmd}', **kwargs)
+    if 'ttl' not in kwargs:
+        query_cache.invalidate_after('docker-machine', cmd, kwargs.get('host') or getattr(ctx, 'host', None))
+    with span('machine', 'wrapper', cmd=cmd):
+        return do(ctx, f'docker-machine {cmd}', **kwargs)
 
 
 @task
@@ -87,13 +143,50 @@ def git(ctx, cmd='--help', **kwargs):
     Returns:
 
     """
-    return do(ctx, f'git {cmd}', **kwargs)
+    with span('git', 'wrapper', cmd=cmd):
+        return do(ctx, f'git {cmd}', **kwargs)
+
+
+# Absolute interpreter path of the activated venv per (host, activation command, working directory)
+_interpreters = {}
+
+
+def interpreter(ctx, path=None, host=None):
+    """Resolve the interpreter of the configured conda or pip venv once per host and cache it.
+
+    Activating a venv costs about a second per call, the resolved interpreter is executed directly instead.
+
+    Args:
+        ctx: Run context.
+        path: Working directory, relative pip venvs are resolved from here.
+        host: Default is the context's host.
+
+    Returns:
+        Absolute path of the interpreter, or None when it cannot be resolved (yet). Nothing is run in dry run mode
+        or while a batch is collecting commands.
+
+    """
+    host = host or getattr(ctx, 'host', None) or 'local'
+    key = (host, ctx.activate, path)
+    if key in _interpreters:
+        return _interpreters[key]
+    if env.dry_run or env.batch is not None:
+        return None
+
+    result = do(ctx, f'{ctx.activate} && python -c "import sys; print(sys.executable)"', dry_run=False,
+                host=None if host == 'local' else host, path=path, hide=True, warn=True)
+    lines = result.stdout.strip().splitlines() if result.ok else []
+    # Activation scripts can print, the interpreter path is the last line
+    _interpreters[key] = lines[-1].strip() if lines and lines[-1].strip() else None
+    return _interpreters[key]
 
 
 @task
 def python(ctx, cmd='--help', venv=True, conda_env=False, **kwargs):
     """System python wrapper with venv activation.
 
+    The venv's interpreter is resolved once per host, see `interpreter`, and falls back to activating the venv.
+
     Args:
         ctx:
         cmd:
@@ -106,14 +199,13 @@ def python(ctx, cmd='--help', venv=True, conda_env=False, **kwargs):
     """
     # TODO: Auto-detect venv type? Or at least better switching
 
-    if conda_env:
-        python_path = f'{ctx.activate} && python'
-    elif venv:
-        python_path = f'{ctx.activate} && python'
+    if conda_env or venv:
+        python_path = interpreter(ctx, kwargs.get('path'), kwargs.get('host')) or f'{ctx.activate} && python'
     else:
         python_path = 'python'
 
-    return do(ctx, f'{python_path} {cmd}', **kwargs)
+    with span('python', 'wrapper', cmd=cmd):
+        return do(ctx, f'{python_path} {cmd}', **kwargs)
 
 
 @task
@@ -150,17 +242,44 @@ def s3cmd(ctx, cmd='cp', simple_path=None, direction='up', local_path=None, s3_p
         exact_timestamps: Useful for when syncing static files like CSS
         **kwargs:
 
+    Note:
+        With S3_ENGINE=boto3 in the .env file local transfers run in-process with boto3 instead of the AWS CLI.
+        S3_CHUNK_SIZE, S3_MAX_CONCURRENCY and S3_MAX_BANDWIDTH configure the transfers, see s3.py.
+
     Returns:
 
     Raises:
         AttributeError: When neither simple_path nor s3_path and local_path are specified.
 
     """
-    bucket = bucket or ctx['bucket_name']
-
     if kwargs.get('path', None) is None:
         kwargs['path'] = ctx['dir']
 
+    local_path, s3_uri = s3_locations(ctx, simple_path, local_path, s3_path, bucket, project_name)
+    remote = kwargs.get('host') or getattr(ctx, 'host', False)
+    with span('s3cmd', 'wrapper', cmd=cmd, direction=direction, local_path=local_path, s3_uri=s3_uri):
+        if ctx.get('s3_engine', 'cli') == 'boto3' and not remote:
+            if env.dry_run:
+                unreplayable(f'boto3 transfer {direction} {local_path} {s3_uri}')
+            else:
+                # Transfer in-process with a shared client instead of spawning the AWS CLI, see s3.py
+                from .s3 import transfer
+                return transfer(cmd, direction, local_path, s3_uri, exact_timestamps, cwd=kwargs['path'])
+        return do(ctx, cmd=s3_command(cmd, direction, local_path, s3_uri, exact_timestamps), **kwargs)
+
+
+def s3_locations(ctx, simple_path=None, local_path=None, s3_path=None, bucket=None, project_name=None):
+    """Local path and s3 uri for the `s3cmd` arguments.
+
+    Returns:
+        Tuple of local_path, s3_uri
+
+    Raises:
+        AttributeError: When neither simple_path nor s3_path and local_path are specified.
+
+    """
+    bucket = bucket or ctx['bucket_name']
+
     if not project_name:
         project_name = 'temp'
 
@@ -180,10 +299,15 @@ def s3cmd(ctx, cmd='cp', simple_path=None, direction='up', local_path=None, s3_p
     else:
         raise AttributeError('Must specify either simple path or both s3_path and local_path')
 
+    return local_path, s3_uri
+
+
+def s3_command(cmd, direction, local_path, s3_uri, exact_timestamps=False):
+    """The `aws s3` command line for `s3cmd`."""
     # params = ' --exact-timestamps' if kwargs.get('exact_timestamps', False) else ''
     params = ' --exact-timestamps --quiet ' if exact_timestamps else ' --quiet '
     template = f'{local_path} {s3_uri}' if direction == 'up' else f'{s3_uri} {local_path}'
-    return do(ctx, cmd=f'aws s3 {cmd}{params}{template}', **kwargs)
+    return f'aws s3 {cmd}{params}{template}'
 
 
 # DEPRECATED
@@ -238,6 +362,16 @@ def mkdir(ctx, path):
 # Local task
 # @task
 def filer(content, key, bucket_name='dstack-storage', dry_run=False):
+    """Put content on S3 without holding it in memory.
+
+    Args:
+        content: str, bytes, `pathlib.Path`, text or binary file object or an iterable of str/bytes chunks.
+            Content larger than S3_CHUNK_SIZE is sent as a multipart upload, see s3.py.
+        key: The object key.
+        bucket_name: Default = dstack-storage.
+        dry_run: Print the upload instead.
+
+    """
     # import pdb; pdb.set_trace()
     # host = env.hosts[0]
     # if local:
@@ -246,9 +380,14 @@ def filer(content, key, bucket_name='dstack-storage', dry_run=False):
     #     ctx.run(f'scp {local_path} {host}:{remote_path}')
 
     if not dry_run:
-        s3 = boto3.resource('s3')
-        file_object = s3.Object(bucket_name=bucket_name, key=key)
-        file_object.put(Body=content.encode('utf-8'))
+        from .s3 import upload_stream
+        upload_stream(content, bucket_name, key)
     else:
-        content = content[:10] + '...'
-        f'[local] aws s3 cp --quiet "{content}" s3://{bucket_name}/{key}'
+        if isinstance(content, (str, bytes)):
+            source = repr(content[:10]) + '...'
+        elif isinstance(content, os.PathLike):
+            source = os.fspath(content)
+        else:
+            source = f'<{type(content).__name__}>'
+        print(LOCAL_PREFIX, f'aws s3 cp --quiet {source} s3://{bucket_name}/{key}')
+        unreplayable(f'upload to s3://{bucket_name}/{key}')
@@ -40,6 +40,6 @@ setup(
         'python-dotenv',
         'requests',
     ],
-    extras_require={'dev': ['twine', 'wheel']},
+    extras_require={'dev': ['twine', 'wheel', 'pytest', 'moto'], 'async': ['asyncssh'], 'dedup': ['numpy']},
     entry_points={'console_scripts': ['dstack = dstack_tasks.main:program.run']},
 )
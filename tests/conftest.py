@@ -0,0 +1,26 @@
+import pytest
+from invoke import Config, Context
+
+
+@pytest.fixture
+def ctx():
+    """Local run context. Commands must not read the captured stdin of pytest."""
+    return Context(Config(overrides={'run': {'in_stream': False}}))
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """moto S3 stand-in with an empty bucket named 'bkt'. Yields the shared client of s3.py."""
+    from moto import mock_aws
+
+    from dstack_tasks import s3 as s3_module
+
+    for name, value in {'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_ACCESS_KEY_ID': 'testing',
+                        'AWS_SECRET_ACCESS_KEY': 'testing'}.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv('ENDPOINT_URL', raising=False)
+    monkeypatch.setattr(s3_module, '_clients', {})
+    with mock_aws():
+        client = s3_module.get_client()
+        client.create_bucket(Bucket='bkt')
+        yield client
@@ -0,0 +1,59 @@
+import asyncio
+import sys
+import types
+
+from dstack_tasks import aio
+
+
+def test_local_commands_run_with_bash(ctx, capfd):
+    result = asyncio.run(aio.do(ctx, '[[ -n "$BASH_VERSION" ]] && echo bash; echo oops >&2'))
+
+    assert (result.stdout, result.stderr) == ('bash\n', 'oops\n')
+    assert capfd.readouterr() == ('bash\n', 'oops\n')
+
+
+def test_remote_connection_is_opened_once(ctx, monkeypatch, capsys):
+    class Completed(object):
+        stdout, stderr, exit_status = 'out\n', 'err\n', 0
+
+    class Connection(object):
+        async def run(self, cmd, check):
+            return Completed()
+
+    connects = []
+
+    async def connect(hostname, port, username):
+        connects.append(hostname)
+        await asyncio.sleep(0.05)
+        return Connection()
+
+    monkeypatch.setitem(sys.modules, 'asyncssh', types.SimpleNamespace(connect=connect))
+    monkeypatch.setattr(aio, '_ssh_connections', {})
+    monkeypatch.setattr(aio, '_ssh_locks', {})
+
+    async def steps():
+        return await asyncio.gather(*[aio.do(ctx, 'uptime', host='web1') for _ in range(3)])
+
+    results = asyncio.run(steps())
+
+    assert connects == ['web1']
+    assert [result.stderr for result in results] == ['err\n'] * 3
+    assert capsys.readouterr() == ('out\n' * 3, 'err\n' * 3)
+
+
+def test_dry_run_records_plan_steps(ctx, monkeypatch, capsys):
+    from dstack_tasks.base import env
+    from dstack_tasks.plan import Plan
+
+    plan = Plan()
+    monkeypatch.setattr(env, 'dry_run', True)
+    monkeypatch.setattr(env, 'plan', plan)
+
+    async def steps():
+        await asyncio.gather(aio.do(ctx, 'docker pull web'), aio.do(ctx, 'uptime', host='web1', hide=True))
+
+    asyncio.run(steps())
+
+    assert plan.replayable
+    assert [(step['cmd'], step['host']) for step in plan.steps] == [('docker pull web', None), ('uptime', 'web1')]
+    assert plan.steps[1]['kwargs'] == {'hide': True, 'warn': False}
@@ -0,0 +1,133 @@
+import gzip
+import hashlib
+import os
+import stat
+
+import pytest
+from invoke import Config, Context
+
+from dstack_tasks.backup import (
+    _cpuset_size, backup_to_s3, compress, container_cpus, default_jobs, parallel_backup, parallel_restore,
+    stream_backup)
+from dstack_tasks.base import env
+
+
+def producer(data, size=64 * 1024):
+    """Stand-in for `dump_chunks`, yields data in chunks like a streamed pg_dump."""
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def test_stream_backup_gzip_and_checksum(s3):
+    data = b'PGDMP' + b'table data\n' * 50000
+
+    key, digest, size = stream_backup(producer(data), 'bkt', 'proj/backups/db.dump', compression='gzip')
+
+    assert key == 'proj/backups/db.dump.gz'
+    body = s3.get_object(Bucket='bkt', Key=key)['Body'].read()
+    assert gzip.decompress(body) == data
+    assert (digest, size) == (hashlib.sha256(body).hexdigest(), len(body))
+    assert s3.head_object(Bucket='bkt', Key=key)['ContentType'] == 'application/gzip'
+    checksum = s3.get_object(Bucket='bkt', Key=f'{key}.sha256')['Body'].read().decode()
+    assert checksum == f'{digest}  db.dump.gz\n'
+
+
+def test_stream_backup_multipart(s3):
+    data = os.urandom(20 * 1024 * 1024)
+
+    key, digest, size = stream_backup(producer(data, 1024 * 1024), 'bkt', 'db.dump')
+
+    head = s3.head_object(Bucket='bkt', Key=key)
+    assert (head['ContentLength'], size) == (len(data), len(data))
+    assert head['ETag'].strip('"').endswith('-3')
+    assert digest == hashlib.sha256(data).hexdigest()
+
+
+def test_failing_producer_aborts_upload(s3):
+    def failing():
+        yield os.urandom(9 * 1024 * 1024)
+        raise RuntimeError('pg_dump failed with exit code 1')
+
+    with pytest.raises(RuntimeError, match='pg_dump failed'):
+        stream_backup(failing(), 'bkt', 'db.dump')
+
+    assert 'Contents' not in s3.list_objects_v2(Bucket='bkt')
+    assert 'Uploads' not in s3.list_multipart_uploads(Bucket='bkt')
+
+
+def test_compress_without_compression_passes_through():
+    assert list(compress([b'a', b'b'], None)) == [b'a', b'b']
+    with pytest.raises(ValueError):
+        list(compress([b'a'], 'xz'))
+
+
+def test_backup_to_s3_dry_run(monkeypatch, capsys):
+    monkeypatch.setattr(env, 'dry_run', True)
+
+    assert backup_to_s3(Context(Config()), 'proj_postgres_1', 'bkt', 'db.dump', compression='gzip') is None
+    assert 'docker exec proj_postgres_1 pg_dump -U postgres -F c -d postgres | gzip > s3://bkt/db.dump.gz' in \
+        capsys.readouterr().out
+
+
+@pytest.fixture
+def fake_docker(tmp_path, monkeypatch):
+    """docker CLI stand-in: inspect prints $INSPECT and nproc prints 3."""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'docker'
+    script.write_text('#!/bin/sh\n'
+                      'case "$1" in\n'
+                      '  inspect) echo "$INSPECT";;\n'
+                      '  exec) echo 3;;\n'
+                      'esac\n')
+    script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setattr(env, 'dry_run', False)
+    return Context(Config(overrides={'run': {'in_stream': False}}))
+
+
+def test_cpuset_size():
+    assert _cpuset_size('0-3,6') == 5
+    assert _cpuset_size('2') == 1
+
+
+@pytest.mark.parametrize('inspect, cpus', [
+    ('1500000000 0 0 ', 2),
+    ('0 250000 100000 ', 3),
+    ('0 0 0 0-3,6', 5),
+    ('0 0 0', 3),
+])
+def test_container_cpus_from_limits(fake_docker, monkeypatch, inspect, cpus):
+    monkeypatch.setenv('INSPECT', inspect)
+
+    # A container per case, the inspect output is cached
+    assert container_cpus(fake_docker, f'postgres_{cpus}_{len(inspect)}') == cpus
+
+
+def test_default_jobs(fake_docker, monkeypatch):
+    monkeypatch.setenv('DB_JOBS', '6')
+    assert default_jobs(fake_docker, 'postgres') == 6
+
+    monkeypatch.delenv('DB_JOBS')
+    monkeypatch.setattr(env, 'dry_run', True)
+    assert default_jobs(fake_docker, 'postgres') == 2
+
+
+def test_parallel_backup_and_restore_dry_run(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(env, 'dry_run', True)
+    monkeypatch.delenv('DB_JOBS', raising=False)
+    ctx = Context(Config(overrides={'dir': str(tmp_path), 'bucket_name': 'bkt', 's3_engine': 'cli',
+                                    'run': {'in_stream': False}}))
+
+    dump_dir = parallel_backup(ctx, 'proj_postgres_1', '.local', 'proj/backups/backup_1.dir', jobs=4, bucket='bkt')
+    parallel_restore(ctx, 'proj_postgres_1', '.local', 'proj/backups/backup_1.dir', bucket='bkt')
+
+    out = capsys.readouterr().out
+    assert dump_dir == '.local/backup_1.dir'
+    assert 'docker exec proj_postgres_1 pg_dump -U postgres -F d -j 4 -f /tmp/backup_1.dir -d postgres' in out
+    assert 'docker cp proj_postgres_1:/tmp/backup_1.dir .local/backup_1.dir' in out
+    upload = 'aws s3 sync --quiet .local/backup_1.dir/ s3://bkt/proj/backups/backup_1.dir/'
+    assert out.index('pg_dump') < out.index(upload)
+    assert 'aws s3 sync --quiet s3://bkt/proj/backups/backup_1.dir/ .local/backup_1.dir/' in out
+    assert ('docker exec proj_postgres_1 pg_restore -U postgres -j 2 --clean --if-exists -d postgres '
+            '/tmp/backup_1.dir') in out
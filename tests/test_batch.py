@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+from invoke.exceptions import UnexpectedExit
+
+from dstack_tasks.base import do, env
+from dstack_tasks.batch import Batch, batch
+
+
+@pytest.fixture(autouse=True)
+def no_dry_run(monkeypatch):
+    monkeypatch.setattr(env, 'dry_run', False)
+
+
+def test_results_are_split_per_command(ctx, tmp_path):
+    with batch(ctx) as current:
+        first = do(ctx, 'printf "one\\ntwo\\n"', hide=True)
+        second = do(ctx, 'printf "no newline"', hide=True)
+        third = do(ctx, 'pwd', path=str(tmp_path), hide=True)
+        fourth = do(ctx, 'echo $GREETING', env={'GREETING': 'hello world'}, hide=True)
+        assert len(current) == 4
+        with pytest.raises(RuntimeError):
+            first.stdout
+
+    assert first.stdout == 'one\ntwo\n'
+    assert second.stdout == 'no newline'
+    assert third.stdout.strip() == str(tmp_path)
+    assert fourth.stdout == 'hello world\n'
+    assert {result.exited for result in (first, second, third, fourth)} == {0}
+
+
+def test_parse_ignores_markers_of_other_batches(ctx):
+    current = Batch(ctx)
+    other = Batch(ctx)
+    current.add('echo a')
+    stdout = (f"\n{current._marker('BEGIN', 0)}\n\n{other._marker('BEGIN', 0)}\nb\n{other._marker('END', 0, '_0')}\n"
+              f"\n{current._marker('END', 0, '_3')}\n")
+
+    output, exited = current.parse(stdout)[0]
+
+    assert exited == 3
+    assert output == f"\n{other._marker('BEGIN', 0)}\nb\n{other._marker('END', 0, '_0')}\n"
+
+
+def test_failure_is_attributed_to_its_command(ctx):
+    with pytest.raises(UnexpectedExit) as error:
+        with batch(ctx):
+            first = do(ctx, 'echo ok', hide=True)
+            failing = do(ctx, 'echo broken; exit 4', hide=True)
+            skipped = do(ctx, 'echo never', hide=True)
+
+    assert error.value.result.command == 'echo broken; exit 4'
+    assert (failing.exited, failing.stdout) == (4, 'broken\n')
+    assert first.exited == 0
+    with pytest.raises(RuntimeError):
+        skipped.stdout
+
+
+def test_warn_continues_with_the_batch(ctx):
+    with batch(ctx):
+        failing = do(ctx, 'exit 2', warn=True, hide=True)
+        last = do(ctx, 'echo done', hide=True)
+
+    assert (failing.exited, last.stdout) == (2, 'done\n')
+
+
+def test_unbatchable_commands_run_right_away(ctx):
+    with batch(ctx) as current:
+        streamed = list(do(ctx, 'echo streamed', stream=True, hide=True))
+        local = do(ctx, 'echo local', local=True, hide=True)
+        assert len(current) == 0
+
+    assert (streamed, local.stdout) == (['streamed'], 'local\n')
+
+
+def test_batch_belongs_to_its_thread(ctx):
+    results = {}
+
+    def other_thread():
+        results['other'] = (env.batch, do(ctx, 'echo other', hide=True).stdout)
+
+    with batch(ctx) as current:
+        queued = do(ctx, 'echo queued', hide=True)
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+        assert len(current) == 1
+
+    assert results['other'] == (None, 'other\n')
+    assert queued.stdout == 'queued\n'
+
+
+def test_batch_is_discarded_on_error(ctx, tmp_path):
+    with pytest.raises(ValueError):
+        with batch(ctx):
+            do(ctx, 'touch created', path=str(tmp_path))
+            raise ValueError()
+
+    assert env.batch is None
+    assert not (tmp_path / 'created').exists()
+
+
+def test_dry_run_prints_commands(ctx, capsys):
+    with batch(ctx, dry_run=True):
+        do(ctx, 'echo one', dry_run=True)
+        do(ctx, 'echo two', dry_run=True)
+
+    out = capsys.readouterr().out
+    assert 'batch of 2 commands' in out
+    assert '1. echo one' in out and '2. echo two' in out
@@ -0,0 +1,59 @@
+import json
+
+from dstack_tasks import benchmark
+from dstack_tasks.base import env
+
+
+def event(name, category, seconds, **args):
+    return {'name': name, 'cat': category, 'dur': int(seconds * 1e6), 'args': args}
+
+
+def test_upload_time_comes_from_s3_spans():
+    events = [
+        event('aws s3 cp old', 'command', 5, command='aws s3 cp old s3://bkt/old'),
+        event('pg_dump', 'command', 2, command='docker exec postgres pg_dump'),
+        event('s3cmd', 'wrapper', 1.5),
+        event('aws s3 sync', 'command', 0.5, command='aws s3 sync dump/ s3://bkt/dump/'),
+    ]
+
+    assert benchmark._phase_seconds(events, 1) == 2.0
+
+
+def test_sizes_and_rates(tmp_path):
+    (tmp_path / 'dump').mkdir()
+    (tmp_path / 'dump' / 'toc.dat').write_bytes(b'x' * 1024)
+    (tmp_path / 'dump' / '3001.dat.gz').write_bytes(b'x' * 2048)
+
+    assert benchmark._directory_size(str(tmp_path / 'dump')) == 3072
+    assert benchmark._mb_per_second(10 * 1024 * 1024, 4) == 2.5
+    assert benchmark._mb_per_second(None, 4) is None
+    assert benchmark._mb_per_second(1024, 0) is None
+
+
+def test_report_is_written_as_json_and_markdown(ctx, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(env, 'dry_run', False)
+    monkeypatch.setattr(env, '_version', '1.2.3')
+    monkeypatch.setattr(benchmark, 'seed', lambda ctx, size_mb: 1000)
+    monkeypatch.setattr(benchmark, 'scalar', lambda ctx, sql: '8000000')
+    modes = []
+
+    def run_mode(ctx, mode, project, data_dir, seeded_rows, replica, interval):
+        modes.append((mode, project, data_dir, seeded_rows, interval))
+        return {'mode': mode, 'backup_seconds': 1.5, 'dump_mb_per_second': 4.0, 'upload_mb_per_second': None,
+                'restore_seconds': 2.0, 'healthy_seconds': 0.5, 'rto_seconds': 2.5, 'rpo_seconds': 3601.5,
+                'verified': True}
+
+    monkeypatch.setattr(benchmark, 'run_mode', run_mode)
+    output = str(tmp_path / 'report')
+
+    report = benchmark.benchmark_backup(ctx, size_mb='10', modes='custom,dedup', interval='3600', project='proj',
+                                        data_dir='/srv/proj', output=output)
+
+    assert modes == [('custom', 'proj', '/srv/proj', 1000, 3600), ('dedup', 'proj', '/srv/proj', 1000, 3600)]
+    with open(output + '.json') as f:
+        assert json.load(f) == report
+    with open(output + '.md') as f:
+        table = f.read()
+    assert table.startswith('# Backup benchmark 1.2.3\n')
+    assert '| custom | 1.5 | 4.0 | - | 2.0 | 0.5 | 2.5 | 3601.5 | True |' in table
+    assert table in capsys.readouterr().out
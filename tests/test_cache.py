@@ -0,0 +1,59 @@
+import time
+
+import pytest
+
+from dstack_tasks.base import do
+from dstack_tasks.cache import QueryCache, query_cache
+
+
+@pytest.fixture
+def cache():
+    cache = QueryCache()
+    for host in ('local', 'web1', 'web2'):
+        cache.set(cache.key('docker ps', None if host == 'local' else host), host, 60)
+    return cache
+
+
+def hosts(cache):
+    return sorted(key[0] for key in cache._entries)
+
+
+def test_read_only_commands_keep_the_cache(cache):
+    cache.invalidate_after('docker', 'ps -a --format "{{.Names}}"', 'web1')
+    cache.invalidate_after('docker-compose', '-p proj logs --tail 10 django', 'web1')
+    cache.invalidate_after('docker-machine', 'ip web1')
+
+    assert hosts(cache) == ['local', 'web1', 'web2']
+
+
+def test_changes_invalidate_only_their_host(cache):
+    cache.invalidate_after('docker-compose', '-p ps up -d django', 'web1')
+    assert hosts(cache) == ['local', 'web2']
+
+    cache.invalidate_after('docker', 'run --rm alpine true')
+    assert hosts(cache) == ['web2']
+
+    cache.invalidate()
+    assert hosts(cache) == []
+
+
+def test_entries_expire(cache):
+    key = cache.key('docker ps', 'web1')
+    cache.set(key, 'result', 0.01)
+    time.sleep(0.02)
+
+    assert cache.get(key) is None
+    assert cache.get(cache.key('docker ps', 'web2')) == 'web2'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_do_reuses_result_within_ttl(ctx, tmp_path):
+    query_cache.invalidate()
+    counter = tmp_path / 'count'
+
+    first = do(ctx, f'echo x >> {counter}; wc -l < {counter}', hide=True, ttl=60)
+    second = do(ctx, f'echo x >> {counter}; wc -l < {counter}', hide=True, ttl=60)
+
+    assert second is first
+    assert counter.read_text() == 'x\n'
+    query_cache.invalidate()
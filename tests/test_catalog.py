@@ -0,0 +1,51 @@
+import sys
+
+import pytest
+from invoke import Config, Context
+
+from dstack_tasks.catalog import BackupCatalog, find_backup, record_backup
+
+
+@pytest.fixture
+def project(s3, tmp_path, monkeypatch):
+    """Context with the catalog in tmp_path and both backup buckets."""
+    monkeypatch.chdir(tmp_path)
+    s3.create_bucket(Bucket='dstack-storage')
+    return Context(Config(overrides={'project_name': 'proj', 'bucket_name': 'bkt'}))
+
+
+def upload(s3, tag):
+    s3.put_object(Bucket='bkt', Key=f'proj/backups/backup_{tag}.pg_dump.gz', Body=b'dump')
+
+
+def test_tag_from_another_host_is_found_after_rebuild(project, s3):
+    record_backup(project, 'proj', '2024-01-02T00-00-00Z_local', 'custom.gz', 'bkt', 'local.pg_dump.gz')
+    upload(s3, '2024-01-01T00-00-00Z_other')
+
+    backup = find_backup(project, 'proj', '2024-01-01T00-00-00Z_other')
+
+    assert backup['format'] == 'custom.gz'
+    assert backup['key'] == 'proj/backups/backup_2024-01-01T00-00-00Z_other.pg_dump.gz'
+    assert find_backup(project, 'proj', 'missing') is None
+
+
+def test_latest_is_refreshed_after_ttl(project, s3, monkeypatch):
+    upload(s3, '2024-01-01T00-00-00Z_nightly')
+    assert find_backup(project, 'proj')['tag'] == '2024-01-01T00-00-00Z_nightly'
+
+    upload(s3, '2024-01-02T00-00-00Z_nightly')
+    assert find_backup(project, 'proj', 'latest')['tag'] == '2024-01-01T00-00-00Z_nightly'
+
+    monkeypatch.setattr(sys.modules['dstack_tasks.catalog'], 'CATALOG_TTL', 0)
+    assert find_backup(project, 'proj', 'latest')['tag'] == '2024-01-02T00-00-00Z_nightly'
+    assert find_backup(project, 'proj', before='2024-01-02')['tag'] == '2024-01-01T00-00-00Z_nightly'
+
+
+def test_rebuild_records_time(project):
+    backups = BackupCatalog()
+    assert backups.expired('proj')
+
+    backups.rebuild('proj', [('bkt', 'proj')])
+
+    assert not backups.expired('proj')
+    assert backups.expired('proj', ttl=-1)
@@ -0,0 +1,112 @@
+import os
+import random
+
+import pytest
+
+from dstack_tasks.chunkstore import ChunkIndex, ChunkStore, chunk_boundaries, chunk_stream
+
+
+def pieces(data, sizes):
+    start = 0
+    for size in sizes:
+        yield data[start:start + size]
+        start += size
+    yield data[start:]
+
+
+@pytest.mark.parametrize('size', [1, 1000, 70000, 300000])
+def test_chunk_stream_matches_boundaries(size):
+    data = random.Random(size).randbytes(3 * 1024 * 1024)
+    options = dict(min_size=16 * 1024, avg_size=64 * 1024, max_size=256 * 1024)
+    expected = [0] + list(chunk_boundaries(data, **options))
+
+    chunks = list(chunk_stream(pieces(data, [size] * (len(data) // size)), **options))
+
+    assert [len(chunk) for chunk in chunks] == [b - a for a, b in zip(expected, expected[1:])]
+    assert b''.join(chunks) == data
+
+
+def sql_dump(rows, seed=0):
+    rng = random.Random(seed)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta', 'theta']
+    return ''.join(f"INSERT INTO accounts VALUES ({i}, 'user{rng.randrange(10 ** 6)}@example.com', "
+                   f"'{' '.join(rng.choice(words) for _ in range(rng.randrange(3, 12)))}', {rng.random():.6f});\n"
+                   for i in range(rows)).encode()
+
+
+def test_insertion_only_changes_nearby_chunks():
+    options = dict(min_size=8 * 1024, avg_size=32 * 1024, max_size=128 * 1024)
+    data = sql_dump(40000)
+    middle = len(data) // 2
+    edited = data[:middle] + b"INSERT INTO accounts VALUES (0, 'new@example.com', 'inserted', 0.5);\n" + data[middle:]
+
+    before = set(chunk_stream([data], **options))
+    after = list(chunk_stream([edited], **options))
+
+    sizes = [len(chunk) for chunk in after]
+    assert max(sizes) < options['max_size'] and sum(sizes) / len(sizes) < 2 * options['avg_size']
+    reused = sum(chunk in before for chunk in after)
+    assert reused >= len(after) - 2
+
+
+def test_chunk_sizes_are_checked():
+    with pytest.raises(ValueError):
+        list(chunk_boundaries(b'data', min_size=16))
+
+
+@pytest.fixture
+def store(s3, tmp_path):
+    index = ChunkIndex(str(tmp_path / 'chunks.sqlite'))
+    yield ChunkStore('bkt', 'proj/dedup', client=s3, index=index, workers=2)
+    index.close()
+
+
+def test_put_deduplicates_and_restores(store, tmp_path):
+    data = os.urandom(3 * 1024 * 1024)
+
+    first = store.put('one', [data])
+    second = store.put('two', [data[:1000], data[1000:]])
+    store.get('two', str(tmp_path / 'restored'))
+
+    assert first['stats']['new_chunks'] == first['stats']['chunks']
+    assert (second['stats']['new_chunks'], second['sha256']) == (0, first['sha256'])
+    assert (tmp_path / 'restored').read_bytes() == data
+
+
+def test_put_uploads_chunks_removed_from_bucket(store, s3, tmp_path):
+    data = os.urandom(3 * 1024 * 1024)
+    manifest = store.put('one', [data])
+    s3.delete_object(Bucket='bkt', Key=store.chunk_key(manifest['chunks'][0][0]))
+
+    # Within the ttl the index is trusted, once it expires the bucket is listed again
+    assert store.put('two', [data])['stats']['new_chunks'] == 0
+    store.index_ttl = 0
+    assert store.put('three', [data])['stats']['new_chunks'] == 1
+
+    store.get('three', str(tmp_path / 'restored'))
+    assert (tmp_path / 'restored').read_bytes() == data
+
+
+def test_index_is_rebuilt_when_expired(store, s3):
+    store.put('one', [os.urandom(1024 * 1024)])
+    s3.put_object(Bucket='bkt', Key=store.chunk_key('ab' * 32), Body=b'x')
+    assert not store.index_expired()
+
+    store.index.set_refreshed(store.prefix, 0)
+    assert store.index_expired()
+    store.put('two', [b'more'])
+
+    assert ('proj/dedup', 'ab' * 32) in store.index
+    assert not store.index_expired()
+
+
+def test_numpy_and_python_hashes_cut_the_same(monkeypatch):
+    pytest.importorskip('numpy')
+    from dstack_tasks import chunkstore
+
+    data = sql_dump(20000, seed=1)
+    options = dict(min_size=8 * 1024, avg_size=32 * 1024, max_size=128 * 1024)
+    expected = list(chunk_boundaries(data, **options))
+
+    monkeypatch.setattr(chunkstore, '_gear_hashes', lambda data, context=b'': None)
+    assert list(chunk_boundaries(data, **options)) == expected
@@ -0,0 +1,59 @@
+import os
+import stat
+
+import pytest
+from invoke import Config, Context
+
+from dstack_tasks.base import env
+from dstack_tasks.wrap import compose_deploy
+
+
+@pytest.fixture
+def compose_log(tmp_path, monkeypatch):
+    """Fake docker-compose on the PATH that logs its start, arguments, BuildKit setting and end."""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    log = tmp_path / 'compose.log'
+    script = bin_dir / 'docker-compose'
+    script.write_text(f'#!/bin/sh\n'
+                      f'echo "start $* $DOCKER_BUILDKIT" >> {log}\n'
+                      f'case "$2" in fail) exit 1;; esac\n'
+                      f'sleep 0.2\n'
+                      f'echo "end $*" >> {log}\n')
+    script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setattr(env, 'dry_run', False)
+
+    def lines():
+        return log.read_text().splitlines()
+    return lines
+
+
+@pytest.fixture
+def project(tmp_path):
+    return Context(Config(overrides={'dir': str(tmp_path), 'run': {'in_stream': False}}))
+
+
+def test_builds_run_concurrently_before_one_up(project, compose_log):
+    pipeline = compose_deploy(project, 'django celery', parallel=2, report=False, hide=True)
+
+    log = compose_log()
+    assert sorted(log[:2]) == ['start build celery 1', 'start build django 1']
+    assert log[-2:] == ['start up -d --no-build django celery ', 'end up -d --no-build django celery']
+    assert pipeline.order()[-1] == 'up'
+    assert all(step.status == 'ok' for step in pipeline.steps.values())
+
+
+def test_without_build_only_up(project, compose_log):
+    compose_deploy(project, ['django'], build=False, report=False, hide=True)
+
+    assert compose_log() == ['start up -d django ', 'end up -d django']
+
+
+def test_failed_build_skips_up(project, compose_log, capsys):
+    with pytest.raises(Exception):
+        compose_deploy(project, 'fail django', parallel=1, hide=True)
+
+    assert not any(line.startswith('start up') for line in compose_log())
+    report = capsys.readouterr().out
+    assert 'build:fail' in report and 'skipped' in report
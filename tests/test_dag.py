@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+from fabric import Connection
+
+from dstack_tasks.dag import Pipeline
+
+
+def test_steps_run_after_their_dependencies(ctx):
+    finished = []
+    lock = threading.Lock()
+
+    def work(ctx, name, seconds=0.0):
+        time.sleep(seconds)
+        with lock:
+            finished.append(name)
+        return name
+
+    pipeline = Pipeline(ctx, workers=3)
+    pipeline.step('upload', work, 'upload', deps=['wheel'])
+    pipeline.step('wheel', work, 'wheel', 0.05, deps=['clean', 'tag'])
+    pipeline.step('clean', work, 'clean', 0.02)
+    pipeline.step('webpack', work, 'webpack', 0.01)
+
+    results = pipeline.run()
+
+    assert pipeline.order() == ['clean', 'wheel', 'upload', 'webpack']
+    assert finished.index('clean') < finished.index('wheel') < finished.index('upload')
+    assert results['upload'] == 'upload'
+    path, total = pipeline.critical_path()
+    assert path == ['clean', 'wheel', 'upload']
+    assert total >= 0.07
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_failure_skips_dependent_steps(ctx, workers):
+    def fail(ctx):
+        raise RuntimeError('build failed')
+
+    pipeline = Pipeline(ctx, workers=workers)
+    pipeline.step('build', fail)
+    pipeline.step('up', lambda ctx: None, deps=['build'])
+
+    with pytest.raises(RuntimeError):
+        pipeline.run()
+    assert [pipeline.steps[name].status for name in ('build', 'up')] == ['failed', 'skipped']
+    assert 'critical path: build' in pipeline.report()
+
+
+def test_circular_dependency():
+    pipeline = Pipeline(None)
+    pipeline.step('a', None, deps=['b'])
+    pipeline.step('b', None, deps=['a'])
+
+    with pytest.raises(ValueError, match='Circular dependency: a -> b -> a'):
+        pipeline.order()
+
+
+def test_remote_steps_keep_user_and_port():
+    seen = []
+    connection = Connection('web1', user='deploy', port=2222)
+
+    pipeline = Pipeline(connection, workers=2)
+    for name in ('release', 'deploy'):
+        pipeline.step(name, lambda ctx: seen.append((ctx.host, ctx.user, ctx.port)))
+    pipeline.run()
+
+    assert seen == [('web1', 'deploy', 2222)] * 2
@@ -0,0 +1,157 @@
+import io
+import json
+import os
+import shutil
+import socketserver
+import struct
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from dstack_tasks.engine import API_VERSION, DockerAPIError, DockerEngine, demultiplex
+
+
+def frame(stream, data):
+    return struct.pack('>BxxxL', stream, len(data)) + data
+
+
+class FakeDocker(BaseHTTPRequestHandler):
+    """Docker Engine API stand-in, records requests on the server and answers from `routes`."""
+    protocol_version = 'HTTP/1.1'
+
+    routes = {
+        ('GET', '/containers/json'): (200, [{'Names': ['/proj_postgres_1'], 'State': 'running'},
+                                            {'Names': ['/proj_web_1', '/alias'], 'State': 'exited'}]),
+        ('GET', '/containers/proj_postgres_1/json'): (200, {'State': {'Running': True}}),
+        ('GET', '/containers/missing/json'): (404, {'message': 'No such container: missing'}),
+        ('POST', '/containers/proj_postgres_1/exec'): (201, {'Id': 'e1'}),
+        ('POST', '/exec/e1/start'): (200, frame(1, b'hello ') + frame(2, b'warning\n') + frame(1, b'world\n')),
+        ('GET', '/exec/e1/json'): (200, {'ExitCode': 3}),
+        ('DELETE', '/volumes/gone'): (404, {'message': 'get gone: no such volume'}),
+        ('GET', '/events'): (200, b'{"status": "health_status: healthy"}\n\n{"status": "die"}\n'),
+    }
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        path, _, query = self.path.partition('?')
+        self.server.requests.append((self.command, path, query, body))
+        status, payload = self.routes.get((self.command, path[len(f'/{API_VERSION}'):]), (404, {'message': 'none'}))
+        if isinstance(payload, bytes):
+            content_type = 'application/vnd.docker.raw-stream'
+        else:
+            payload, content_type = json.dumps(payload).encode(), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        if self.server.close_after:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_DELETE = handle_request
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def docker():
+    directory = tempfile.mkdtemp()
+    server = socketserver.ThreadingUnixStreamServer(os.path.join(directory, 'docker.sock'), FakeDocker)
+    server.daemon_threads = True
+    server.requests, server.connections, server.close_after = [], 0, False
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    engine = DockerEngine(server.server_address)
+    yield engine, server
+    engine.close()
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(directory)
+
+
+def test_requests_reuse_one_connection(docker):
+    engine, server = docker
+
+    assert engine.container_names() == ['proj_postgres_1', 'proj_web_1']
+    assert engine.inspect('proj_postgres_1')['State']['Running'] is True
+    engine.containers(filters={'name': ['proj']})
+
+    assert server.connections == 1
+    assert server.requests[0][2] == 'all=1'
+    assert 'filters=%7B%22name%22' in server.requests[2][2]
+
+
+def test_reconnects_when_daemon_closes_connection(docker):
+    engine, server = docker
+    server.close_after = True
+
+    engine.inspect('proj_postgres_1')
+    engine.inspect('proj_postgres_1')
+
+    assert len(server.requests) == 2
+    assert server.connections == 2
+
+
+def test_error_status_raises(docker):
+    engine, _ = docker
+
+    with pytest.raises(DockerAPIError) as info:
+        engine.inspect('missing')
+
+    assert info.value.status == 404
+    assert 'No such container' in str(info.value)
+
+
+def test_remove_missing_volume(docker):
+    engine, server = docker
+
+    engine.remove_volume('gone', missing_ok=True)
+    with pytest.raises(DockerAPIError):
+        engine.remove_volume('gone')
+    assert server.requests[0][:3] == ('DELETE', f'/{API_VERSION}/volumes/gone', 'force=0')
+
+
+def test_exec_run_splits_streams(docker):
+    engine, server = docker
+
+    result = engine.exec_run('proj_postgres_1', 'pg_isready', user='postgres', env={'PGHOST': 'db'})
+
+    assert (result.stdout, result.stderr, result.exit_code, result.ok) == (b'hello world\n', b'warning\n', 3, False)
+    config = server.requests[0][3]
+    assert config['Cmd'] == ['sh', '-c', 'pg_isready']
+    assert (config['User'], config['Env']) == ('postgres', ['PGHOST=db'])
+
+
+def test_exec_to_file_writes_stdout(docker):
+    engine, _ = docker
+    fileobj = io.BytesIO()
+
+    result = engine.exec_to_file('proj_postgres_1', ['pg_dump'], fileobj)
+
+    assert fileobj.getvalue() == b'hello world\n'
+    assert (result.stdout, result.stderr) == (b'', b'warning\n')
+
+
+def test_events_skips_blank_lines(docker):
+    engine, server = docker
+
+    events = list(engine.events({'event': ['health_status']}, since=10.5, until=20))
+
+    assert [event['status'] for event in events] == ['health_status: healthy', 'die']
+    assert 'since=10&until=20' in server.requests[0][2]
+
+
+def test_demultiplex_reads_large_frames_in_chunks():
+    data = frame(1, b'a' * 10) + frame(2, b'b' * 3) + b'\x01\x00'
+
+    frames = list(demultiplex(io.BytesIO(data), chunk_size=4))
+
+    assert frames == [(1, b'aaaa'), (1, b'aaaa'), (1, b'aa'), (2, b'bbb')]
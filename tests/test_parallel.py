@@ -0,0 +1,110 @@
+import pytest
+
+from dstack_tasks.base import do
+from dstack_tasks.parallel import fan, run_on_hosts, summary_table
+
+# 'local' and 'localhost' run the task locally, so they stand in for real hosts
+HOSTS = ['local', 'localhost']
+
+
+def echo_hello(ctx):
+    do(ctx, 'echo hello')
+
+
+def test_output_is_prefixed_per_host(ctx, capsys):
+    results = run_on_hosts(ctx, echo_hello, HOSTS, workers=2)
+
+    assert [item.status for item in results] == ['ok', 'ok']
+    lines = capsys.readouterr().out.splitlines()
+    for host in HOSTS:
+        assert any(f'[{host}]' in line and line.endswith(' hello') for line in lines), lines
+
+
+def test_continue_on_error(ctx):
+    calls = []
+
+    def task(ctx):
+        calls.append(ctx)
+        if len(calls) == 1:
+            raise RuntimeError('boom')
+
+    results = run_on_hosts(ctx, task, HOSTS, workers=1)
+
+    assert [item.status for item in results] == ['failed', 'ok']
+    assert isinstance(results[0].error, RuntimeError)
+    assert len(calls) == 2
+
+
+def test_fail_fast_skips_remaining_hosts(ctx):
+    calls = []
+
+    def task(ctx):
+        calls.append(ctx)
+        raise RuntimeError('boom')
+
+    results = run_on_hosts(ctx, task, HOSTS, workers=1, fail_fast=True)
+
+    assert [item.status for item in results] == ['failed', 'skipped']
+    assert len(calls) == 1
+
+
+def test_summary_table(ctx):
+    calls = []
+
+    def task(ctx):
+        calls.append(ctx)
+        if len(calls) == 2:
+            raise ValueError('second host failed\nwith details')
+
+    table = summary_table(run_on_hosts(ctx, task, HOSTS, workers=1))
+    lines = table.splitlines()
+
+    assert lines[0].split() == ['host', 'status', 'time', 'error']
+    assert lines[1].split()[:2] == ['local', 'ok']
+    assert lines[2].split()[:2] == ['localhost', 'failed']
+    assert lines[2].endswith('ValueError: second host failed')
+    assert lines[-1] == '1/2 hosts succeeded'
+
+
+def test_fan_task_raises_when_a_host_fails(ctx, monkeypatch, capsys):
+    import dstack_tasks
+
+    calls = []
+
+    def task(ctx, cmd=None):
+        calls.append(cmd)
+        if len(calls) == 1:
+            raise RuntimeError('boom')
+
+    monkeypatch.setitem(dstack_tasks.ns.tasks, 'flaky', task)
+    with pytest.raises(RuntimeError, match='flaky failed on 1 of 2 host'):
+        fan(ctx, 'flaky', hosts=','.join(HOSTS), workers=1, args='cmd=check')
+
+    assert calls == ['check', 'check']
+    assert '1/2 hosts succeeded' in capsys.readouterr().out
+
+
+def test_task_arguments_use_default_types():
+    from dstack_tasks.parallel import task_arguments
+    from dstack_tasks.tasks import db
+
+    kwargs = task_arguments(db, 'cmd=check,replica=False,sync=yes,jobs=4,tag=true')
+
+    assert kwargs == {'cmd': 'check', 'replica': False, 'sync': True, 'jobs': '4', 'tag': True}
+    with pytest.raises(ValueError):
+        task_arguments(db, 'replica=maybe')
+
+
+def test_fork_context_keeps_connection_settings():
+    from fabric import Connection
+
+    from dstack_tasks.parallel import fork_context
+
+    connection = Connection('db1', user='deploy', port=2222, connect_kwargs={'key_filename': 'id_deploy'})
+
+    forked = fork_context(connection)
+    other = fork_context(connection, 'admin@db2:2200')
+
+    assert (forked.host, forked.user, forked.port) == ('db1', 'deploy', 2222)
+    assert forked.connect_kwargs == connection.connect_kwargs
+    assert (other.host, other.user, other.port) == ('db2', 'admin', 2200)
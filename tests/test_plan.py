@@ -0,0 +1,59 @@
+import io
+
+import pytest
+
+from dstack_tasks.base import do, env
+from dstack_tasks.plan import Plan, plan_key, unreplayable
+
+
+@pytest.fixture
+def plan(monkeypatch):
+    plan = Plan()
+    monkeypatch.setattr(env, 'dry_run', True)
+    monkeypatch.setattr(env, 'plan', plan)
+    return plan
+
+
+def test_record_and_replay(ctx, plan, tmp_path, monkeypatch, capfd):
+    do(ctx, 'echo "$GREETING" > out.txt', path=str(tmp_path), env={'GREETING': 'hi'})
+    do(ctx, 'cat >> out.txt', path=str(tmp_path), in_stream=io.StringIO('from stdin\n'), hide=True)
+    plan.save(str(tmp_path / 'plan.json'))
+    capfd.readouterr()
+
+    monkeypatch.setattr(env, 'dry_run', False)
+    monkeypatch.setattr(env, 'plan', None)
+    results = Plan.load(str(tmp_path / 'plan.json')).execute(ctx)
+
+    assert [result.exited for result in results] == [0, 0]
+    assert (tmp_path / 'out.txt').read_text() == 'hi\nfrom stdin\n'
+    assert plan.steps[1]['stdin'] == 'from stdin\n' and plan.steps[1]['kwargs'] == {'hide': True}
+
+
+def test_unreplayable_plan_is_not_executed(ctx, plan, monkeypatch):
+    do(ctx, 'touch should-not-exist')
+    unreplayable('wait until postgres is ready')
+    do(ctx, 'cat', in_stream=open(__file__))
+
+    assert not plan.replayable
+    assert plan.unreplayable_steps() == ['wait until postgres is ready', 'cat reads stdin from TextIOWrapper']
+    monkeypatch.setattr(env, 'dry_run', False)
+    with pytest.raises(RuntimeError, match='wait until postgres is ready'):
+        plan.execute(ctx)
+
+
+def test_plan_key_covers_environment(tmp_path, monkeypatch):
+    (tmp_path / '.env').write_text('PROJECT_NAME=proj\n')
+    monkeypatch.setenv('S3_BUCKET_NAME', 'bkt')
+    monkeypatch.delenv('HOST_NAMES', raising=False)
+    key = plan_key(['dstack', 'e', 'deploy-code'], str(tmp_path))
+
+    monkeypatch.setenv('TELEGRAM_BOT_TOKEN', 'secret')
+    assert plan_key(['dstack', 'e', 'deploy-code'], str(tmp_path)) == key
+    monkeypatch.setenv('HOST_NAMES', 'web1,web2')
+    assert plan_key(['dstack', 'e', 'deploy-code'], str(tmp_path)) != key
+    monkeypatch.delenv('HOST_NAMES')
+    monkeypatch.setenv('S3_BUCKET_NAME', 'other')
+    assert plan_key(['dstack', 'e', 'deploy-code'], str(tmp_path)) != key
+    (tmp_path / '.env').write_text('PROJECT_NAME=other\n')
+    monkeypatch.setenv('S3_BUCKET_NAME', 'bkt')
+    assert plan_key(['dstack', 'e', 'deploy-code'], str(tmp_path)) != key
@@ -0,0 +1,116 @@
+import pytest
+
+from dstack_tasks import pool as pool_module
+from dstack_tasks.pool import ConnectionPool, parse_host
+
+
+class FakeConnection(object):
+    def __init__(self, host, user, port):
+        self.key = (host, user, port)
+        self.client = object()
+        self.transport = object()
+        self.is_connected = True
+
+    def close(self):
+        self.is_connected = False
+
+
+class FakePool(ConnectionPool):
+    """Pool that opens fake connections instead of SSH transports."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.opened = []
+
+    def _open(self, host, user, port, config, connect_kwargs):
+        self.opened.append(FakeConnection(host, user, port))
+        return self.opened[-1]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(pool_module.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_parse_host():
+    assert parse_host('ubuntu@example.com:2222') == ('example.com', 'ubuntu', 2222)
+    assert parse_host('example.com', user='root', port='22') == ('example.com', 'root', 22)
+    assert parse_host('example.com') == ('example.com', None, None)
+
+
+def test_connections_are_shared_per_host_user_and_port():
+    pool = FakePool()
+
+    first = pool.get('web1', user='deploy', port=22)
+    second = pool.get('deploy@web1:22')
+    other = pool.get('web1', user='root', port=22)
+
+    assert first is not second
+    assert first.transport is second.transport is pool.opened[0].transport
+    assert other.transport is pool.opened[1].transport
+    assert pool.stats() == {'hits': 1, 'misses': 2, 'evictions': 0, 'open': 2, 'in_use': 3}
+
+
+def test_release_only_counts_leased_connections():
+    pool = FakePool()
+    connection = pool.get('web1', user='deploy', port=22)
+
+    pool.release(connection)
+    pool.release(connection)
+    pool.release(object())
+
+    assert pool.stats()['in_use'] == 0
+
+
+def test_idle_connections_are_evicted(clock):
+    pool = FakePool(idle_timeout=60)
+    pool.release(pool.get('web1', user='deploy', port=22))
+
+    clock[0] += 61
+    pool.get('web1', user='deploy', port=22)
+
+    assert not pool.opened[0].is_connected
+    assert len(pool.opened) == 2
+    assert pool.stats()['evictions'] == 1
+
+
+def test_connections_in_use_are_not_evicted(clock):
+    pool = FakePool(idle_timeout=60)
+    connection = pool.get('web1', user='deploy', port=22)
+
+    clock[0] += 600
+    pool.evict_idle()
+    assert pool.opened[0].is_connected
+
+    # The idle time counts from the release
+    pool.release(connection)
+    clock[0] += 30
+    pool.evict_idle()
+    assert pool.opened[0].is_connected
+    clock[0] += 31
+    pool.evict_idle()
+    assert not pool.opened[0].is_connected
+
+
+def test_disconnected_connections_are_replaced():
+    pool = FakePool(idle_timeout=0)
+    pool.release(pool.get('web1', user='deploy', port=22))
+    pool.opened[0].is_connected = False
+
+    connection = pool.get('web1', user='deploy', port=22)
+
+    assert connection.transport is pool.opened[1].transport
+    assert pool.stats()['misses'] == 2
+
+
+def test_close_all():
+    pool = FakePool()
+    pool.get('web1', user='deploy', port=22)
+    pool.get('web2', user='deploy', port=22)
+
+    pool.close_all()
+
+    assert not any(connection.is_connected for connection in pool.opened)
+    assert pool.stats()['open'] == 0
@@ -0,0 +1,68 @@
+import sys
+
+import pytest
+from invoke import Config, Context
+
+from dstack_tasks import wrap
+from dstack_tasks.base import env
+from dstack_tasks.batch import batch
+
+
+@pytest.fixture
+def venv(tmp_path, monkeypatch):
+    """Context whose activation command logs each activation and puts a python symlink first on the PATH."""
+    bin_dir = tmp_path / 'venv' / 'bin'
+    bin_dir.mkdir(parents=True)
+    (bin_dir / 'python').symlink_to(sys.executable)
+    log = tmp_path / 'activations.log'
+    activate = f'echo activated >> {log} && export PATH={bin_dir}:$PATH'
+    monkeypatch.setattr(wrap, '_interpreters', {})
+    monkeypatch.setattr(env, 'dry_run', False)
+    ctx = Context(Config(overrides={'activate': activate, 'run': {'in_stream': False}}))
+
+    def activations():
+        return len(log.read_text().splitlines()) if log.exists() else 0
+    return ctx, str(bin_dir / 'python'), activations
+
+
+def test_interpreter_is_resolved_once(venv):
+    ctx, python_path, activations = venv
+
+    first = wrap.python(ctx, cmd='-c "import sys; print(sys.prefix)"', hide=True)
+    second = wrap.pip(ctx, cmd='--version', hide=True)
+
+    assert activations() == 1
+    assert wrap.interpreter(ctx) == python_path
+    assert first.command.startswith(python_path + ' ')
+    assert second.command.startswith(f'{python_path} -m pip')
+
+
+def test_interpreter_is_cached_per_working_directory(venv, tmp_path):
+    ctx, python_path, activations = venv
+
+    wrap.interpreter(ctx)
+    wrap.interpreter(ctx, path=str(tmp_path))
+
+    assert activations() == 2
+
+
+def test_failed_resolution_falls_back_to_activation(venv):
+    ctx, python_path, activations = venv
+    ctx.activate = 'false'
+
+    assert wrap.interpreter(ctx) is None
+    result = wrap.python(ctx, cmd='-c "print(1)"', warn=True, hide=True)
+
+    assert result.command.startswith('false && python')
+
+
+def test_nothing_runs_in_dry_run_or_batch(venv, monkeypatch):
+    ctx, python_path, activations = venv
+
+    with batch(ctx):
+        assert wrap.interpreter(ctx) is None
+    monkeypatch.setattr(env, 'dry_run', True)
+    assert wrap.interpreter(ctx) is None
+
+    assert activations() == 0
+    assert wrap._interpreters == {}
@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+from dstack_tasks import ready
+from dstack_tasks.base import env
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fake perf_counter that only advances when sleeping. Yields the list of sleeps."""
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(round(seconds, 3))
+        now[0] += seconds
+
+    monkeypatch.setattr(ready.time, 'perf_counter', lambda: now[0])
+    monkeypatch.setattr(ready.time, 'sleep', sleep)
+    monkeypatch.setattr(env, 'dry_run', False)
+    return sleeps
+
+
+def states(monkeypatch, *values):
+    """Let container_state return values one after the other, repeating the last one."""
+    values = list(values)
+
+    def container_state(ctx, container):
+        return values.pop(0) if len(values) > 1 else values[0]
+
+    monkeypatch.setattr(ready, 'container_state', container_state)
+
+
+def test_backoff_doubles_up_to_maximum_and_stops_at_timeout(clock):
+    elapsed = list(ready.backoff(4, initial=0.5, maximum=1.0))
+
+    assert clock == [0.5, 1.0, 1.0, 1.0, 0.5]
+    assert elapsed[-1] == 4.0
+
+
+def test_waits_for_created_container_to_run(ctx, clock, monkeypatch):
+    states(monkeypatch, ('missing', False), ('missing', False), ('none', True))
+
+    assert ready.wait_ready(ctx, 'web', timeout=10) == pytest.approx(0.3)
+
+
+def test_healthcheck_is_awaited_with_events(ctx, clock, monkeypatch):
+    states(monkeypatch, ('starting', True))
+    waits = []
+
+    def wait_health_events(ctx, container, timeout):
+        waits.append(timeout)
+        return None if len(waits) == 1 else 'healthy'
+
+    monkeypatch.setattr(ready, '_wait_health_events', wait_health_events)
+
+    ready.wait_ready(ctx, 'web', timeout=10)
+
+    # No event in the first wait, the container was inspected again before waiting for events once more
+    assert waits == [10.0, pytest.approx(9.9)]
+
+
+def test_unhealthy_container_raises(ctx, clock, monkeypatch):
+    states(monkeypatch, ('starting', True))
+    monkeypatch.setattr(ready, '_wait_health_events', lambda ctx, container, timeout: 'unhealthy')
+
+    with pytest.raises(TimeoutError, match='web not ready after .*: unhealthy'):
+        ready.wait_ready(ctx, 'web', timeout=10)
+
+
+def test_postgres_without_healthcheck_uses_pg_isready(ctx, clock, monkeypatch):
+    states(monkeypatch, ('none', False))
+    monkeypatch.setattr(ready, '_wait_pg_isready', lambda ctx, container, timeout: True)
+
+    assert ready.wait_ready(ctx, 'postgres', timeout=10, postgres=True) == 0.0
+
+
+def test_timeout_from_env_when_container_never_runs(ctx, clock, monkeypatch):
+    states(monkeypatch, ('missing', False))
+    monkeypatch.setenv('READY_TIMEOUT', '3')
+
+    with pytest.raises(TimeoutError, match='web not ready after 3.0s: missing'):
+        ready.wait_ready(ctx, 'web')
+    assert sum(clock) == pytest.approx(3.0)
+
+
+def test_dry_run_prints_wait(ctx, monkeypatch, capsys):
+    monkeypatch.setattr(env, 'dry_run', True)
+    monkeypatch.setattr(env, 'plan', None)
+
+    assert ready.wait_ready(ctx, 'web', timeout=30) == 0.0
+    assert '# wait until web is ready (timeout 30s)' in capsys.readouterr().out
+
+
+def test_health_events_from_docker_cli(ctx, tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'docker'
+    script.write_text('#!/bin/sh\necho "health_status: starting"\necho "health_status: healthy"\nsleep 30\n')
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}:{os.environ["PATH"]}')
+    monkeypatch.setattr(env, 'dry_run', False)
+
+    # Returns on the event without waiting for the stream to end
+    assert ready._wait_health_events(ctx, 'web', 20) == 'healthy'
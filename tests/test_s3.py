@@ -0,0 +1,217 @@
+import hashlib
+import io
+import json
+import os
+import pathlib
+
+import pytest
+from invoke import Config, Context
+
+from dstack_tasks.base import env
+from dstack_tasks.s3 import download_ranged, transfer_config, upload_file, upload_stream
+from dstack_tasks.wrap import filer, s3cmd
+
+
+@pytest.fixture
+def project(tmp_path):
+    """Context for a project in tmp_path with the given S3 engine."""
+    def make(engine='boto3'):
+        return Context(Config(overrides={'dir': str(tmp_path), 'bucket_name': 'bkt', 's3_engine': engine,
+                                         'run': {'in_stream': False}}))
+    return make
+
+
+def test_upload_and_download_with_simple_path(s3, project, tmp_path):
+    (tmp_path / 'dist').mkdir()
+    (tmp_path / 'dist' / 'app.whl').write_bytes(b'wheel')
+
+    s3cmd(project(), simple_path='dist/app.whl', direction='up', project_name='proj')
+    assert s3.get_object(Bucket='bkt', Key='proj/dist/app.whl')['Body'].read() == b'wheel'
+
+    os.remove(tmp_path / 'dist' / 'app.whl')
+    result = s3cmd(project(), simple_path='dist/app.whl', direction='down', project_name='proj')
+    assert (tmp_path / 'dist' / 'app.whl').read_bytes() == b'wheel'
+    assert result.stdout.startswith('download: s3://bkt/proj/dist/app.whl')
+
+
+def test_sync_only_transfers_changed_files(s3, project, tmp_path):
+    static = tmp_path / 'static'
+    (static / 'css').mkdir(parents=True)
+    (static / 'css' / 'site.css').write_text('body {}')
+    (static / 'app.js').write_text('let a')
+
+    first = s3cmd(project(), cmd='sync', local_path='static/', s3_path='proj/static/')
+    second = s3cmd(project(), cmd='sync', local_path='static/', s3_path='proj/static/')
+
+    assert len(first.stdout.splitlines()) == 2
+    assert second.stdout == ''
+    keys = sorted(item['Key'] for item in s3.list_objects_v2(Bucket='bkt', Prefix='proj/')['Contents'])
+    assert keys == ['proj/static/app.js', 'proj/static/css/site.css']
+
+    s3cmd(project(), cmd='sync', direction='down', local_path='copy/', s3_path='proj/static/')
+    assert (tmp_path / 'copy' / 'css' / 'site.css').read_text() == 'body {}'
+
+
+def test_multipart_upload_uses_chunk_size(s3, tmp_path):
+    path = tmp_path / 'dump'
+    path.write_bytes(os.urandom(11 * 1024 * 1024))
+
+    upload_file(str(path), 's3://bkt/dump', client=s3, config=transfer_config(chunk_size=5 * 1024 * 1024))
+
+    head = s3.head_object(Bucket='bkt', Key='dump')
+    assert head['ContentLength'] == 11 * 1024 * 1024
+    assert head['ETag'].strip('"').endswith('-3')
+
+
+def test_filer_accepts_content_types(s3, tmp_path):
+    path = tmp_path / 'recipe.yaml'
+    path.write_text('name: app\n')
+    contents = {
+        'str': ('héllo', 'héllo'.encode('utf-8')),
+        'bytes': (b'\x00\x01', b'\x00\x01'),
+        'path': (pathlib.Path(str(path)), b'name: app\n'),
+        'text-file': (io.StringIO('text file'), b'text file'),
+        'binary-file': (io.BytesIO(b'binary file'), b'binary file'),
+        'chunks': (iter(['a', b'b', 'c']), b'abc'),
+    }
+
+    for key, (content, expected) in contents.items():
+        filer(content, key, bucket_name='bkt')
+
+        assert s3.get_object(Bucket='bkt', Key=key)['Body'].read() == expected
+
+
+def test_streamed_chunks_use_multipart_upload(s3):
+    chunk = os.urandom(1024 * 1024)
+
+    upload_stream((chunk for _ in range(11)), 'bkt', 'dump', client=s3,
+                  config=transfer_config(chunk_size=5 * 1024 * 1024))
+
+    head = s3.head_object(Bucket='bkt', Key='dump')
+    assert head['ContentLength'] == 11 * 1024 * 1024
+    assert head['ETag'].strip('"').endswith('-3')
+
+
+def test_filer_dry_run_prints_upload(monkeypatch, capsys):
+    monkeypatch.setattr(env, 'plan', None)
+
+    filer('some long content', 'recipes/app.yaml', bucket_name='bkt', dry_run=True)
+    filer(pathlib.Path('recipe.yaml'), 'recipes/app.yaml', bucket_name='bkt', dry_run=True)
+
+    out = capsys.readouterr().out
+    assert "aws s3 cp --quiet 'some long '... s3://bkt/recipes/app.yaml" in out
+    assert 'aws s3 cp --quiet recipe.yaml s3://bkt/recipes/app.yaml' in out
+
+
+def test_dry_run_matches_cli(project, monkeypatch, capsys):
+    monkeypatch.setattr(env, 'dry_run', True)
+
+    s3cmd(project('cli'), simple_path='dist/app.whl', direction='up', project_name='proj')
+    cli = capsys.readouterr().out
+    s3cmd(project('boto3'), simple_path='dist/app.whl', direction='up', project_name='proj')
+
+    assert capsys.readouterr().out == cli
+    assert 'aws s3 cp --quiet dist/app.whl s3://bkt/proj/dist/app.whl' in cli
+
+
+class FlakyClient(object):
+    """Client wrapper that records ranged GETs and fails the part starting at `fail_at`."""
+
+    def __init__(self, client, fail_at=None):
+        self.client = client
+        self.fail_at = fail_at
+        self.ranges = []
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def get_object(self, **kwargs):
+        if 'Range' not in kwargs:
+            return self.client.get_object(**kwargs)
+        self.ranges.append(kwargs['Range'])
+        if self.fail_at is not None and kwargs['Range'].startswith(f'bytes={self.fail_at}-'):
+            raise ConnectionResetError('connection lost')
+        return self.client.get_object(**kwargs)
+
+
+def test_download_ranged_assembles_parts(s3, tmp_path):
+    data = os.urandom(10 * 1024 + 7)
+    s3.put_object(Bucket='bkt', Key='backups/db.dump', Body=data)
+    spy = FlakyClient(s3)
+
+    message = download_ranged('s3://bkt/backups/db.dump', str(tmp_path) + '/', client=spy, part_size=1024)
+
+    assert (tmp_path / 'db.dump').read_bytes() == data
+    assert message == f'download: s3://bkt/backups/db.dump to {tmp_path}/db.dump'
+    assert len(spy.ranges) == 11 and 'bytes=10240-10246' in spy.ranges
+    assert sorted(os.listdir(tmp_path)) == ['db.dump']
+
+
+def test_download_ranged_verifies_sha256(s3, tmp_path):
+    data = b'dump' * 1000
+    s3.put_object(Bucket='bkt', Key='db.dump', Body=data)
+    s3.put_object(Bucket='bkt', Key='db.dump.sha256', Body=f'{hashlib.sha256(b"other").hexdigest()}  db.dump\n')
+    target = str(tmp_path / 'db.dump')
+
+    with pytest.raises(ValueError, match='Checksum mismatch'):
+        download_ranged('s3://bkt/db.dump', target, client=s3, part_size=1024)
+    assert os.listdir(tmp_path) == []
+
+    s3.put_object(Bucket='bkt', Key='db.dump.sha256', Body=f'{hashlib.sha256(data).hexdigest()}  db.dump\n')
+    download_ranged('s3://bkt/db.dump', target, client=s3, part_size=1024)
+    with pytest.raises(ValueError):
+        download_ranged('s3://bkt/db.dump', target, client=s3, sha256='0' * 64)
+
+
+def test_download_ranged_resumes_missing_parts(s3, tmp_path):
+    data = os.urandom(8 * 1024)
+    s3.put_object(Bucket='bkt', Key='db.dump', Body=data)
+    target = str(tmp_path / 'db.dump')
+
+    with pytest.raises(ConnectionResetError):
+        download_ranged('s3://bkt/db.dump', target, client=FlakyClient(s3, fail_at=5 * 1024), part_size=1024,
+                        workers=1)
+    assert not os.path.exists(target)
+    with open(target + '.part.json') as f:
+        done = json.load(f)['done']
+    assert done[:5] == [0, 1, 2, 3, 4] and 5 not in done
+
+    spy = FlakyClient(s3)
+    download_ranged('s3://bkt/db.dump', target, client=spy, part_size=1024, workers=1)
+
+    assert open(target, 'rb').read() == data
+    assert spy.ranges == [f'bytes={i * 1024}-{i * 1024 + 1023}' for i in range(8) if i not in done]
+
+
+def test_download_ranged_restarts_for_changed_object(s3, tmp_path):
+    s3.put_object(Bucket='bkt', Key='db.dump', Body=os.urandom(4 * 1024))
+    target = str(tmp_path / 'db.dump')
+    with pytest.raises(ConnectionResetError):
+        download_ranged('s3://bkt/db.dump', target, client=FlakyClient(s3, fail_at=2048), part_size=1024, workers=1)
+
+    data = os.urandom(4 * 1024)
+    s3.put_object(Bucket='bkt', Key='db.dump', Body=data)
+    spy = FlakyClient(s3)
+    download_ranged('s3://bkt/db.dump', target, client=spy, part_size=1024, workers=1)
+
+    assert open(target, 'rb').read() == data
+    assert len(spy.ranges) == 4
+
+
+def test_download_ranged_skips_md5_for_kms_objects(s3, tmp_path):
+    class KmsClient(FlakyClient):
+        # With SSE-KMS the ETag is not the md5 of the content
+        def head_object(self, **kwargs):
+            return dict(self.client.head_object(**kwargs), ETag='"0123456789abcdef0123456789abcdef"',
+                        ServerSideEncryption='aws:kms')
+
+        def get_object(self, **kwargs):
+            kwargs.pop('IfMatch', None)
+            return super().get_object(**kwargs)
+
+    data = os.urandom(3000)
+    s3.put_object(Bucket='bkt', Key='db.dump', Body=data)
+
+    download_ranged('s3://bkt/db.dump', str(tmp_path / 'db.dump'), client=KmsClient(s3), part_size=1024)
+
+    assert (tmp_path / 'db.dump').read_bytes() == data
@@ -0,0 +1,94 @@
+import re
+
+import pytest
+from invoke.runners import Result
+
+from dstack_tasks import wrap
+from dstack_tasks.base import env
+from dstack_tasks.sql import Query, Session, literal
+
+
+@pytest.fixture
+def psql(monkeypatch):
+    """Stand-in for `compose` that answers each statement of the script from a dictionary of SQL to output lines."""
+    answers = {}
+    calls = []
+
+    def compose(ctx, cmd, in_stream=None, **kwargs):
+        script = in_stream.read()
+        calls.append((cmd, script, kwargs))
+        lines = []
+        for marker, sql in re.findall(r'^\\echo (\S+)\n(.*);$', script, re.M):
+            lines.append(marker)
+            lines.extend(answers.get(sql, []))
+        return Result(stdout='\n'.join(lines) + '\n', command=cmd)
+
+    monkeypatch.setattr(wrap, 'compose', compose)
+    monkeypatch.setattr(env, 'dry_run', False)
+    return answers, calls
+
+
+def test_literal():
+    assert literal("it's") == "'it''s'"
+    assert (literal(None), literal(True), literal(3)) == ('NULL', 'TRUE', '3')
+
+
+def test_statements_are_sent_in_one_exec(ctx, psql):
+    answers, calls = psql
+    answers['SELECT tag, size FROM backup_log'] = ['tag\x00size', 'a\x0010', 'b\x00']
+    answers['SELECT count(*) FROM backup_log'] = ['count', '2']
+
+    with Session(ctx, database='app', single_transaction=True) as session:
+        created = session.execute('CREATE TABLE IF NOT EXISTS backup_log (tag VARCHAR(255), size BIGINT);')
+        tags = session.query('SELECT tag, size FROM backup_log')
+        count = session.query('SELECT count(*) FROM backup_log')
+
+    (cmd, script, kwargs), = calls
+    assert cmd == 'exec -T postgres psql -U postgres -d app -X -q -A -z -P footer=off -v ON_ERROR_STOP=1 -1 -f -'
+    assert kwargs == {'hide': True}
+    assert script.count('\\echo __DSTACK_SQL_') == 3
+    assert (created.columns, created.scalar()) == ([], None)
+    assert tags.rows == [{'tag': 'a', 'size': '10'}, {'tag': 'b', 'size': ''}]
+    assert count.scalar() == '2'
+
+
+def test_markers_of_other_sessions_are_output(ctx, psql):
+    answers, calls = psql
+    answers["SELECT '__DSTACK_SQL_other_1__' AS line"] = ['line', '__DSTACK_SQL_other_1__']
+
+    with Session(ctx) as session:
+        query = session.query("SELECT '__DSTACK_SQL_other_1__' AS line")
+
+    assert query.scalar() == '__DSTACK_SQL_other_1__'
+
+
+def test_failed_body_does_not_run(ctx, psql):
+    answers, calls = psql
+
+    with pytest.raises(ValueError):
+        with Session(ctx) as session:
+            session.execute('DROP TABLE backup_log')
+            raise ValueError()
+
+    assert calls == []
+
+
+def test_dry_run_prints_script(ctx, monkeypatch, capsys):
+    monkeypatch.setattr(env, 'dry_run', True)
+    monkeypatch.setattr(env, 'plan', None)
+    ctx.config['dir'] = '.'
+
+    with Session(ctx) as session:
+        query = session.query("SELECT 'x'")
+
+    out = capsys.readouterr().out
+    assert 'docker-compose exec -T postgres psql -U postgres' in out
+    assert "SELECT 'x';" in out
+    assert query.rows == []
+
+
+def test_query_parse_empty_result():
+    query = Query('SELECT 1 WHERE false;')
+    query._parse(['?column?'])
+
+    assert (query.sql, query.columns, len(query), query.scalar()) == ('SELECT 1 WHERE false', ['?column?'], 0, None)
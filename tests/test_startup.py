@@ -0,0 +1,18 @@
+import subprocess
+import sys
+
+from dstack_tasks.develop import HEAVY_MODULES, benchmark_startup
+
+
+def test_no_heavy_imports_at_startup():
+    probe = 'import sys, dstack_tasks.main; print(",".join(sys.modules))'
+    loaded = subprocess.run([sys.executable, '-c', probe], check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout.strip().split(',')
+
+    assert [module for module in HEAVY_MODULES if module in loaded] == []
+
+
+def test_startup_within_budget(ctx):
+    timings = benchmark_startup(ctx, runs=3, budget=0.5)
+
+    assert set(timings) == {'dstack --list', 'dstack dry echo'}
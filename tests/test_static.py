@@ -0,0 +1,87 @@
+import os
+import subprocess
+
+import pytest
+
+from dstack_tasks import static
+
+
+@pytest.fixture
+def assets(tmp_path):
+    root = tmp_path / 'static'
+    (root / 'css').mkdir(parents=True)
+    (root / 'css' / 'site.css').write_text('body {}\n')
+    (root / 'app.js').write_text('alert(1)\n')
+    (root / 'style.less').write_text('@x: 1;\n')
+    return root
+
+
+def test_build_manifest_reuses_cached_hashes(assets, monkeypatch):
+    manifest = static.build_manifest(str(assets), exclude=['*.less'])
+    assert sorted(manifest) == ['app.js', 'css/site.css']
+    assert manifest['app.js'] == {'hash': static.file_hash(str(assets / 'app.js')), 'size': 9}
+
+    hashed = []
+
+    def file_hash(path):
+        hashed.append(path)
+        return 'changed'
+
+    monkeypatch.setattr(static, 'file_hash', file_hash)
+    (assets / 'app.js').write_text('alert(2);\n')
+
+    assert static.build_manifest(str(assets), exclude=['*.less'])['app.js']['hash'] == 'changed'
+    assert hashed == [str(assets / 'app.js')]
+
+
+def test_upload_only_new_objects_and_read_manifest(assets, s3):
+    assert static.upload_static(str(assets), 'bkt', 'proj/static', '1.0') == (3, 24)
+    (assets / 'extra.js').write_text('alert(3)\n')
+    # Same content as app.js, stored once
+    (assets / 'copy.js').write_text('alert(1)\n')
+
+    assert static.upload_static(str(assets), 'bkt', 'proj/static', '1.1') == (1, 9)
+
+    assert sorted(static.read_manifest('bkt', 'proj/static', '1.0')) == ['app.js', 'css/site.css', 'style.less']
+    manifest = static.read_manifest('bkt', 'proj/static', '1.1')
+    assert manifest['copy.js'] == manifest['app.js']
+
+
+def test_deploy_only_changed_files(assets, s3, tmp_path):
+    static.upload_static(str(assets), 'bkt', 'proj/static', '1.0')
+    target = tmp_path / 'deployed'
+
+    assert static.deploy_static(str(target), 'bkt', 'proj/static', '1.0') == (3, 24)
+    assert (target / 'css' / 'site.css').read_text() == 'body {}\n'
+    assert oct(os.stat(str(target / 'app.js')).st_mode & 0o777) == '0o644'
+
+    (target / 'app.js').write_text('changed\n')
+    assert static.deploy_static(str(target), 'bkt', 'proj/static', '1.0') == (1, 9)
+    assert (target / 'app.js').read_text() == 'alert(1)\n'
+
+
+def test_parse_checksum_command_output(assets):
+    expected = {relative: entry['hash'] for relative, entry in static.build_manifest(str(assets)).items()}
+    (assets / 'app.js.part').write_text('partial')
+    output = subprocess.run(static.checksum_command(str(assets)), shell=True, check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+
+    checksums = static.parse_checksums(output)
+
+    assert checksums == expected
+
+
+def test_download_script_fetches_changed_files(assets):
+    manifest = static.build_manifest(str(assets))
+    checksums = {'app.js': manifest['app.js']['hash'], 'css/site.css': 'outdated'}
+
+    script, count, size = static.download_script(manifest, checksums, '/srv/my app/static', 'bkt', 'proj/static')
+
+    assert (count, size) == (2, 15)
+    lines = script.splitlines()
+    assert lines[0] == 'set -e'
+    assert "mkdir -p '/srv/my app/static/css'" in lines
+    source = 's3://bkt/' + static.object_key('proj/static', manifest['css/site.css']['hash'])
+    assert (f"aws s3 cp --quiet {source} '/srv/my app/static/css/site.css.part' && "
+            f"mv '/srv/my app/static/css/site.css.part' '/srv/my app/static/css/site.css'") in lines
+    assert not any('app.js' in line for line in lines)
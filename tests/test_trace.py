@@ -0,0 +1,109 @@
+import json
+
+import pytest
+
+from dstack_tasks.base import do
+from dstack_tasks.trace import Tracer
+from dstack_tasks.wrap import bash
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    tracer = Tracer()
+    monkeypatch.setattr('dstack_tasks.base.span', tracer.span)
+    monkeypatch.setattr('dstack_tasks.wrap.span', tracer.span)
+    return tracer
+
+
+def test_streamed_command_span_ends_with_stream(ctx, tracer):
+    stream = do(ctx, 'sleep 0.2; printf "a\\nb\\n"; exit 3', stream=True, hide='stdout', warn=True)
+    assert tracer.events == []
+
+    assert list(stream) == ['a', 'b']
+
+    event, = tracer.events
+    assert event['dur'] >= 200000
+    assert (event['args']['exit_code'], event['args']['stdout_bytes']) == (3, 4)
+
+
+def test_closed_stream_ends_span(ctx, tracer):
+    stream = do(ctx, 'yes', stream=True, hide='stdout')
+    next(iter(stream))
+    stream.close()
+
+    event, = tracer.events
+    assert event['args']['command'] == 'yes'
+    assert 'exit_code' not in event['args']
+
+
+def test_command_span_records_exit_code(ctx, tracer):
+    do(ctx, 'echo hello', hide=True)
+    with pytest.raises(Exception):
+        do(ctx, 'exit 2', hide=True)
+
+    assert [event['args']['exit_code'] for event in tracer.events] == [0, 2]
+
+
+def test_close_waits_for_command(ctx, tracer):
+    stream = do(ctx, 'yes', stream=True, hide='stdout')
+    next(iter(stream))
+    stream.close()
+
+    assert stream._process.returncode is not None
+    assert not stream._stderr_thread.is_alive()
+
+
+def test_close_stops_children_of_the_shell(ctx, tracer):
+    stream = do(ctx, 'echo started; sleep 30; echo done', stream=True, hide='stdout')
+    assert next(iter(stream)) == 'started'
+
+    stream.close()
+
+    event, = tracer.events
+    assert event['dur'] < 10e6
+
+
+def test_abandoned_stream_ends_span(ctx, tracer):
+    for line in do(ctx, 'yes', stream=True, hide='stdout'):
+        break
+    with do(ctx, 'yes', stream=True, hide='stdout'):
+        pass
+    stream = do(ctx, 'yes', stream=True, hide='stdout')
+    process = stream._process
+    del stream
+
+    assert len(tracer.events) == 3
+    assert process.returncode is not None
+
+
+def test_command_span_args(ctx, tracer, tmp_path):
+    do(ctx, 'printf héllo', path=str(tmp_path), hide=True)
+
+    event, = tracer.events
+    assert (event['name'], event['cat'], event['ph']) == ('printf héllo', 'command', 'X')
+    assert event['args'] == {'command': 'printf héllo', 'host': 'local', 'cwd': str(tmp_path), 'sudo': False,
+                             'exit_code': 0, 'stdout_bytes': 6, 'stderr_bytes': 0}
+
+
+def test_wrapper_span_contains_command_span(ctx, tracer):
+    bash(ctx, cmd='sleep 0.05')
+
+    command, wrapper = tracer.events
+    assert (command['cat'], wrapper['cat'], wrapper['args']) == ('command', 'wrapper', {'cmd': 'sleep 0.05'})
+    assert wrapper['ts'] <= command['ts']
+    assert command['ts'] + command['dur'] <= wrapper['ts'] + wrapper['dur']
+
+
+def test_write_chrome_trace(ctx, tracer, tmp_path):
+    do(ctx, 'true', hide=True)
+    do(ctx, 'echo ' + 'x' * 100, hide=True)
+
+    tracer.write(str(tmp_path / 'trace.json'))
+
+    with open(str(tmp_path / 'trace.json')) as f:
+        trace = json.load(f)
+    metadata, first, second = trace['traceEvents']
+    assert metadata['ph'] == 'M'
+    assert first['ts'] <= second['ts']
+    # Long commands are shortened in the name but kept in full in the args
+    assert len(second['name']) == 80 and second['args']['command'] == 'echo ' + 'x' * 100
@@ -0,0 +1,86 @@
+import subprocess
+
+import pytest
+
+from dstack_tasks import version
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """Git repository with one commit tagged v1.0. setuptools_scm is replaced by a counter of its calls."""
+    def git(*args):
+        subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args),
+                       cwd=str(tmp_path), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    calls = []
+
+    def get_version(root):
+        calls.append(root)
+        return f'1.0.{len(calls)}'
+
+    git('init', '-q')
+    (tmp_path / 'app.py').write_text('print(1)\n')
+    git('add', 'app.py')
+    git('commit', '-q', '-m', 'first')
+    git('tag', 'v1.0')
+    monkeypatch.setattr(version, '_resolved', {})
+    monkeypatch.setattr('setuptools_scm.get_version', get_version)
+    return tmp_path, git, calls
+
+
+def test_version_is_cached_per_process_and_on_disk(repo, monkeypatch):
+    root, git, calls = repo
+
+    assert version.resolve_version(root=str(root)) == '1.0.1'
+    assert version.resolve_version(root=str(root)) == '1.0.1'
+    monkeypatch.setattr(version, '_resolved', {})
+    assert version.resolve_version(root=str(root)) == '1.0.1'
+
+    assert len(calls) == 1
+    assert (root / '.local' / 'version_cache.json').exists()
+
+
+def test_new_commit_invalidates_cache(repo):
+    root, git, calls = repo
+    version.resolve_version(root=str(root))
+
+    git('commit', '-q', '--allow-empty', '-m', 'second')
+
+    assert version.resolve_version(root=str(root)) == '1.0.2'
+
+
+def test_new_tag_invalidates_cache(repo):
+    root, git, calls = repo
+    key = version.git_state(str(root))
+    version.resolve_version(root=str(root))
+
+    git('tag', 'v1.1')
+    # Tags are detected by the mtime of refs/tags, make sure it changes on coarse file systems
+    tags = root / '.git' / 'refs' / 'tags'
+    stat = tags.stat()
+    subprocess.run(['touch', '-d', '@{}'.format(int(stat.st_mtime) + 2), str(tags)], check=True)
+
+    assert version.git_state(str(root)) != key
+    assert version.resolve_version(root=str(root)) == '1.0.2'
+
+
+def test_dirty_tree_changes_key(repo):
+    root, git, calls = repo
+    key = version.git_state(str(root))
+
+    (root / 'app.py').write_text('print(2)\n')
+
+    assert version.git_state(str(root)) != key
+
+
+def test_no_git_falls_back_to_version_txt(tmp_path, monkeypatch):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'version.txt').write_text('2.3.4\n')
+
+    def get_version(root):
+        raise LookupError('not a git repository')
+
+    monkeypatch.setattr('setuptools_scm.get_version', get_version)
+
+    assert version.git_state(str(tmp_path)) is None
+    assert version.resolve_version(root=str(tmp_path)) == '2.3.4'